@@ -9,15 +9,31 @@
 #
 #############################################
 from __future__ import division
+import time
+#import and startup times are logged by main()
+IMPORT_START=time.time()
 import csv
-from collections import defaultdict
-import collections
-import pybedtools
-from pybedtools import BedTool
+from array import array
+from collections import defaultdict, deque, OrderedDict
+from itertools import izip, repeat
+import heapq
+import struct
+import zlib
+import hashlib
+import shutil
+import tempfile
+import json
+import sqlite3
+import resource
+import fcntl
+import platform
+import mmap
 import subprocess
+import threading
+import signal
+from distutils import spawn
+#numpy is used by every run (parsing, merging, stats); matplotlib and seaborn are only imported by plotImports()
 import numpy as np
-import matplotlib.pylab as plt
-import seaborn as sns
 import os
 import sys
 import logging
@@ -27,6 +43,9 @@ import datetime
 import yaml
 import errno
 import argparse
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+IMPORT_SECS=time.time()-IMPORT_START
 
 def getLength(uniq_loc_list):
 	#get length of intervals in a bedtool
@@ -37,23 +56,64 @@ def getLength(uniq_loc_list):
 
 	return tot_len
 
+def mergeIntervals(starts, ends, groups=None):
+	#merge overlapping and book-ended intervals, same rules as 'bedtools merge' (a start <= the running end joins the interval)
+	#groups (e.g. sequence ids) keep intervals on different sequences apart; returns (groups, starts, ends) sorted by group then start
+	starts=np.asarray(starts, dtype=np.int64)
+	ends=np.asarray(ends, dtype=np.int64)
+	if groups is None:
+		groups=np.zeros(starts.size, dtype=np.int64)
+	else:
+		groups=np.asarray(groups, dtype=np.int64)
+	if starts.size == 0:
+		return groups, starts, ends
+	order=np.lexsort((ends, starts, groups))
+	grp=groups[order]
+	#shift each group past the largest end so one running max covers all groups without bleeding between them
+	shift=grp*(int(ends.max())+1)
+	beg=starts[order]+shift
+	run_end=np.maximum.accumulate(ends[order]+shift)
+	new_int=np.empty(beg.size, dtype=bool)
+	new_int[0]=True
+	np.greater(beg[1:], run_end[:-1], out=new_int[1:])
+	first=np.flatnonzero(new_int)
+	last=np.append(first[1:]-1, beg.size-1)
+	return grp[first], beg[first]-shift[first], run_end[last]-shift[first]
+
+def bedtoolsMerge(chrom_list, starts, ends):
+	#optional cross-check: run the same intervals through bedtools merge (needs pybedtools and bedtools installed)
+	from pybedtools import BedTool
+	order=sorted(range(len(starts)), key=lambda i: (chrom_list[i], starts[i], ends[i]))
+	loc_str="\n".join(["%s\t%d\t%d" % (chrom_list[i], starts[i], ends[i]) for i in order])
+	return [(inter.chrom, inter.start, inter.stop, inter.stop-inter.start) for inter in BedTool(loc_str, from_string=True).merge()]
+
+#set from params:bedtools_check in the config, compares every native merge against bedtools (slow, debugging only)
+BEDTOOLS_CHECK=False
+
 def mergeLoc(loc_list):
 	#For data types where there can be redundancy, we need to merge the locs and then get the lengths
-	uniq_loc_list=[]
-	tot_len=0
-	loc_str=""
+	chrom_idx={}
+	chrom_names=[]
+	chrom_list=[]
+	groups=[]
+	starts=[]
+	ends=[]
 	for loc in loc_list:
 		(chrom, pre_loc)=loc.split(":")
 		(start, end)=pre_loc.split("-")
-		if not loc_str:
-			loc_str="%s\t%s\t%s" % (chrom, start, end)
-		else:
-			loc_str="%s\n%s\t%s\t%s" % (loc_str, chrom, start, end)
-	non_uniq=BedTool(loc_str, from_string=True)
-	uniq_int=non_uniq.merge()
-	for inter in uniq_int:
-		loc=(inter.chrom, inter.start, inter.stop, inter.stop-inter.start)
-		uniq_loc_list.append(loc)
+		if chrom not in chrom_idx:
+			chrom_idx[chrom]=len(chrom_names)
+			chrom_names.append(chrom)
+		chrom_list.append(chrom)
+		groups.append(chrom_idx[chrom])
+		starts.append(int(start))
+		ends.append(int(end))
+	(grp, uniq_start, uniq_end)=mergeIntervals(starts, ends, groups)
+	uniq_loc_list=[(chrom_names[g], s, e, e-s) for (g, s, e) in zip(grp.tolist(), uniq_start.tolist(), uniq_end.tolist())]
+	if BEDTOOLS_CHECK:
+		bt_loc_list=bedtoolsMerge(chrom_list, starts, ends)
+		if sorted(bt_loc_list) != sorted(uniq_loc_list):
+			logging.error("Native merge differs from bedtools merge: %s vs %s" % (uniq_loc_list, bt_loc_list))
 	return uniq_loc_list
 
 def sort_list(unsort_list):
@@ -64,138 +124,555 @@ def sort_list(unsort_list):
 		sort_seq_list=sorted(unsort_list)
 	return sort_seq_list
 
-def parseAlignReport(fi, assm_name, obj_dict):
-	#data structures
-	gap_no_hit = defaultdict(int)
-	ungap_no_hit = defaultdict(int)
-	no_hit_loc = defaultdict(list)
-	#will store ungap no hit if <50% of loc is N
-	ungap_no_hit_loc=defaultdict(list)
-	sp_loc=defaultdict(list)
-	sp_only_loc=defaultdict(list)
-	inv_loc=defaultdict(list)
-	mix_loc=defaultdict(list)
-	offchrom_loc=defaultdict(list)
+#reports are read in chunks of this many bytes (uncompressed files) or BGZF blocks (bgzip files, ~64kB each)
+READ_CHUNK=1<<24
+BGZF_BATCH=64
+
+class CorruptInput(Exception):
+	#a compressed input that opened fine but doesn't decode: where it went wrong and why. Not an IOError, so readers
+	#don't report it as a file they can't open; they add the file name with describe()
+	def __init__(self, where, cause):
+		Exception.__init__(self, "%s: %s" % (where, cause))
+		self.where=where
+		self.cause=cause
+
+	def describe(self, fi):
+		return "%s in %s: %s" % (self.where, fi, self.cause)
+
+def isBgzf(head):
+	#gzip member with the FEXTRA flag and a 'BC' subfield first, as written by bgzip (and BgzfWriter)
+	return len(head) >= 16 and head[:4] == "\x1f\x8b\x08\x04" and head[12:14] == "BC"
+
+def bgzfBlocks(data):
+	#(block offset, start, end) of the deflate data of every block, from the BSIZE fields alone
+	blocks=[]
+	pos=0
+	size=len(data)
+	while pos < size:
+		if data[pos:pos+4] != "\x1f\x8b\x08\x04":
+			raise CorruptInput("Corrupt BGZF block at byte %d" % pos, "no BGZF header")
+		if pos+12 > size:
+			raise CorruptInput("Truncated BGZF block at byte %d" % pos, "file ends inside the header")
+		xlen=struct.unpack("<H", data[pos+10:pos+12])[0]
+		if pos+12+xlen > size:
+			raise CorruptInput("Truncated BGZF block at byte %d" % pos, "file ends inside the header")
+		bsize=None
+		sub=pos+12
+		while sub+4 <= pos+12+xlen:
+			(si, slen)=(data[sub:sub+2], struct.unpack("<H", data[sub+2:sub+4])[0])
+			if si == "BC" and slen == 2:
+				bsize=struct.unpack("<H", data[sub+4:sub+6])[0]
+			sub += 4+slen
+		if bsize is None:
+			raise CorruptInput("Corrupt BGZF block at byte %d" % pos, "no BSIZE field")
+		if pos+bsize+1 > size:
+			raise CorruptInput("Truncated BGZF block at byte %d" % pos, "block is %d bytes, the file ends after %d" % (bsize+1, size-pos))
+		blocks.append((pos, pos+12+xlen, pos+bsize+1-8))
+		pos += bsize+1
+	return blocks
+
+def inflateBlocks(task):
+	#raw inflate of a batch of BGZF blocks; zlib releases the GIL, so batches inflate in parallel on threads
+	(data, blocks)=task
+	out=[]
+	for (pos, start, end) in blocks:
+		try:
+			text=zlib.decompress(data[start:end], -15)
+		except zlib.error as e:
+			raise CorruptInput("Corrupt BGZF block at byte %d" % pos, e)
+		if len(text) != struct.unpack("<I", data[end+4:end+8])[0]:
+			raise CorruptInput("Corrupt BGZF block at byte %d" % pos, "inflated to %d bytes, ISIZE says %d" % (len(text), struct.unpack("<I", data[end+4:end+8])[0]))
+		out.append(text)
+	return "".join(out)
+
+def bgzfChunks(data, jobs=1):
+	blocks=bgzfBlocks(data)
+	tasks=[(data, blocks[i:i+BGZF_BATCH]) for i in range(0, len(blocks), BGZF_BATCH)]
+	if jobs < 2:
+		for task in tasks:
+			yield inflateBlocks(task)
+		return
+	pool=ThreadPool(jobs)
 	try:
-		with open(fi, 'r') as infile:
-			data=csv.reader(infile, delimiter="\t")
-			for line in data:
-				#skip empty lines
-				if (len(line)==0):
-					#skip blank lines
-					continue
-				elif (line[0].startswith("#")):
-					#skip header lines
+		#keep a few batches per thread inflating ahead of the parser: they overlap with parsing but memory stays bounded
+		ahead=deque()
+		for task in tasks:
+			ahead.append(pool.apply_async(inflateBlocks, (task,)))
+			if len(ahead) > jobs*2:
+				yield ahead.popleft().get()
+		while ahead:
+			yield ahead.popleft().get()
+	finally:
+		pool.terminate()
+		pool.join()
+
+def gzipChunks(fi, jobs=1):
+	#ordinary gzip can't be split, so decompress in a pigz or gzip process alongside the parsing; zlib in this process without either
+	for prog in ("pigz", "gzip"):
+		path=spawn.find_executable(prog)
+		if path:
+			cmd=[path, "-dc", fi] if prog == "gzip" else [path, "-dc", "-p", str(max(jobs, 1)), fi]
+			proc=subprocess.Popen(cmd, stdout=subprocess.PIPE)
+			done=False
+			try:
+				for chunk in iter(lambda: proc.stdout.read(READ_CHUNK), ""):
+					yield chunk
+				done=True
+			finally:
+				#the reader may stop early (e.g. assembly name mismatch)
+				if not done and proc.poll() is None:
+					proc.kill()
+				proc.stdout.close()
+				returncode=proc.wait()
+			if returncode != 0:
+				#it has said why on stderr; the offset isn't known here
+				raise CorruptInput("Corrupt gzip data", "%s -d exited with status %d" % (prog, returncode))
+			return
+	with open(fi, 'rb') as infile:
+		inflater=zlib.decompressobj(16+zlib.MAX_WBITS)
+		for data in iter(lambda: infile.read(READ_CHUNK), ""):
+			while data:
+				try:
+					text=inflater.decompress(data)
+				except zlib.error as e:
+					raise CorruptInput("Corrupt gzip data in the %d bytes from byte %d" % (len(data), infile.tell()-len(data)), e)
+				yield text
+				#concatenated members: start over on whatever follows the end of the last one
+				data=inflater.unused_data
+				if data:
+					inflater=zlib.decompressobj(16+zlib.MAX_WBITS)
+
+def iterLineChunks(fi, jobs=1):
+	#the lines of a report (without line ends) in lists, one per chunk read. Plain, gzip or bgzip input, told apart by the first bytes.
+	#plain files are memory mapped and split a chunk at a time, bgzip blocks are inflated on jobs threads
+	with open(fi, 'rb') as infile:
+		if os.fstat(infile.fileno()).st_size == 0:
+			return
+		data=mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+	try:
+		head=data[:16]
+		if isBgzf(head):
+			chunks=bgzfChunks(data, jobs)
+		elif head[:2] == "\x1f\x8b":
+			chunks=gzipChunks(fi, jobs)
+		else:
+			chunks=(data[i:i+READ_CHUNK] for i in xrange(0, len(data), READ_CHUNK))
+		tail=""
+		for chunk in chunks:
+			lines=(tail+chunk).split("\n")
+			tail=lines.pop()
+			yield lines
+		if tail:
+			yield [tail]
+	finally:
+		data.close()
+
+def readLines(fi, jobs=1):
+	#iterLineChunks one line at a time
+	for lines in iterLineChunks(fi, jobs):
+		for line in lines:
+			yield line
+
+#alignment report data types, in the order they are stored
+ALIGN_TYPES=["NoHit", "SP", "SP Only", "Inv", "Mix"]
+
+class AlignColumns(object):
+	#typed columns for the rows of one alignment report data type
+	def __init__(self):
+		self.seq_id=array('l')#index into the report's sequence name list
+		self.start=array('l')#0-based start
+		self.end=array('l')
+		self.gap_len=array('l')
+		self.ungap_len=array('l')
+
+	def __len__(self):
+		return len(self.seq_id)
+
+	def add(self, seq_id, start, end, gap_len, ungap_len):
+		self.seq_id.append(seq_id)
+		self.start.append(start)
+		self.end.append(end)
+		self.gap_len.append(gap_len)
+		self.ungap_len.append(ungap_len)
+
+	def extend(self, other):
+		self.seq_id.extend(other.seq_id)
+		self.start.extend(other.start)
+		self.end.extend(other.end)
+		self.gap_len.extend(other.gap_len)
+		self.ungap_len.extend(other.ungap_len)
+
+	def arrays(self):
+		#numpy views of the columns (no copy)
+		return [np.frombuffer(col, dtype=np.int_) if len(col) else np.zeros(0, dtype=np.int_) for col in (self.seq_id, self.start, self.end, self.gap_len, self.ungap_len)]
+
+def iterAlignBlocks(fi, assm_name, jobs=1):
+	#stream the report, yielding (seq_id, seq_name, {data_type: AlignColumns}) as each 'Sequence Name:' block ends.
+	#seq_id numbers sequences in the order they first appear
+	seq_ids={}
+	seq_id=None
+	cols=None
+	try:
+		for lines in iterLineChunks(fi, jobs):
+			for line in lines:
+				line=line.rstrip("\r")
+				if not line or line[0] == "#":
+					#skip blank and header lines
 					continue
-				elif (len(line) == 1):
+				fields=line.split("\t")
+				if len(fields) == 1:
 					#metadata
-					if line[0].startswith('Query Assembly Name:'):
-						query_asm_name = line[0].split(':')[1].lstrip()
+					if line.startswith('Query Assembly Name:'):
+						query_asm_name = line.split(':')[1].lstrip()
 						if not query_asm_name == assm_name:
 							logging.critical("Assembly name mismatch: %s\t%s" % (query_asm_name, assm_name))
 							sys.exit(3)
-					if line[0].startswith('Sequence Name:'):
-						seq_name = line[0].split(':')[1].lstrip()
-				else:
+					elif line.startswith('Sequence Name:'):
+						if cols is not None:
+							yield seq_id, seq_name, cols
+						seq_name = line.split(':')[1].lstrip()
+						seq_id=seq_ids.setdefault(seq_name, len(seq_ids))
+						cols=dict((data_type, AlignColumns()) for data_type in ALIGN_TYPES)
+				elif cols is not None:
 					#data lines
-					#print line
-					data_type=line[0]
-					start = int(line[1])-1
-					end = int(line[2])
-					gap_len = int(line[3])
-					ungap_len = int(line[5])
-					loc="%s:%d-%d" % (seq_name, start, end)
-					#can count no hit locs because there should be no overlap
-					if data_type == "NoHit":
-						gap_no_hit[seq_name] += gap_len
-						ungap_no_hit[seq_name] += ungap_len
-						no_hit_loc[seq_name].append(loc)
-						#store unap loc if <50% of the loc is N
-						if (ungap_len/gap_len >.5):
-							ungap_no_hit_loc[seq_name].append(loc)
-					#all other locs, need to get locs and then uniquify
-					elif data_type == "Inv":
-						inv_loc[seq_name].append(loc)
-					elif data_type == "Mix":
-						mix_loc[seq_name].append(loc)
-					elif data_type == "SP":
-						sp_loc[seq_name].append(loc)
-					elif data_type == "SP Only":
-						sp_only_loc[seq_name].append(loc)
-
+					col=cols.get(fields[0])
+					if col is not None:
+						col.add(seq_id, int(fields[1])-1, int(fields[2]), int(fields[3]), int(fields[5]))
+		if cols is not None:
+			yield seq_id, seq_name, cols
+	except CorruptInput as e:
+		logging.critical(e.describe(fi))
+		sys.exit(2)
 	except IOError:
 		logging.critical("Can't open %s" % fi)
 		sys.exit(2)
-	#set alignment attribute information for seq_object
+
+def readAlignReport(fi, assm_name, jobs=1):
+	#read the whole report into one set of typed columns per data type
+	seq_names=[]
+	cols=dict((data_type, AlignColumns()) for data_type in ALIGN_TYPES)
+	for (seq_id, seq_name, block_cols) in iterAlignBlocks(fi, assm_name, jobs):
+		if seq_id == len(seq_names):
+			seq_names.append(seq_name)
+		for data_type in ALIGN_TYPES:
+			cols[data_type].extend(block_cols[data_type])
+	return seq_names, cols
+
+def ungapMask(gap_len, ungap_len):
+	#store ungap loc if <50% of the loc is N
+	return ungap_len*2 > gap_len
+
+def mergeTask(task):
+	(key, start, end, seq_id)=task
+	return mergeIntervals(start, end, seq_id)
+
+def mergeAlignColumns(cols, num_seqs, jobs=1):
+	#merge each data type per sequence; NoHit gapped/ungapped totals are summed from the raw rows
+	merged={}
+	(seq_id, start, end, gap_len, ungap_len)=cols["NoHit"].arrays()
+	merged['nohit_len']=np.bincount(seq_id, weights=gap_len, minlength=num_seqs).astype(np.int64)
+	merged['ungap_nohit_len']=np.bincount(seq_id, weights=ungap_len, minlength=num_seqs).astype(np.int64)
+	tasks=[('nohit', start, end, seq_id)]
+	ungap=ungapMask(gap_len, ungap_len)
+	tasks.append(('ungap_nohit', start[ungap], end[ungap], seq_id[ungap]))
+	for (key, data_type) in (('sp', "SP"), ('sp_only', "SP Only"), ('inv', "Inv"), ('mix', "Mix")):
+		(seq_id, start, end, gap_len, ungap_len)=cols[data_type].arrays()
+		tasks.append((key, start, end, seq_id))
+	if jobs < 2:
+		for task in tasks:
+			merged[task[0]]=mergeTask(task)
+		return merged
+	#split every data type into ranges of sequence ids; ranges don't share sequences so the merged chunks just concatenate in order.
+	#threads rather than processes: numpy sorts release the GIL and this may already be running inside a pool worker.
+	bounds=np.linspace(0, num_seqs, jobs+1).astype(np.int64)
+	chunks=[]
+	for (key, start, end, seq_id) in tasks:
+		for (lo, hi) in zip(bounds[:-1], bounds[1:]):
+			keep=(seq_id >= lo) & (seq_id < hi)
+			chunks.append((key, start[keep], end[keep], seq_id[keep]))
+	pool=ThreadPool(jobs)
+	try:
+		results=pool.map(mergeTask, chunks)
+	finally:
+		pool.close()
+		pool.join()
+	for (n, task) in enumerate(tasks):
+		parts=results[n*jobs:(n+1)*jobs]
+		merged[task[0]]=tuple(np.concatenate([part[i] for part in parts]) for i in range(3))
+	return merged
+
+def splitBySeq(grouped, seq_names):
+	#turn merged (seq_id, start, end) arrays into a loc tuple list per sequence name
+	(grp, start, end)=grouped
+	offsets=np.searchsorted(grp, np.arange(len(seq_names)+1))
+	start=start.tolist()
+	end=end.tolist()
+	loc_lists={}
+	for (i, seq) in enumerate(seq_names):
+		loc_lists[seq]=[(seq, s, e, e-s) for (s, e) in zip(start[offsets[i]:offsets[i+1]], end[offsets[i]:offsets[i+1]])]
+	return loc_lists
+
+#merged alignment data keys, each a (seq_id, start, end) triple of arrays
+MERGED_KEYS=['nohit', 'ungap_nohit', 'sp', 'sp_only', 'inv', 'mix']
+
+def loadAlignData(fi, assm_name, jobs=1):
+	#merged alignment data for a report, from the cache when there is an entry for it
+	key=None
+	if REPORT_CACHE:
+		key=REPORT_CACHE.key("align", fi, assm_name)
+		with METRICS.stage("align_cache", assm_name) as stage:
+			arrays=REPORT_CACHE.load(key)
+			if arrays is not None:
+				logging.info("Using cached alignment data for %s" % fi)
+				merged={'nohit_len': arrays['nohit_len'], 'ungap_nohit_len': arrays['ungap_nohit_len']}
+				for merged_key in MERGED_KEYS:
+					merged[merged_key]=(arrays[merged_key+'_seq'], arrays[merged_key+'_start'], arrays[merged_key+'_end'])
+				stage.count('intervals_merged', sum([merged[merged_key][0].size for merged_key in MERGED_KEYS]))
+				return arrays['seq_names'].tolist(), merged
+	with METRICS.stage("align_report", assm_name) as stage:
+		(seq_names, cols)=readAlignReport(fi, assm_name, jobs)
+		stage.count('sequences', len(seq_names))
+		stage.count('rows_parsed', sum([len(cols[data_type]) for data_type in ALIGN_TYPES]))
+		stage.count('bytes_read', os.path.getsize(fi))
+	logging.debug("%s: %s rows" % (assm_name, ", ".join(["%s %d" % (data_type, len(cols[data_type])) for data_type in ALIGN_TYPES])))
+	with METRICS.stage("merge", assm_name) as stage:
+		merged=mergeAlignColumns(cols, len(seq_names), jobs)
+		if METRICS.enabled:
+			#every row goes into one merge, the ungapped NoHit rows into a second one as well
+			stage.count('intervals_in', sum([len(cols[data_type]) for data_type in ALIGN_TYPES])+int(ungapMask(*cols["NoHit"].arrays()[3:]).sum()))
+			stage.count('intervals_merged', sum([merged[merged_key][0].size for merged_key in MERGED_KEYS]))
+	if key:
+		arrays={'seq_names': np.array(seq_names, dtype='S'), 'nohit_len': merged['nohit_len'], 'ungap_nohit_len': merged['ungap_nohit_len']}
+		for merged_key in MERGED_KEYS:
+			(arrays[merged_key+'_seq'], arrays[merged_key+'_start'], arrays[merged_key+'_end'])=merged[merged_key]
+		REPORT_CACHE.save(key, arrays)
+	return seq_names, merged
+
+def parseAlignReport(fi, assm_name, obj_dict, jobs=1):
+	#returns the report's sequence names and merged arrays so later steps can work on the arrays directly
+	(seq_names, merged)=loadAlignData(fi, assm_name, jobs)
+	with METRICS.stage("set_align", assm_name):
+		if isinstance(obj_dict, Assembly):
+			obj_dict.setAlignData(seq_names, merged)
+		else:
+			setAlignData(obj_dict, seq_names, merged, assm_name)
+	return seq_names, merged
+
+def setAlignData(obj_dict, seq_names, merged, assm_name):
+	#set alignment attribute information for a {name: Seq} dict (Assembly has its own setAlignData)
+	seq_ids=dict((seq, i) for (i, seq) in enumerate(seq_names))
+	loc_lists=dict((key, splitBySeq(merged[key], seq_names)) for key in MERGED_KEYS)
 	for seq in obj_dict:
-		if not seq in gap_no_hit:
-			logging.debug("Seq has no NoHit %s: %s" % (assm_name, seq))
+		i=seq_ids.get(seq)
+		if i is None:
+			logging.debug("Seq has no alignment data %s: %s" % (assm_name, seq))
 			obj_dict[seq].set_nohit(0, 0, [], [])
-		else:
-			uniq_no_hit_loc=mergeLoc(no_hit_loc[seq])
-			uniq_ungap_no_hit_loc=mergeLoc(ungap_no_hit_loc[seq])
-			obj_dict[seq].set_nohit(gap_no_hit[seq], ungap_no_hit[seq], uniq_no_hit_loc, uniq_ungap_no_hit_loc)
-		if not seq in sp_loc:
-			logging.debug("Seq has no SP %s: %s" % (assm_name, seq))
 			obj_dict[seq].set_sp(0, [])
-		else:
-			sp_uniq_loc=mergeLoc(sp_loc[seq])
-			sp_len=getLength(sp_uniq_loc)
-			obj_dict[seq].set_sp(sp_len[seq], sp_uniq_loc)
-		if not seq in sp_only_loc:
-			logging.debug("Seq has no SP Only %s: %s" % (assm_name, seq))
 			obj_dict[seq].set_sp_only(0, [])
+			obj_dict[seq].set_inv(0, [])
+			obj_dict[seq].set_mix(0, [])
+			continue
+		obj_dict[seq].set_nohit(int(merged['nohit_len'][i]), int(merged['ungap_nohit_len'][i]), loc_lists['nohit'][seq], loc_lists['ungap_nohit'][seq])
+		sp_list=loc_lists['sp'][seq]
+		obj_dict[seq].set_sp(getLength(sp_list)[seq], sp_list)
+		sp_only_list=loc_lists['sp_only'][seq]
+		obj_dict[seq].set_sp_only(getLength(sp_only_list)[seq], sp_only_list)
+		inv_list=loc_lists['inv'][seq]
+		obj_dict[seq].set_inv(getLength(inv_list)[seq], inv_list)
+		mix_list=loc_lists['mix'][seq]
+		obj_dict[seq].set_mix(getLength(mix_list)[seq], mix_list)
+
+
+def topNOrder(length, n, *tie_keys):
+	#indices of the n largest lengths, largest first, ties broken by tie_keys (ascending, in the order given).
+	#np.partition finds the cut-off in linear time so only the candidates are sorted
+	if n <= 0 or length.size == 0:
+		return np.zeros(0, dtype=np.int64)
+	if length.size > n:
+		kth=length.size-n
+		cand=np.flatnonzero(length >= np.partition(length, kth)[kth])
+	else:
+		cand=np.arange(length.size)
+	keys=[key[cand] for key in reversed(tie_keys)]+[-length[cand]]
+	return cand[np.lexsort(keys)][:n]
+
+def seqRank(seq_names, assm_dict):
+	#position of each report sequence in sort_list order, -1 for sequences not in the assembly; used to break length ties
+	pos=dict((seq, i) for (i, seq) in enumerate(sort_list(assm_dict.keys())))
+	return np.array([pos.get(seq, -1) for seq in seq_names], dtype=np.int64)
+
+def topNIntervals(seq_names, grouped, n, seq_rank):
+	#genome-wide top n of merged (seq_id, start, end) arrays, as loc tuples
+	(grp, start, end)=grouped
+	rank=seq_rank[grp]
+	keep=np.flatnonzero(rank >= 0)
+	order=keep[topNOrder((end-start)[keep], n, rank[keep], start[keep])]
+	return [(seq_names[g], s, e, e-s) for (g, s, e) in zip(grp[order].tolist(), start[order].tolist(), end[order].tolist())]
+
+def topNBySeq(seq_names, grouped, n, seq_rank):
+	#top n of every sequence: one sort by (sequence, -length, start), then the first n of each sequence. {seq: [loc tuples]}
+	(grp, start, end)=grouped
+	length=end-start
+	rank=seq_rank[grp]
+	order=np.lexsort((start, -length, rank))
+	order=order[rank[order] >= 0]
+	sorted_rank=rank[order]
+	within=np.arange(order.size)-np.searchsorted(sorted_rank, sorted_rank)
+	order=order[within < n]
+	by_seq=defaultdict(list)
+	for (g, s, e) in zip(grp[order].tolist(), start[order].tolist(), end[order].tolist()):
+		by_seq[seq_names[g]].append((seq_names[g], s, e, e-s))
+	return by_seq
+
+class TopN(object):
+	#bounded min-heap of the n longest intervals seen so far (O(log n) per interval).
+	#on equal length the lower rank wins, then the earlier interval, like a stable sort
+	def __init__(self, n):
+		self.n=n
+		self.heap=[]
+		self.count=0
+
+	def push(self, loc, rank=0):
+		item=(loc[3], -rank, -self.count, loc)
+		self.count += 1
+		if len(self.heap) < self.n:
+			heapq.heappush(self.heap, item)
+		elif self.n and item > self.heap[0]:
+			heapq.heapreplace(self.heap, item)
+
+	def pushArrays(self, seq, start, end, rank=0):
+		#only intervals that can still make the list are turned into tuples
+		length=end-start
+		if self.n and len(self.heap) >= self.n:
+			keep=np.flatnonzero(length >= self.heap[0][0])
 		else:
-			sp_only_uniq_loc=mergeLoc(sp_only_loc[seq])
-			sp_only_len=getLength(sp_only_uniq_loc)
-			obj_dict[seq].set_sp_only(sp_only_len[seq], sp_only_uniq_loc)
-		if not seq in inv_loc:
-			logging.debug("Seq has no INV data: %s: %s" % (assm_name, seq))
-			obj_dict[seq].set_inv(0,[])
-		else:
-			inv_uniq_loc=mergeLoc(inv_loc[seq])
-			inv_len=getLength(inv_uniq_loc)
-			obj_dict[seq].set_inv(inv_len[seq], inv_uniq_loc)
-		if not seq in mix_loc:
-			logging.debug("Seq has no Mix data: %s: %s" % (assm_name, seq))
-			obj_dict[seq].set_mix(0,[])
-		else:
-			mix_uniq_loc=mergeLoc(mix_loc[seq])
-			mix_len=getLength(mix_uniq_loc)
-			obj_dict[seq].set_mix(mix_len[seq], mix_uniq_loc)
+			keep=np.sort(topNOrder(length, self.n))
+		for (s, e) in zip(start[keep].tolist(), end[keep].tolist()):
+			self.push((seq, s, e, e-s), rank)
+
+	def items(self):
+		return [item[3] for item in sorted(self.heap, reverse=True)]
 
+def mergeBlock(cols):
+	#merge the rows of one sequence block: {merged key: (start, end)} plus the NoHit gapped/ungapped totals
+	merged={}
+	(seq_id, start, end, gap_len, ungap_len)=cols["NoHit"].arrays()
+	merged['nohit_len']=int(gap_len.sum())
+	merged['ungap_nohit_len']=int(ungap_len.sum())
+	merged['nohit']=mergeIntervals(start, end)[1:]
+	ungap=ungapMask(gap_len, ungap_len)
+	merged['ungap_nohit']=mergeIntervals(start[ungap], end[ungap])[1:]
+	for (key, data_type) in (('sp', "SP"), ('sp_only', "SP Only"), ('inv', "Inv"), ('mix', "Mix")):
+		(seq_id, start, end, gap_len, ungap_len)=cols[data_type].arrays()
+		merged[key]=mergeIntervals(start, end)[1:]
+	return merged
+
+def streamAlignReport(fi, assm_name, obj_dict, bed_writers, top_lists, top_by_seq=None, stage=None, jobs=1):
+	#bounded memory version of parseAlignReport: every sequence block is merged as soon as it ends, its bed rows are written
+	#to bed_writers ({merged key: BedWriter}) and its intervals offered to top_lists ({merged key: TopN}).
+	#top_by_seq ({merged key: {}}) is filled with each sequence's own top n, n taken from the TopN lists.
+	#Seq objects only keep the lengths, their interval lists stay empty. Row and interval counts go to stage (see Metrics).
+	stage=stage or NULL_STAGE
+	if isinstance(obj_dict, Assembly):
+		obj_dict.clearAlignData()
+	else:
+		for seq in obj_dict:
+			obj_dict[seq].set_nohit(0, 0, [], [])
+			obj_dict[seq].set_sp(0, [])
+			obj_dict[seq].set_sp_only(0, [])
+			obj_dict[seq].set_inv(0, [])
+			obj_dict[seq].set_mix(0, [])
+	seq_rank=dict((seq, i) for (i, seq) in enumerate(sort_list(obj_dict.keys())))
+	def addBlock(seq, merged):
+		obj=obj_dict[seq]
+		lens=dict((key, int((end-start).sum())) for (key, (start, end)) in [(key, merged[key]) for key in MERGED_KEYS])
+		obj.set_nohit(obj.nohit_len+merged['nohit_len'], obj.ungap_nohit_len+merged['ungap_nohit_len'], [], [])
+		obj.set_sp(obj.sp_len+lens['sp'], [])
+		obj.set_sp_only(obj.sp_only_len+lens['sp_only'], [])
+		obj.set_inv(obj.inv_len+lens['inv'], [])
+		obj.set_mix(obj.mix_len+lens['mix'], [])
+		stage.count('intervals_merged', sum([merged[key][0].size for key in MERGED_KEYS]))
+		for key in MERGED_KEYS:
+			(start, end)=merged[key]
+			if key in bed_writers and start.size:
+				bed_writers[key].writeRows(seq, start.tolist(), end.tolist())
+			if key in top_lists:
+				top_lists[key].pushArrays(seq, start, end, seq_rank[seq])
+				if top_by_seq is not None:
+					order=topNOrder(end-start, top_lists[key].n, start)
+					top_by_seq[key][seq]=[(seq, s, e, e-s) for (s, e) in zip(start[order].tolist(), end[order].tolist())]
+	#a block is held back until the next one starts, so a sequence split over consecutive blocks is merged as one
+	#(merging merged intervals again gives the same result as merging all the rows at once)
+	(pending_seq, pending)=(None, None)
+	done=set()
+	for (seq_id, seq, cols) in iterAlignBlocks(fi, assm_name, jobs):
+		if seq not in obj_dict:
+			logging.debug("Seq not in sequence report %s: %s" % (assm_name, seq))
+			continue
+		stage.count('rows_parsed', sum([len(cols[data_type]) for data_type in ALIGN_TYPES]))
+		merged=mergeBlock(cols)
+		if seq == pending_seq:
+			for key in MERGED_KEYS:
+				merged[key]=mergeIntervals(np.append(pending[key][0], merged[key][0]), np.append(pending[key][1], merged[key][1]))[1:]
+			for key in ('nohit_len', 'ungap_nohit_len'):
+				merged[key] += pending[key]
+		else:
+			if pending_seq is not None:
+				addBlock(pending_seq, pending)
+				done.add(pending_seq)
+			if seq in done:
+				#its rows are already written: the beds, stats and tabix index would all be wrong
+				logging.critical("%s comes back after other sequences in %s, which streaming can't merge; run with stream: no" % (seq, fi))
+				sys.exit(1)
+		(pending_seq, pending)=(seq, merged)
+	if pending_seq is not None:
+		addBlock(pending_seq, pending)
 
 def parseSeqRep(fi, assm_name, assm_acc, chrom_list, exclude_mt):
 	#parse the NCBI seq report to get names, roles, assm-units, etc
-	assm_list={}
+	names=[]
+	seq_idx={}
+	lengths=[]
+	roles=[]
+	units=[]
 	try:
-		with open(fi, 'r') as infile:
-			data=csv.reader(infile, delimiter="\t")
-			for line in data:
-				if line[0].startswith("# Assembly Name:"):
-					if assm_name not in line[0]:
-						logging.critical("Wrong report, assembly name mismatch: %s\t%s" % (assm_name, line[0]))
-			 	if not line[0].startswith("#"):
-			 		rec = Seq()
-			 		rec.assm=assm_name
-			 		rec.name=line[0]
-			 		rec.ref_acc=assm_acc
-			 		rec.length=int(line[8])
-			 		rec.role=line[1]
-			 		rec.assm_unit=line[7]
-			 		assm_list[line[0]]=rec
-			 		if exclude_mt == True:
-			 			if line[1] == 'assembled-molecule' and line[7] == "Primary Assembly":
-			 				chrom_list.append(line[0])
-			 		else:
-			 			if line[1] == 'assembled-molecule':
-			 				chrom_list.append(line[0])
+		data=csv.reader(readLines(fi), delimiter="\t")
+		for line in data:
+			if line[0].startswith("# Assembly Name:"):
+				if assm_name not in line[0]:
+					logging.critical("Wrong report, assembly name mismatch: %s\t%s" % (assm_name, line[0]))
+			if not line[0].startswith("#"):
+				if line[0] in seq_idx:
+					#a repeated name replaces the earlier row
+					i=seq_idx[line[0]]
+					(lengths[i], roles[i], units[i])=(int(line[8]), line[1], line[7])
+					continue
+				seq_idx[line[0]]=len(names)
+				names.append(line[0])
+				lengths.append(int(line[8]))
+				roles.append(line[1])
+				units.append(line[7])
 
+	except CorruptInput as e:
+		logging.critical(e.describe(fi))
+		sys.exit(1)
 	except IOError:
 		logging.critical("Can't open %s" % fi)
 		sys.exit(1)
 
-	return assm_list
+	assm=Assembly(assm_name, assm_acc, names, lengths, roles, units)
+	chrom_list.extend(assm.chromList(exclude_mt))
+	return assm
+
+def seqAliases(fi):
+	#{GenBank, RefSeq or UCSC-style name: Sequence-Name} from a seq report, so a sequence file may use any of them
+	aliases={}
+	for line in csv.reader(readLines(fi), delimiter="\t"):
+		if line and not line[0].startswith("#"):
+			for col in (4, 6, 9):
+				if len(line) > col and not line[col] in ("na", ""):
+					aliases.setdefault(line[col], line[0])
+	return aliases
 
 class Seq(object):
 	#set up attributes you want to track about the sequence
@@ -229,92 +706,759 @@ class Seq(object):
 		self.mix_len=mix_l
 		self.mix_loc_list=mix_loc_l
 
+#per sequence length columns of an Assembly, in stats file order
+STAT_FIELDS=['nohit_len', 'ungap_nohit_len', 'sp_len', 'sp_only_len', 'inv_len', 'mix_len']
+#interval list attribute of Seq for each merged key
+SEQ_LISTS={'nohit': 'no_hit_list', 'ungap_nohit': 'ungap_no_hit_list', 'sp': 'sp_list', 'sp_only': 'sp_only_list', 'inv': 'inv_loc_list', 'mix': 'mix_loc_list'}
+
+class Assembly(object):
+	#array-backed set of sequences: one row per sequence in a structured array (length, role, unit and the length of
+	#each data type), and the merged intervals of each data type in shared arrays indexed by per-row offsets.
+	#Stands in for the old {name: Seq} dict: keys(), len(), 'in' and [name] work, the latter returning a SeqView.
+	def __init__(self, assm_name, assm_acc, names, lengths, roles, units):
+		self.name=assm_name
+		self.acc=assm_acc
+		self.names=list(names)
+		self.index=dict((seq, i) for (i, seq) in enumerate(self.names))
+		roles=np.array(roles, dtype='S')
+		units=np.array(units, dtype='S')
+		fields=[('length', np.int64), ('role', roles.dtype), ('assm_unit', units.dtype)]+[(field, np.int64) for field in STAT_FIELDS]
+		self.table=np.zeros(len(self.names), dtype=fields)
+		self.table['length']=lengths
+		self.table['role']=roles
+		self.table['assm_unit']=units
+		#(GapIndex, its row for each of ours) once a sequence file is read, see setGaps
+		self.gaps=None
+		self.clearAlignData()
+
+	def clearAlignData(self):
+		for field in STAT_FIELDS:
+			self.table[field]=0
+		#merged key: (offsets, start, end); intervals of row i are start/end[offsets[i]:offsets[i+1]]
+		empty=np.zeros(0, dtype=np.int64)
+		self.intervals=dict((key, (np.zeros(len(self.names)+1, dtype=np.int64), empty, empty)) for key in SEQ_LISTS)
+
+	def copy(self):
+		#new assembly with the same sequences and no alignment data
+		other=object.__new__(Assembly)
+		other.name=self.name
+		other.acc=self.acc
+		other.names=self.names
+		other.index=self.index
+		other.table=self.table.copy()
+		other.gaps=self.gaps
+		other.clearAlignData()
+		return other
+
+	def __len__(self):
+		return len(self.names)
+
+	def __iter__(self):
+		return iter(self.names)
+
+	def __contains__(self, seq):
+		return seq in self.index
+
+	def __getitem__(self, seq):
+		return SeqView(self, self.index[seq])
+
+	def keys(self):
+		return list(self.names)
+
+	def itervalues(self):
+		for i in xrange(len(self.names)):
+			yield SeqView(self, i)
+
+	def iteritems(self):
+		for i in xrange(len(self.names)):
+			yield self.names[i], SeqView(self, i)
+
+	def rows(self, seq_list):
+		return np.array([self.index[seq] for seq in seq_list], dtype=np.int64)
+
+	def chromList(self, exclude_mt):
+		#chromosome names in report order; with exclude_mt only those in the Primary Assembly
+		keep=self.table['role'] == 'assembled-molecule'
+		if exclude_mt == True:
+			keep &= self.table['assm_unit'] == "Primary Assembly"
+		return [self.names[i] for i in np.flatnonzero(keep)]
+
+	def totals(self):
+		return [int(self.table[field].sum()) for field in STAT_FIELDS]
+
+	def setAlignData(self, seq_names, merged):
+		#take merged report data (keyed by report sequence id) onto the rows; report sequences not in the assembly are dropped
+		row_of=np.array([self.index.get(seq, -1) for seq in seq_names], dtype=np.int64)
+		found=np.flatnonzero(row_of >= 0)
+		self.clearAlignData()
+		self.table['nohit_len'][row_of[found]]=np.asarray(merged['nohit_len'])[found]
+		self.table['ungap_nohit_len'][row_of[found]]=np.asarray(merged['ungap_nohit_len'])[found]
+		num_rows=len(self.names)
+		for key in SEQ_LISTS:
+			(grp, start, end)=merged[key]
+			rows=row_of[grp] if len(grp) else np.zeros(0, dtype=np.int64)
+			keep=np.flatnonzero(rows >= 0)
+			#stable, so each row keeps its intervals in start order
+			order=keep[np.argsort(rows[keep], kind='mergesort')]
+			rows=rows[order]
+			start=np.asarray(start[order], dtype=np.int64)
+			end=np.asarray(end[order], dtype=np.int64)
+			self.intervals[key]=(np.searchsorted(rows, np.arange(num_rows+1)), start, end)
+			if key not in ('nohit', 'ungap_nohit'):
+				self.table[key+'_len']=np.bincount(rows, weights=end-start, minlength=num_rows).astype(np.int64)
+
+	def rowIntervals(self, key, row):
+		(offsets, start, end)=self.intervals[key]
+		return start[offsets[row]:offsets[row+1]], end[offsets[row]:offsets[row+1]]
+
+	def grouped(self, key):
+		#(row, start, end) arrays of a data type, the layout mergeIntervals returns
+		(offsets, start, end)=self.intervals[key]
+		return np.repeat(np.arange(len(self.names)), np.diff(offsets)), start, end
+
+	def setGaps(self, gaps, aliases=None):
+		#match the sequences of a GapIndex to the rows, by name or by one of the report's other names (seqAliases);
+		#returns {row: GapIndex row} of the rows matched
+		aliases=aliases or {}
+		matched={}
+		for (i, seq) in enumerate(gaps.names):
+			row=self.index.get(seq, self.index.get(aliases.get(seq)))
+			if row is not None:
+				matched.setdefault(row, i)
+		gap_rows=np.full(len(self.names), -1, dtype=np.int64)
+		gap_rows[matched.keys()]=matched.values()
+		self.gaps=(gaps, gap_rows)
+		return matched
+
+	def nCounts(self, rows, start, end):
+		#N bases in each interval of the given rows (-1 on sequences the sequence file lacks), None without a sequence file
+		if self.gaps is None:
+			return None
+		(gaps, gap_rows)=self.gaps
+		return gaps.count(gap_rows[rows], start, end)
+
+class SeqView(object):
+	#lightweight Seq stand-in for one row of an Assembly; reads and the set_* length updates go straight to the arrays
+	__slots__=('assembly', 'row')
+
+	def __init__(self, assembly, row):
+		self.assembly=assembly
+		self.row=row
+
+	def field(name):
+		def get(self):
+			val=self.assembly.table[name][self.row]
+			return int(val) if name not in ('role', 'assm_unit') else str(val)
+		return property(get)
+
+	def intervals(key):
+		def get(self):
+			seq=self.name
+			(start, end)=self.assembly.rowIntervals(key, self.row)
+			return [(seq, s, e, e-s) for (s, e) in zip(start.tolist(), end.tolist())]
+		return property(get)
+
+	assm=property(lambda self: self.assembly.name)
+	name=property(lambda self: self.assembly.names[self.row])
+	ref_acc=property(lambda self: self.assembly.acc)
+	length=field('length')
+	role=field('role')
+	assm_unit=field('assm_unit')
+	nohit_len=field('nohit_len')
+	ungap_nohit_len=field('ungap_nohit_len')
+	sp_len=field('sp_len')
+	sp_only_len=field('sp_only_len')
+	inv_len=field('inv_len')
+	mix_len=field('mix_len')
+	no_hit_list=intervals('nohit')
+	ungap_no_hit_list=intervals('ungap_nohit')
+	sp_list=intervals('sp')
+	sp_only_list=intervals('sp_only')
+	inv_loc_list=intervals('inv')
+	mix_loc_list=intervals('mix')
+	del field, intervals
+
+	def setLengths(self, **lengths):
+		for (name, val) in lengths.iteritems():
+			self.assembly.table[name][self.row]=val
+
+	#interval lists can't be set one sequence at a time (use Assembly.setAlignData), only empty ones are accepted
+	def set_nohit(self, gap_len, ungap_len, loc_list, ungap_loc_list):
+		if loc_list or ungap_loc_list:
+			raise ValueError("Assembly intervals are set with setAlignData")
+		self.setLengths(nohit_len=gap_len, ungap_nohit_len=ungap_len)
+
+	def set_sp(self, sp_l, sp_list):
+		if sp_list:
+			raise ValueError("Assembly intervals are set with setAlignData")
+		self.setLengths(sp_len=sp_l)
+
+	def set_sp_only(self, sp_only_l, sp_only_list):
+		if sp_only_list:
+			raise ValueError("Assembly intervals are set with setAlignData")
+		self.setLengths(sp_only_len=sp_only_l)
+
+	def set_inv(self, inv_l, inv_loc_l):
+		if inv_loc_l:
+			raise ValueError("Assembly intervals are set with setAlignData")
+		self.setLengths(inv_len=inv_l)
+
+	def set_mix(self, mix_l, mix_loc_l):
+		if mix_loc_l:
+			raise ValueError("Assembly intervals are set with setAlignData")
+		self.setLengths(mix_len=mix_l)
+
 def writeTopTenLine(fh, loc_list):
 	fh.write("#chr\tstart\tstop\tlen\n")
 	for loc in loc_list:
 		fh.write("%s\t%d\t%d\t%d\n" % (loc[0], loc[1], loc[2], loc[3]))
 
-def writeTopTen(fh, assm1, assm2, assm_dict):
+#top ten sections: (merged key, section title)
+TOP_TEN_SECTIONS=[('nohit', "No Hit"), ('ungap_nohit', "Ungap No Hit"), ('sp', "SP"), ('sp_only', "SP_only"), ('inv', "Inv"), ('mix', "Mix")]
+def writeTopTen(fh, assm1, assm2, assm_dict, n=10):
+	#top n by category from the intervals held on the Seq objects, selected with bounded heaps
+	top_lists=dict((key, TopN(n)) for (key, title) in TOP_TEN_SECTIONS)
+	for (rank, seq) in enumerate(sort_list(assm_dict.keys())):
+		for (key, top) in top_lists.iteritems():
+			for loc in getattr(assm_dict[seq], SEQ_LISTS[key]):
+				top.push(loc, rank)
+	writeTopTenLists(fh, assm1, assm2, dict((key, top.items()) for (key, top) in top_lists.iteritems()), n)
+
+def topTitle(n):
+	return "ten" if n == 10 else "%d" % n
+
+def writeTopTenLists(fh, assm1, assm2, top_lists, n=10):
+	#top n file from ready-made lists ({merged key: [loc tuples]})
 	date=datetime.datetime.now().strftime("%Y-%m-%d")
 	fh.write("##%s vs %s assembly alignment report\n##%s\n" % (assm1, assm2, date))
-	fh.write("##Top ten by category.\n")
-	nohit=[]
-	ungap_nohit=[]
-	sp=[]
-	sp_only=[]
-	inv=[]
-	mix=[]
-	for seq in assm_dict:
-		nohit.extend(assm_dict[seq].no_hit_list)
-		ungap_nohit.extend(assm_dict[seq].ungap_no_hit_list)
-		sp.extend(assm_dict[seq].sp_list)
-		sp_only.extend(assm_dict[seq].sp_only_list)
-		inv.extend(assm_dict[seq].inv_loc_list)
-		mix.extend(assm_dict[seq].mix_loc_list)
-	#no hit
-	sort_nohit=sorted(nohit, key=lambda x: x[3], reverse=True)
-	sort_nohit_ten=sort_nohit[:10]
-	fh.write("##No Hit\n")
-	writeTopTenLine(fh, sort_nohit_ten)
-	#ungap no Hit
-	sort_ungap_nohit=sorted(ungap_nohit, key=lambda x: x[3], reverse=True)
-	sort_ungap_nohit_ten=sort_ungap_nohit[:10]
-	fh.write("\n##Ungap No Hit\n")
-	writeTopTenLine(fh, sort_ungap_nohit_ten)
-	#sp
-	sort_sp=sorted(sp, key=lambda x: x[3], reverse=True)
-	sort_sp_ten=sort_sp[:10]
-	fh.write("\n##SP\n")
-	writeTopTenLine(fh, sort_sp_ten)
-	#sp_only
-	sort_sp_only=sorted(sp_only, key=lambda x: x[3], reverse=True)
-	sort_sp_only_ten=sort_sp_only[:10]
-	fh.write("\n##SP_only\n")
-	writeTopTenLine(fh, sort_sp_only_ten)
-	#inv
-	sort_inv=sorted(inv, key=lambda x: x[3], reverse=True)
-	sort_inv_ten=sort_inv[:10]
-	fh.write("\n##Inv\n")
-	writeTopTenLine(fh, sort_inv_ten)
-	#mix
-	sort_mix=sorted(inv, key=lambda x: x[3], reverse=True)
-	sort_mix_ten=sort_mix[:10]
-	fh.write("\n##Mix\n")
-	writeTopTenLine(fh, sort_mix_ten)
+	fh.write("##Top %s by category.\n" % topTitle(n))
+	for (i, (key, title)) in enumerate(TOP_TEN_SECTIONS):
+		fh.write("%s##%s\n" % ("\n" if i else "", title))
+		writeTopTenLine(fh, top_lists[key])
 
-def makeBed(out_file, assm_dict, data_type):
-	out_str=out_file.split(".")[0].split("/")[1]
-	out=open(out_file, 'w')
-	out.write("track name=%s\n" % out_str)
-	seq_list=assm_dict.keys()
+def writeTopBySeq(fh, assm1, assm2, by_seq, n=10):
+	#top n of each sequence by category ({merged key: {seq: [loc tuples]}}), sequences in sort_list order
+	date=datetime.datetime.now().strftime("%Y-%m-%d")
+	fh.write("##%s vs %s assembly alignment report\n##%s\n" % (assm1, assm2, date))
+	fh.write("##Top %s per sequence by category.\n" % topTitle(n))
+	for (i, (key, title)) in enumerate(TOP_TEN_SECTIONS):
+		fh.write("%s##%s\n" % ("\n" if i else "", title))
+		writeTopTenLine(fh, [loc for seq in sort_list(by_seq[key].keys()) for loc in by_seq[key][seq]])
+
+def bedTrackName(out_file):
+	return os.path.basename(out_file).split(".")[0]
+
+class BgzfWriter(object):
+	#block gzip (BGZF) output, the format bgzip/tabix/htslib read: a series of gzip members holding at most BLOCK bytes each.
+	#every block but the last holds exactly BLOCK bytes, so an uncompressed position maps to a virtual offset once the
+	#compressed start of each block is known (voffset()).
+	BLOCK=0xff00
+	EOF_BLOCK="1f8b08040000000000ff0600424302001b0003000000000000000000".decode("hex")
+
+	def __init__(self, out_file, level=6):
+		self.fh=open(out_file, 'wb')
+		self.level=level
+		self.buf=[]
+		self.buf_len=0
+		self.pos=0#uncompressed bytes written so far
+		self.block_offsets=[0]#compressed start of every block, plus the end of the last one
+
+	def write(self, data):
+		self.buf.append(data)
+		self.buf_len += len(data)
+		self.pos += len(data)
+		if self.buf_len >= self.BLOCK:
+			data="".join(self.buf)
+			done=len(data)-len(data)%self.BLOCK
+			for start in xrange(0, done, self.BLOCK):
+				self.writeBlock(data[start:start+self.BLOCK])
+			self.buf=[data[done:]]
+			self.buf_len=len(data)-done
+
+	def writeBlock(self, data):
+		comp=zlib.compressobj(self.level, zlib.DEFLATED, -15)
+		cdata=comp.compress(data)+comp.flush()
+		header=struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata)+25)
+		self.fh.write(header+cdata+struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data)))
+		self.block_offsets.append(self.block_offsets[-1]+len(header)+len(cdata)+8)
+
+	def voffset(self, pos):
+		#virtual offset of an uncompressed position, valid after close()
+		return (self.block_offsets[pos//self.BLOCK] << 16) | (pos % self.BLOCK)
+
+	def close(self):
+		if self.buf_len:
+			self.writeBlock("".join(self.buf))
+		self.fh.write(self.EOF_BLOCK)
+		self.fh.close()
+
+def reg2bin(beg, end):
+	#tabix/BAM binning scheme (16kb smallest bins, 5 levels) for the 0-based half-open interval beg-end
+	end -= 1
+	if beg>>14 == end>>14: return 4681+(beg>>14)
+	if beg>>17 == end>>17: return 585+(beg>>17)
+	if beg>>20 == end>>20: return 73+(beg>>20)
+	if beg>>23 == end>>23: return 9+(beg>>23)
+	if beg>>26 == end>>26: return 1+(beg>>26)
+	return 0
+
+class TabixIndex(object):
+	#builds a .tbi (tabix, bed preset) index while rows are written; positions are uncompressed offsets until close().
+	#rows must come grouped by sequence and sorted by start, as the merged interval lists are
+	def __init__(self, skip=1):
+		self.skip=skip#header lines (the bed track line)
+		self.names=[]
+		self.bins=[]#per sequence: {bin: [[beg_pos, end_pos], ...]}
+		self.linear=[]#per sequence: first row position overlapping each 16kb window
+
+	def add(self, seq, beg, end, beg_pos, end_pos):
+		if not self.names or self.names[-1] != seq:
+			self.names.append(seq)
+			self.bins.append({})
+			self.linear.append([])
+		chunks=self.bins[-1].setdefault(reg2bin(beg, max(end, beg+1)), [])
+		if chunks and chunks[-1][1] == beg_pos:
+			chunks[-1][1]=end_pos
+		else:
+			chunks.append([beg_pos, end_pos])
+		linear=self.linear[-1]
+		last_win=(max(end, beg+1)-1)>>14
+		if len(linear) <= last_win:
+			linear.extend([None]*(last_win+1-len(linear)))
+		for win in xrange(beg>>14, last_win+1):
+			if linear[win] is None:
+				linear[win]=beg_pos
+
+	def write(self, out_file, bgzf):
+		#bgzf: the finished BgzfWriter the positions refer to
+		out=BgzfWriter(out_file)
+		names="".join([name+"\0" for name in self.names])
+		#format 0x10000: generic, 0-based half-open coordinates; columns 1/2/3, '#' comments
+		out.write("TBI\1"+struct.pack("<iiiiiiii", len(self.names), 0x10000, 1, 2, 3, ord('#'), self.skip, len(names))+names)
+		for (bins, linear) in zip(self.bins, self.linear):
+			out.write(struct.pack("<i", len(bins)))
+			for (bin_id, chunks) in sorted(bins.iteritems()):
+				out.write(struct.pack("<Ii", bin_id, len(chunks)))
+				out.write("".join([struct.pack("<QQ", bgzf.voffset(beg_pos), bgzf.voffset(end_pos)) for (beg_pos, end_pos) in chunks]))
+			ioff=[]
+			prev=0
+			for pos in linear:
+				if pos is not None:
+					prev=bgzf.voffset(pos)
+				ioff.append(prev)
+			out.write(struct.pack("<i", len(ioff))+struct.pack("<%dQ" % len(ioff), *ioff))
+		out.close()
+
+class BedWriter(object):
+	#buffered bed output for one category; with bgzip the file is block gzipped (<out_file>.gz) and gets a tabix index (.gz.tbi)
+	def __init__(self, out_file, bgzip=False):
+		self.bgzip=bgzip
+		if bgzip:
+			self.out_file=out_file+".gz"
+			self.out=BgzfWriter(self.out_file)
+			self.index=TabixIndex()
+		else:
+			self.out_file=out_file
+			self.out=open(out_file, 'w', 1<<20)
+		self.out.write("track name=%s\n" % bedTrackName(out_file))
+
+	def writeRows(self, seq, starts, ends):
+		rows=["%s\t%d\t%d\n" % (seq, s, e) for (s, e) in zip(starts, ends)]
+		if self.bgzip:
+			pos=self.out.pos
+			for (row, s, e) in zip(rows, starts, ends):
+				self.index.add(seq, s, e, pos, pos+len(row))
+				pos += len(row)
+		self.out.write("".join(rows))
+
+	def close(self):
+		self.out.close()
+		if self.bgzip:
+			self.index.write(self.out_file+".tbi", self.out)
+
+#merged key for each bed data type
+BED_KEYS={"nohit": 'nohit', "ungap_nohit": 'ungap_nohit', "collapse": 'sp', "expand": 'sp_only', "inv": 'inv', "mix": 'mix'}
+
+def writeBeds(out_files, assm_dict, bgzip=False):
+	#all bed files of an assembly ({data type: out file}) in one pass over the sorted sequences.
+	#A bed that fails is logged and dropped while the others carry on; the failed ones are raised as OutputsFailed at the end
+	writers={}
+	failed=[]
+	def bedFailed(data_type, e):
+		logging.exception("Failed to write %s: %s" % (out_files[data_type], e))
+		failed.append(out_files[data_type])
+		writer=writers.pop(data_type, None)
+		if writer:
+			try:
+				writer.out.close()
+			except Exception:
+				pass
+	for (data_type, out_file) in out_files.iteritems():
+		if data_type not in BED_KEYS:
+			logging.error("Unknown data type, abandoning bed: %s" % data_type)
+			continue
+		try:
+			writers[data_type]=BedWriter(out_file, bgzip)
+		except Exception as e:
+			bedFailed(data_type, e)
 	#sort list alphanumerically, it looks like the complex sort barfs on non-GRC assemblies- trying work around.
-	#I should do this in the class so I don't have to do it twice in the code.
-	sort_seq_list=sort_list(seq_list)
-	loc_list=[]
-	if data_type == "nohit":
-		for seq in sort_seq_list:
-			loc_list.extend(assm_dict[seq].no_hit_list)
-	elif data_type == "collapse":
-		for seq in sort_seq_list:
-			loc_list.extend(assm_dict[seq].sp_list)
-	elif data_type == "expand":
-		for seq in sort_seq_list:
-			loc_list.extend(assm_dict[seq].sp_only_list)
-	elif data_type == "inv":
-		for seq in sort_seq_list:
-			loc_list.extend(assm_dict[seq].inv_loc_list)
-	elif data_type == "mix":
-		for seq in sort_seq_list:
-			loc_list.extend(assm_dict[seq].mix_loc_list)
-	elif data_type == "ungap_nohit":
-		for seq in sort_seq_list:
-			loc_list.extend(assm_dict[seq].ungap_no_hit_list)
-	else:
-		logging.error("Unknown data type, abandoning bed: %s" % data_type)
+	for seq in sort_list(assm_dict.keys()):
+		for (data_type, writer) in writers.items():
+			try:
+				if isinstance(assm_dict, Assembly):
+					(start, end)=assm_dict.rowIntervals(BED_KEYS[data_type], assm_dict.index[seq])
+					if start.size:
+						writer.writeRows(seq, start.tolist(), end.tolist())
+				else:
+					loc_list=getattr(assm_dict[seq], SEQ_LISTS[BED_KEYS[data_type]])
+					if loc_list:
+						writer.writeRows(seq, [loc[1] for loc in loc_list], [loc[2] for loc in loc_list])
+			except Exception as e:
+				bedFailed(data_type, e)
+	for (data_type, writer) in writers.items():
+		try:
+			writer.close()
+		except Exception as e:
+			bedFailed(data_type, e)
+	if failed:
+		raise OutputsFailed(failed)
 
-	for loc in loc_list:
-		out.write("%s\t%d\t%d\n" % (loc[0], loc[1], loc[2]))
-	out.close()
+def makeBed(out_file, assm_dict, data_type):
+	writeBeds({data_type: out_file}, assm_dict)
+
+class IntervalIndex(object):
+	#the merged intervals of both assemblies of a pair, saved as one .npz and searched with binary search.
+	#Merged intervals of a type never overlap, so on each sequence both starts and ends are sorted; with the row folded into
+	#the coordinate (row*SHIFT+pos) the whole assembly is one sorted array and a batch of regions is two searchsorted calls per type
+	VERSION=1
+	SHIFT=1<<40
+
+	def __init__(self, assemblies):
+		#[(assembly name, sequence names, {merged key: (offsets, start, end)})]
+		self.assemblies=assemblies
+		self.keys={}
+
+	@classmethod
+	def fromAssemblies(cls, assm_dicts):
+		return cls([(assm_dict.name, assm_dict.names, dict(assm_dict.intervals)) for assm_dict in assm_dicts])
+
+	def save(self, out_file):
+		arrays={'version': np.array([self.VERSION]), 'assemblies': np.array([name for (name, names, intervals) in self.assemblies], dtype='S')}
+		for (n, (name, names, intervals)) in enumerate(self.assemblies):
+			arrays['%d.names' % n]=np.array(names, dtype='S')
+			for key in MERGED_KEYS:
+				(arrays['%d.%s.offsets' % (n, key)], arrays['%d.%s.start' % (n, key)], arrays['%d.%s.end' % (n, key)])=intervals[key]
+		#np.savez adds .npz to any other name
+		with open(out_file, 'wb') as fh:
+			np.savez(fh, **arrays)
+
+	@classmethod
+	def load(cls, in_file):
+		arrays=np.load(in_file)
+		if int(arrays['version'][0]) != cls.VERSION:
+			raise ValueError("%s: interval index version %d, expected %d" % (in_file, int(arrays['version'][0]), cls.VERSION))
+		assemblies=[]
+		for (n, name) in enumerate(arrays['assemblies'].tolist()):
+			intervals=dict((key, tuple(arrays['%d.%s.%s' % (n, key, part)] for part in ('offsets', 'start', 'end'))) for key in MERGED_KEYS)
+			assemblies.append((name, arrays['%d.names' % n].tolist(), intervals))
+		return cls(assemblies)
+
+	def names(self):
+		return [name for (name, names, intervals) in self.assemblies]
+
+	def side(self, assm=None):
+		#(sequence index, intervals) of an assembly by name, the first one by default
+		for (name, names, intervals) in self.assemblies:
+			if assm is None or name == assm:
+				if name not in self.keys:
+					#row-folded starts and ends, built on first use
+					keys={}
+					for (key, (offsets, start, end)) in intervals.iteritems():
+						rows=np.repeat(np.arange(len(names), dtype=np.int64), np.diff(offsets))
+						keys[key]=(rows*self.SHIFT+start, rows*self.SHIFT+end)
+					self.keys[name]=(dict((seq, i) for (i, seq) in enumerate(names)), keys)
+				return self.keys[name]
+		raise KeyError("No assembly %s in the index (%s)" % (assm, ", ".join(self.names())))
+
+	def queryRegions(self, seqs, starts, ends, assm=None):
+		#overlaps of a batch of 0-based half-open regions: {merged key: (region numbers, interval starts, interval ends)},
+		#ordered by region then interval start. Regions on sequences the assembly doesn't have overlap nothing
+		(seq_rows, keys)=self.side(assm)
+		rows=np.array([seq_rows.get(seq, -1) for seq in seqs], dtype=np.int64)
+		found=rows >= 0
+		base=np.where(found, rows, 0)*self.SHIFT
+		starts=base+np.clip(np.asarray(starts, dtype=np.int64), 0, self.SHIFT-1)
+		ends=base+np.clip(np.asarray(ends, dtype=np.int64), 0, self.SHIFT-1)
+		hits={}
+		for key in MERGED_KEYS:
+			(key_starts, key_ends)=keys[key]
+			#first interval ending after the region start up to the first one starting at or after its end
+			lo=np.searchsorted(key_ends, starts, 'right')
+			hi=np.where(found, np.maximum(np.searchsorted(key_starts, ends, 'left'), lo), lo)
+			counts=hi-lo
+			region=np.repeat(np.arange(len(counts)), counts)
+			idx=np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts, counts)+np.repeat(lo, counts)
+			shift=rows[region]*self.SHIFT
+			hits[key]=(region, key_starts[idx]-shift, key_ends[idx]-shift)
+		return hits
+
+	def query(self, seq, start, end, assm=None):
+		#[(merged key, start, end)] of the intervals overlapping seq:start-end (0-based half-open)
+		hits=self.queryRegions([seq], [start], [end], assm)
+		return [(key, s, e) for key in MERGED_KEYS for (s, e) in zip(hits[key][1].tolist(), hits[key][2].tolist())]
+
+def fastaGaps(fi):
+	#one pass over an uncompressed FASTA through mmap, READ_CHUNK bytes at a time: (names, lengths, rows, starts, ends) of its
+	#runs of N (or n). Line ends are dropped from each chunk before looking for runs, runs cut by a chunk boundary are joined later
+	names=[]
+	lengths=[]
+	(rows, starts, ends)=([], [], [])
+	with open(fi, 'rb') as infile:
+		mm=mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			size=mm.size()
+			if not mm[0] == ">":
+				logging.critical("%s is neither FASTA nor 2bit (compressed FASTA can't be memory-mapped)" % fi)
+				sys.exit(1)
+			head=0
+			while head < size:
+				line_end=mm.find("\n", head)
+				if line_end < 0:
+					line_end=size
+				names.append((mm[head+1:line_end].split() or [""])[0])
+				next_head=mm.find("\n>", line_end)
+				seq_end=size if next_head < 0 else next_head+1
+				pos=0
+				for chunk_start in xrange(line_end+1, seq_end, READ_CHUNK):
+					data=np.frombuffer(mm, dtype=np.uint8, count=min(READ_CHUNK, seq_end-chunk_start), offset=chunk_start)
+					bases=data[(data != 10) & (data != 13)]
+					is_n=np.zeros(bases.size+2, dtype=np.int8)
+					is_n[1:-1]=(bases == 78) | (bases == 110)
+					edges=np.diff(is_n)
+					starts.append(np.flatnonzero(edges == 1)+pos)
+					ends.append(np.flatnonzero(edges == -1)+pos)
+					rows.append(np.full(starts[-1].size, len(names)-1, dtype=np.int64))
+					pos += bases.size
+				lengths.append(pos)
+				head=seq_end
+		finally:
+			mm.close()
+	empty=np.zeros(0, dtype=np.int64)
+	return names, lengths, np.concatenate(rows) if rows else empty, np.concatenate(starts) if starts else empty, np.concatenate(ends) if ends else empty
+
+#first 4 bytes of a 2bit file, little and big endian
+TWO_BIT_SIGS={"\x43\x27\x41\x1a": "<", "\x1a\x41\x27\x43": ">"}
+
+def twoBitGaps(fi):
+	#(names, lengths, rows, starts, ends) of the N blocks a 2bit file lists for each sequence, read through mmap without
+	#touching the packed bases. Version 1 files have 64-bit sequence offsets
+	with open(fi, 'rb') as infile:
+		mm=mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			endian=TWO_BIT_SIGS[mm[:4]]
+			(version, seq_count)=struct.unpack(endian+"II", mm[4:12])
+			offset_fmt=endian+("Q" if version == 1 else "I")
+			offset_size=struct.calcsize(offset_fmt)
+			names=[]
+			lengths=[]
+			(rows, starts, ends)=([], [], [])
+			pos=16
+			for row in xrange(seq_count):
+				name_size=ord(mm[pos])
+				names.append(mm[pos+1:pos+1+name_size])
+				pos += 1+name_size
+				seq_offset=struct.unpack(offset_fmt, mm[pos:pos+offset_size])[0]
+				pos += offset_size
+				(dna_size, n_blocks)=struct.unpack(endian+"II", mm[seq_offset:seq_offset+8])
+				lengths.append(dna_size)
+				block_start=np.frombuffer(mm, dtype=endian+"u4", count=n_blocks, offset=seq_offset+8).astype(np.int64)
+				block_size=np.frombuffer(mm, dtype=endian+"u4", count=n_blocks, offset=seq_offset+8+4*n_blocks).astype(np.int64)
+				starts.append(block_start)
+				ends.append(block_start+block_size)
+				rows.append(np.full(n_blocks, row, dtype=np.int64))
+		finally:
+			mm.close()
+	empty=np.zeros(0, dtype=np.int64)
+	return names, lengths, np.concatenate(rows) if rows else empty, np.concatenate(starts) if starts else empty, np.concatenate(ends) if ends else empty
+
+class GapIndex(object):
+	#runs of N in an assembly's sequence file, row-folded (row*SHIFT+pos) like IntervalIndex so the runs of all sequences
+	#are one sorted array, with a running total of run lengths. The N count of a batch of intervals is then two searchsorted
+	#calls and a difference of running totals, trimmed by the parts of the end runs that stick out, without reading any bases
+	SHIFT=IntervalIndex.SHIFT
+
+	def __init__(self, names, lengths, rows, starts, ends):
+		self.names=list(names)
+		self.index=dict((seq, i) for (i, seq) in enumerate(self.names))
+		self.lengths=np.asarray(lengths, dtype=np.int64)
+		#sorted, with runs that touch (across a chunk boundary, or adjacent 2bit blocks) joined
+		(rows, starts, ends)=mergeIntervals(starts, ends, rows)
+		self.rows=rows
+		self.starts=rows*self.SHIFT+starts
+		self.ends=rows*self.SHIFT+ends
+		self.total=np.append(0, np.cumsum(ends-starts))
+		self.seq_n=np.bincount(rows, weights=ends-starts, minlength=len(self.names)).astype(np.int64)
+
+	def count(self, rows, starts, ends):
+		#N bases in each 0-based half-open interval on the given sequence rows; -1 where the row is -1 (not in the file)
+		rows=np.asarray(rows, dtype=np.int64)
+		found=rows >= 0
+		base=np.where(found, rows, 0)*self.SHIFT
+		starts=base+np.asarray(starts, dtype=np.int64)
+		ends=base+np.asarray(ends, dtype=np.int64)
+		#runs first..last-1 overlap the interval
+		first=np.searchsorted(self.ends, starts, 'right')
+		last=np.maximum(np.searchsorted(self.starts, ends, 'left'), first)
+		n=self.total[last]-self.total[first]
+		hit=np.flatnonzero(last > first)
+		n[hit] -= np.maximum(starts[hit]-self.starts[first[hit]], 0)+np.maximum(self.ends[last[hit]-1]-ends[hit], 0)
+		return np.where(found, n, -1)
+
+def readGapIndex(fi):
+	#GapIndex of a FASTA or 2bit file. A FASTA is scanned once, after that its runs come from the report cache
+	try:
+		with open(fi, 'rb') as infile:
+			head=infile.read(4)
+		if head in TWO_BIT_SIGS:
+			return GapIndex(*twoBitGaps(fi))
+		if not head:
+			logging.critical("Empty sequence file %s" % fi)
+			sys.exit(1)
+		key=None
+		if REPORT_CACHE:
+			key=REPORT_CACHE.key("gaps", fi)
+			arrays=REPORT_CACHE.load(key)
+			if arrays is not None:
+				logging.info("Using cached N runs for %s" % fi)
+				return GapIndex(arrays['names'].tolist(), arrays['lengths'], arrays['rows'], arrays['starts'], arrays['ends'])
+		(names, lengths, rows, starts, ends)=fastaGaps(fi)
+	except IOError:
+		logging.critical("Can't open %s" % fi)
+		sys.exit(1)
+	if key:
+		REPORT_CACHE.save(key, {'names': np.array(names, dtype='S'), 'lengths': np.array(lengths, dtype=np.int64), 'rows': rows, 'starts': starts, 'ends': ends})
+	return GapIndex(names, lengths, rows, starts, ends)
+
+def loadGaps(assm, assm_dict):
+	#input_files:<side>:sequence: N runs of the assembly's sequence file, matched to the rows of its sequence report
+	with METRICS.stage("gaps", assm['name']) as stage:
+		gaps=readGapIndex(assm['sequence'])
+		matched=assm_dict.setGaps(gaps, seqAliases(assm['seq_rpt']))
+		stage.count('sequences', len(matched))
+		stage.count('gap_runs', gaps.starts.size)
+		stage.count('bytes_read', os.path.getsize(assm['sequence']))
+	logging.info("Read %s: %d sequences, %d runs of N, %d of %d report sequences matched" % (assm['sequence'], len(gaps.names), gaps.starts.size, len(matched), len(assm_dict)))
+	if len(matched) < len(assm_dict):
+		logging.warning("%d %s sequences are not in %s, their intervals have no N count" % (len(assm_dict)-len(matched), assm['name'], assm['sequence']))
+	(rows, gap_rows)=(np.array(matched.keys(), dtype=np.int64), np.array(matched.values(), dtype=np.int64))
+	wrong=np.flatnonzero(assm_dict.table['length'][rows] != gaps.lengths[gap_rows])
+	if wrong.size:
+		logging.warning("%d %s sequences differ in length from %s (e.g. %s), is it the right assembly?" % (wrong.size, assm['name'], assm['sequence'], ", ".join([assm_dict.names[row] for row in rows[wrong[:5]].tolist()])))
+
+def densityWindows(lengths, window, step):
+	#(row, start, end) of every window: one each step bases from 0 to the end of the sequence, clipped to its length
+	lengths=np.asarray(lengths, dtype=np.int64)
+	counts=(lengths+step-1)//step
+	rows=np.repeat(np.arange(lengths.size), counts)
+	starts=(np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts, counts))*step
+	return rows, starts, np.minimum(starts+window, lengths[rows])
+
+def coveredBefore(intervals, rows, pos):
+	#bases of each row's merged intervals ((offsets, start, end) as Assembly keeps them) that lie before pos:
+	#a running sum of interval lengths, read at the last interval ending by pos, plus the part of the one pos falls in
+	(offsets, start, end)=intervals
+	fold=np.repeat(np.arange(offsets.size-1, dtype=np.int64), np.diff(offsets))*IntervalIndex.SHIFT
+	cum=np.append(0, np.cumsum(end-start))
+	k=np.searchsorted(fold+end, rows*IntervalIndex.SHIFT+pos, 'right')
+	partial=np.zeros(k.size, dtype=np.int64)
+	inside=np.flatnonzero(k < offsets[rows+1])
+	partial[inside]=np.maximum(pos[inside]-start[k[inside]], 0)
+	return cum[k]-cum[offsets[rows]]+partial
+
+def windowCoverage(assm_dict, window, step):
+	#(rows, starts, ends, {bed data type: covered bases per window}) over every sequence of the assembly
+	(rows, starts, ends)=densityWindows(assm_dict.table['length'], window, step)
+	covered={}
+	for (key, data_type, merged_key) in BED_OUTPUTS:
+		intervals=assm_dict.intervals[merged_key]
+		covered[data_type]=coveredBefore(intervals, rows, ends)-coveredBefore(intervals, rows, starts)
+	return rows, starts, ends, covered
+
+def writeDensity(out_prefix, assm_dict, window, step):
+	#<out_prefix>_<data type>.bedGraph (fraction of each window covered, empty windows left out) for each bed data type,
+	#plus <out_prefix>.npz with the covered bases of every window; returns the files written.
+	#bedGraph rows must not overlap, so with sliding windows (step < window) each row spans the first step bases of its window
+	(rows, starts, ends, covered)=windowCoverage(assm_dict, window, step)
+	row_ends=np.minimum(starts+step, ends)
+	out_files=[]
+	#bedGraphs follow the beds' sequence order
+	rank=np.empty(len(assm_dict), dtype=np.int64)
+	rank[assm_dict.rows(sort_list(assm_dict.keys()))]=np.arange(len(assm_dict))
+	order=np.argsort(rank[rows], kind='mergesort')
+	for (key, data_type, merged_key) in BED_OUTPUTS:
+		out_file="%s_%s.bedGraph" % (out_prefix, data_type)
+		keep=order[covered[data_type][order] > 0]
+		frac=covered[data_type][keep]/(ends[keep]-starts[keep])
+		with open(out_file, 'w', 1<<20) as fh:
+			fh.write("track type=bedGraph name=%s\n" % bedTrackName(out_file))
+			names=assm_dict.names
+			fh.write("".join(["%s\t%d\t%d\t%.4g\n" % (names[r], s, e, f) for (r, s, e, f) in zip(rows[keep].tolist(), starts[keep].tolist(), row_ends[keep].tolist(), frac.tolist())]))
+		out_files.append(out_file)
+	#covered bases fit the smallest type that holds a whole window
+	dtype=np.uint16 if window < 1<<16 else np.uint32
+	arrays=dict((data_type, counts.astype(dtype)) for (data_type, counts) in covered.iteritems())
+	arrays.update({'names': np.array(assm_dict.names, dtype='S'), 'lengths': assm_dict.table['length'], 'window': np.array([window]), 'step': np.array([step])})
+	with open(out_prefix+".npz", 'wb') as fh:
+		np.savez_compressed(fh, **arrays)
+	out_files.append(out_prefix+".npz")
+	return out_files
+
+def loadDensity(in_file):
+	#the .npz of writeDensity back as (names, rows, starts, ends, {bed data type: covered bases per window})
+	arrays=np.load(in_file)
+	(rows, starts, ends)=densityWindows(arrays['lengths'], int(arrays['window'][0]), int(arrays['step'][0]))
+	return arrays['names'].tolist(), rows, starts, ends, dict((data_type, arrays[data_type].astype(np.int64)) for (key, data_type, merged_key) in BED_OUTPUTS)
+
+def parseRegion(region):
+	#samtools style seq:start-end (1-based, inclusive; seq:pos or a bare seq also work) -> 0-based half-open (seq, start, end)
+	#a span that isn't digits, commas and a dash, or ends before it starts, is a bad region rather than a sequence name
+	(seq, sep, span)=region.rpartition(":")
+	if not sep or not span:
+		return region, 0, IntervalIndex.SHIFT-1
+	(start, dash, end)=span.replace(",", "").partition("-")
+	if not start.isdigit() or (dash and not end.isdigit()):
+		raise ValueError("Bad region: %s, seq:start-end (1-based, inclusive)" % region)
+	(start, end)=(int(start)-1, int(end) if dash else int(start))
+	if start < 0 or end < start:
+		raise ValueError("Bad region: %s, seq:start-end (1-based, inclusive)" % region)
+	return seq, start, end
+
+def readRegions(fi):
+	#(name, seq, start, end) of each line of a bed file (plain or compressed); name is the 4th column or seq:start-end
+	regions=[]
+	for line in readLines(fi):
+		if not line or line[0] == "#" or line.startswith("track") or line.startswith("browser"):
+			continue
+		fields=line.rstrip("\r").split("\t")
+		(seq, start, end)=(fields[0], int(fields[1]), int(fields[2]))
+		regions.append((fields[3] if len(fields) > 3 else "%s:%d-%d" % (seq, start+1, end), seq, start, end))
+	return regions
+
+def queryHits(index, regions, assm=None):
+	#(region number, merged key, start, end) of every interval overlapping the (name, seq, start, end) regions, by region, type and start
+	hits=index.queryRegions([region[1] for region in regions], [region[2] for region in regions], [region[3] for region in regions], assm)
+	rows=[]
+	for key in MERGED_KEYS:
+		(region, start, end)=hits[key]
+		rows.extend(zip(region.tolist(), [key]*len(region), start.tolist(), end.tolist()))
+	rows.sort(key=lambda row: (row[0], MERGED_KEYS.index(row[1]), row[2]))
+	return rows
+
+def writeQueryHits(fh, index, regions, assm=None):
+	#one line per overlapping interval: region, data type and the merged interval (0-based, like the beds)
+	rows=queryHits(index, regions, assm)
+	fh.write("#Region\tType\tSequence\tStart\tEnd\n")
+	fh.write("".join(["%s\t%s\t%s\t%d\t%d\n" % (regions[n][0], key, regions[n][1], s, e) for (n, key, s, e) in rows]))
 
 def writeStats(fh, assm1, assm2, assm_dict):
 	##stats header
@@ -323,28 +1467,66 @@ def writeStats(fh, assm1, assm2, assm_dict):
 	fh.write("##Overall stats\n")
 	fh.write("#Sequence\tNoHit\tUnGap_NoHit\tCollapse(SP)\tExpansion(SP Only)\tInversion\tMix\n")
 	##by chromosome
-	nohit_tot=0
-	ungap_nohit_tot=0
-	coll_tot=0
-	exp_tot=0
-	inv_tot=0
-	mix_tot=0
 	seq_list=assm_dict.keys()
 	#sort list alphanumerically, it looks like the complex sort barfs on non-GRC assemblies- trying work around.
 	sort_seq_list=sort_list(seq_list)
-	for seq in sort_seq_list:
-		obj=assm_dict[seq]
-		nohit_tot += obj.nohit_len
-		ungap_nohit_tot += obj.ungap_nohit_len
-		coll_tot += obj.sp_len
-		exp_tot += obj.sp_only_len
-		inv_tot += obj.inv_len
-		mix_tot += obj.mix_len
-		fh.write("%s\t%d\t%d\t%d\t%d\t%d\t%d\n" % (seq, obj.nohit_len, obj.ungap_nohit_len, obj.sp_len, obj.sp_only_len, obj.inv_len, obj.mix_len))
-	fh.write("total\t%d\t%d\t%d\t%d\t%d\t%d\n" % (nohit_tot, ungap_nohit_tot, coll_tot, exp_tot, inv_tot, mix_tot))
+	if isinstance(assm_dict, Assembly):
+		rows=assm_dict.rows(sort_seq_list)
+		seq_lens=zip(*[assm_dict.table[field][rows].tolist() for field in STAT_FIELDS]) if rows.size else []
+		tot=assm_dict.totals()
+	else:
+		seq_lens=[tuple([getattr(assm_dict[seq], field) for field in STAT_FIELDS]) for seq in sort_seq_list]
+		tot=[sum(lens) for lens in zip(*seq_lens)] if seq_lens else [0]*len(STAT_FIELDS)
+	fh.write("".join(["%s\t%d\t%d\t%d\t%d\t%d\t%d\n" % ((seq,)+tuple(lens)) for (seq, lens) in zip(sort_seq_list, seq_lens)]))
+	fh.write("total\t%d\t%d\t%d\t%d\t%d\t%d\n" % tuple(tot))
 	##top ten for each category (add later)
 
+def writeGapStats(fh, assm1, assm2, assm_dict, seq_file):
+	#N bases in each data type's merged intervals, and in the whole sequence, per sequence. Ungapped is length minus N;
+	#NA for sequences the sequence file doesn't have, which the totals leave out
+	date=datetime.datetime.now().strftime("%Y-%m-%d")
+	fh.write("##%s vs %s N content of the merged intervals\n##%s\n##Sequence file: %s\n" % (assm1, assm2, date, seq_file))
+	fh.write("#Sequence\tCategory\tLength\tN\tUngapped\n")
+	(gaps, gap_rows)=assm_dict.gaps
+	num_rows=len(assm_dict)
+	found=gap_rows >= 0
+	#-1 picks the appended -1 for rows without a match
+	cats=[("sequence", assm_dict.table['length'], np.append(gaps.seq_n, -1)[gap_rows])]
+	for (key, data_type, merged_key) in BED_OUTPUTS:
+		(rows, start, end)=assm_dict.grouped(merged_key)
+		n=assm_dict.nCounts(rows, start, end)
+		length=np.bincount(rows, weights=end-start, minlength=num_rows).astype(np.int64)
+		cats.append((data_type, length, np.where(found, np.bincount(rows, weights=n, minlength=num_rows).astype(np.int64), -1)))
+	lines=[]
+	for row in assm_dict.rows(sort_list(assm_dict.keys())).tolist():
+		for (cat, length, n) in cats:
+			if found[row]:
+				lines.append("%s\t%s\t%d\t%d\t%d\n" % (assm_dict.names[row], cat, length[row], n[row], length[row]-n[row]))
+			else:
+				lines.append("%s\t%s\t%d\tNA\tNA\n" % (assm_dict.names[row], cat, length[row]))
+	fh.write("".join(lines))
+	for (cat, length, n) in cats:
+		(tot_len, tot_n)=(int(length[found].sum()), int(n[found].sum()))
+		fh.write("total\t%s\t%d\t%d\t%d\n" % (cat, tot_len, tot_n, tot_len-tot_n))
+
+def plotImports():
+	#matplotlib and seaborn take seconds to import, so only runs that draw pay for them.
+	#Agg unless MPLBACKEND says otherwise: no display is needed and nothing interactive is started
+	start=time.time()
+	os.environ.setdefault("MPLBACKEND", "Agg")
+	import matplotlib.pyplot as plt
+	import seaborn as sns
+	logging.debug("Plotting imports: %.3fs" % (time.time()-start))
+	return plt, sns
+
 def makeBarGraph(assm1_chrom_list, assm1_dict, assm1_name, assm2_chrom_list, assm2_dict, assm2_name, out_fi, data_type):
+	data=barGraphData(assm1_chrom_list, assm1_dict, assm1_name, assm2_chrom_list, assm2_dict, assm2_name, data_type)
+	if data:
+		drawBarGraph(assm1_chrom_list, data[0], data[1], assm1_name, assm2_name, data[2], out_fi)
+
+def barGraphData(assm1_chrom_list, assm1_dict, assm1_name, assm2_chrom_list, assm2_dict, assm2_name, data_type):
+	#(assm1 lengths, assm2 lengths, title) of each chromosome for a graph, None if it can't be drawn.
+	#plain lists, so a figure process gets what it draws without the assemblies
 	#check that chrom lists are the same- they should be but better to check
 	err=0
 	if [item for item in assm1_chrom_list if item in assm2_chrom_list]:
@@ -354,7 +1536,7 @@ def makeBarGraph(assm1_chrom_list, assm1_dict, assm1_name, assm2_chrom_list, ass
 		err += 1
 	if err>0:
 		logging.error("Chromosome lists not the same, not making graphic")
-		return
+		return None
 	#set up lists for graphing
 	assm1_list=[]
 	assm2_list=[]
@@ -378,33 +1560,1502 @@ def makeBarGraph(assm1_chrom_list, assm1_dict, assm1_name, assm2_chrom_list, ass
 			title="Ungapped NoHit sequence: %s and %s" % (assm1_name, assm2_name)
 		else:
 			logging.error("Unknown data type, not making image: %s" % data_type)
-			return
-	#set up plot
-	sns.set_style("ticks")
-	sns.set_context("talk")
-	plt.figure(figsize=(20,10), dpi=100)
-	ax = plt.gca()
-	ax.get_xaxis().get_major_formatter().set_scientific(False)
-	X = np.arange(len(assm1_chrom_list))
-	width=0.5
-	y1_label=assm1_name
-	y2_label=assm2_name
-	plt.bar(X, assm1_list, width=0.5, facecolor='seagreen', edgecolor='none', label=y1_label)
-	plt.bar(X+0.5, assm2_list, width=0.5, facecolor="blue", edgecolor='none', label=y2_label)
-	plt.xticks(np.arange(len(assm1_list))+0.5, assm1_chrom_list, ha='center', size='22')
-	plt.yticks(size="22")
-	plt.xlabel('sequences', size='36')
-	plt.ylabel('number of bases', size='36')
-	plt.title(title, size='36')
-	plt.legend(loc='upper left', prop={'size':24})
-	sns.despine(top=True, right=True)
-	plt.savefig(out_fi, dpi=100)
+			return None
+	return assm1_list, assm2_list, title
+
+def drawBarGraph(chrom_list, assm1_list, assm2_list, assm1_name, assm2_name, title, out_fi, formats=(), preview_dpi=None):
+	renderGraphs([(out_fi, 'pair', (chrom_list, assm1_list, assm2_list, assm1_name, assm2_name, title))], formats, preview_dpi)
+
+class OutputsFailed(Exception):
+	#some of the outputs of one task failed (already logged), the others were written
+	def __init__(self, outputs):
+		Exception.__init__(self, "failed: %s" % ", ".join(outputs))
+		self.outputs=outputs
+
+def imageOutFiles(out_fi, formats=(), preview_dpi=None):
+	#the files BarGraphRenderer.save writes for an image: out_fi, the same name in each extra format and the preview
+	base=os.path.splitext(out_fi)[0]
+	out_files=[out_fi]+["%s.%s" % (base, fmt) for fmt in formats if not out_fi.endswith("."+fmt)]
+	if preview_dpi:
+		out_files.append(base+".preview.png")
+	return out_files
+
+def imageOptions(params):
+	#(extra formats, preview dpi) from params:img_formats and params:img_preview_dpi
+	formats=params.get('img_formats') or []
+	if isinstance(formats, basestring):
+		formats=[fmt.strip() for fmt in formats.split(",") if fmt.strip()]
+	return [fmt.lstrip(".") for fmt in formats], params.get('img_preview_dpi') or None
+
+class BarGraphRenderer(object):
+	#draws bar graphs one after another on a single reused figure (style set up once), closed by close().
+	#save() also writes each extra format (e.g. svg or pdf) and, with preview_dpi, a low resolution <name>.preview.png
+	def __init__(self, formats=(), preview_dpi=None):
+		(self.plt, self.sns)=plotImports()
+		self.sns.set_style("ticks")
+		self.sns.set_context("talk")
+		self.formats=formats
+		self.preview_dpi=preview_dpi
+		self.fig=None
+
+	def figure(self, figsize=(20,10)):
+		#the reused figure, cleared and made current
+		if self.fig is None:
+			self.fig=self.plt.figure(figsize=figsize, dpi=100)
+		else:
+			self.plt.figure(self.fig.number)
+			self.fig.clf()
+			if tuple(self.fig.get_size_inches()) != figsize:
+				self.fig.set_size_inches(figsize)
+		return self.fig
+
+	def pairBars(self, chrom_list, assm1_list, assm2_list, assm1_name, assm2_name, title):
+		#makeBarGraph's chart on the current axes
+		(plt, sns)=(self.plt, self.sns)
+		ax = plt.gca()
+		ax.get_xaxis().get_major_formatter().set_scientific(False)
+		X = np.arange(len(chrom_list))
+		plt.bar(X, assm1_list, width=0.5, facecolor='seagreen', edgecolor='none', label=assm1_name)
+		plt.bar(X+0.5, assm2_list, width=0.5, facecolor="blue", edgecolor='none', label=assm2_name)
+		plt.xticks(np.arange(len(assm1_list))+0.5, chrom_list, ha='center', size='22')
+		plt.yticks(size="22")
+		plt.xlabel('sequences', size='36')
+		plt.ylabel('number of bases', size='36')
+		plt.title(title, size='36')
+		plt.legend(loc='upper left', prop={'size':24})
+		sns.despine(top=True, right=True)
+
+	def pair(self, chrom_list, assm1_list, assm2_list, assm1_name, assm2_name, title):
+		self.figure()
+		self.pairBars(chrom_list, assm1_list, assm2_list, assm1_name, assm2_name, title)
+
+	def panel(self, chrom_list, assm1_name, assm2_name, graphs):
+		#all of a pair's charts in one figure, two per row, each panel the size of a single chart
+		rows=(len(graphs)+1)//2
+		self.figure((40, 10*rows))
+		for (n, (assm1_list, assm2_list, title)) in enumerate(graphs):
+			self.plt.subplot(rows, 2, n+1)
+			self.pairBars(chrom_list, assm1_list, assm2_list, assm1_name, assm2_name, title)
+		#room for the 36pt labels and titles between the panels
+		self.fig.subplots_adjust(left=0.06, right=0.98, bottom=0.1/rows, top=1-0.08/rows, wspace=0.15, hspace=0.35)
+
+	def grouped(self, chrom_list, ref_name, query_names, values, title):
+		#makeBarGraph for N queries: one bar per query in each reference chromosome's group; values is chromosomes x queries
+		(plt, sns)=(self.plt, self.sns)
+		self.figure()
+		ax = plt.gca()
+		ax.get_xaxis().get_major_formatter().set_scientific(False)
+		X = np.arange(len(chrom_list))
+		width=0.8/max(len(query_names), 1)
+		colors=sns.color_palette("deep", len(query_names))
+		for (n, query) in enumerate(query_names):
+			plt.bar(X+n*width, values[:, n], width=width, align='edge', color=colors[n], edgecolor='none', label=query)
+		plt.xticks(X+0.4, chrom_list, ha='center', size='22')
+		plt.yticks(size="22")
+		plt.xlabel('%s sequences' % ref_name, size='36')
+		plt.ylabel('number of bases', size='36')
+		plt.title("%s: %s vs %s" % (title, ref_name, ", ".join(query_names)), size='36')
+		plt.legend(loc='upper left', prop={'size':24})
+		sns.despine(top=True, right=True)
+
+	def save(self, out_fi):
+		out_files=imageOutFiles(out_fi, self.formats, self.preview_dpi)
+		for fi in out_files:
+			#vector formats come from the file name, the preview is the only one at another resolution
+			self.fig.savefig(fi, dpi=self.preview_dpi if fi.endswith(".preview.png") else 100)
+		return out_files
+
+	def close(self):
+		if self.fig is not None:
+			self.plt.close(self.fig)
+			self.fig=None
+
+def renderGraphs(graphs, formats=(), preview_dpi=None):
+	#[(out_fi, BarGraphRenderer method, args)] drawn in turn on one figure. Every graph is tried; the ones that failed
+	#are logged and raised together as OutputsFailed
+	failed=[]
+	renderer=BarGraphRenderer(formats, preview_dpi)
+	try:
+		for (out_fi, draw, args) in graphs:
+			try:
+				getattr(renderer, draw)(*args)
+				renderer.save(out_fi)
+			except Exception as e:
+				logging.exception("Failed to draw %s: %s" % (out_fi, e))
+				failed.append(out_fi)
+	finally:
+		renderer.close()
+	if failed:
+		raise OutputsFailed(failed)
+
+def peakRssMb():
+	#high-water mark of this process so far; ru_maxrss is kB on Linux, bytes on macOS
+	peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak/(1024*1024) if sys.platform == "darwin" else peak/1024
+
+#(clock_gettime, timespec type, byref, clock id) once looked up, False where there is no per-thread cpu clock
+THREAD_CLOCK=None
+
+def threadCpuSecs():
+	#cpu seconds used by the calling thread (CLOCK_THREAD_CPUTIME_ID, through libc as python 2 has no clock_gettime), or None.
+	#stages run in the output threads alongside parsing, so process-wide cpu time would charge each the others' work
+	global THREAD_CLOCK
+	if THREAD_CLOCK is None:
+		THREAD_CLOCK=False
+		try:
+			import ctypes
+			import ctypes.util
+			class Timespec(ctypes.Structure):
+				_fields_=[('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+			libc=ctypes.CDLL(ctypes.util.find_library("c"))
+			THREAD_CLOCK=(libc.clock_gettime, Timespec, ctypes.byref, 16 if sys.platform == "darwin" else 3)
+		except (ImportError, OSError, AttributeError):
+			pass
+	if not THREAD_CLOCK:
+		return None
+	(clock_gettime, Timespec, byref, clock_id)=THREAD_CLOCK
+	ts=Timespec()
+	if clock_gettime(clock_id, byref(ts)) != 0:
+		return None
+	return ts.tv_sec+ts.tv_nsec/1e9
+
+class Stage(object):
+	#one timed pipeline stage (a with block); counts can be added while it runs
+	def __init__(self, metrics, name, assm_name):
+		self.metrics=metrics
+		self.rec={'stage': name, 'assembly': assm_name, 'pair': metrics.pair}
+
+	def __enter__(self):
+		#cpu of this thread where there is a clock for it, else of the whole process (recorded as process_cpu_s)
+		self.thread_cpu_start=threadCpuSecs()
+		self.cpu_start=sum(os.times()[:2])
+		self.peak_start=peakRssMb()
+		self.start=time.time()
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		self.rec['wall_s']=round(time.time()-self.start, 4)
+		thread_cpu=threadCpuSecs() if self.thread_cpu_start is not None else None
+		if thread_cpu is not None:
+			self.rec['cpu_s']=round(thread_cpu-self.thread_cpu_start, 4)
+		else:
+			self.rec['process_cpu_s']=round(sum(os.times()[:2])-self.cpu_start, 4)
+		#the peak is process-wide: how much the stage raised it, and where it stands
+		peak=peakRssMb()
+		self.rec['peak_rss_growth_mb']=round(max(0, peak-self.peak_start), 1)
+		self.rec['process_peak_rss_mb']=round(peak, 1)
+		if exc_type is not None:
+			self.rec['failed']=True
+		self.metrics.records.append(self.rec)
+		return False
+
+	def count(self, key, n):
+		self.rec[key]=self.rec.get(key, 0)+int(n)
+
+	def addFiles(self, *out_files):
+		#bytes_written for the output files that exist
+		for out_file in out_files:
+			if out_file and os.path.isfile(out_file):
+				self.count('bytes_written', os.path.getsize(out_file))
+
+class NullStage(object):
+	#what Metrics.stage hands out when metrics are off: no clocks, nothing recorded
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		return False
+
+	def count(self, key, n):
+		pass
+
+	def addFiles(self, *out_files):
+		pass
+
+NULL_STAGE=NullStage()
+
+class Metrics(object):
+	#per stage and assembly wall time, cpu time, peak RSS and item counts, written out by --metrics-json
+	def __init__(self, enabled=False):
+		self.enabled=enabled
+		self.records=[]
+		#"assm1 vs assm2" of the pair being run, set by runPair
+		self.pair=None
+
+	def stage(self, name, assm_name=None):
+		if not self.enabled:
+			return NULL_STAGE
+		return Stage(self, name, assm_name)
+
+	def collect(self, start):
+		#records added since start, taken out so a pool worker can hand them back to the parent
+		records=self.records[start:]
+		del self.records[start:]
+		return records
+
+	def write(self, out_file, meta):
+		with open(out_file, 'w') as fh:
+			json.dump({'meta': meta, 'stages': self.records}, fh, indent=1, sort_keys=True)
+
+#turned on by --metrics-json
+METRICS=Metrics()
+
+#bed outputs per assembly: (config key, makeBed data type, merged key)
+BED_OUTPUTS=[('no_hit_bed', "nohit", 'nohit'), ('ungap_nohit_bed', "ungap_nohit", 'ungap_nohit'), ('collapse_bed', "collapse", 'sp'), ('expand_bed', "expand", 'sp_only'), ('inv_bed', "inv", 'inv'), ('mix_bed', "mix", 'mix')]
+
+class ReportCache(object):
+	#on-disk cache of parsed reports. Each entry is a directory of .npy files that is memory-mapped on load;
+	#the key covers the input file (size+mtime, or a content hash) and the parameters that change the parse.
+	#least recently used entries are evicted once the cache grows past max_mb.
+	VERSION=1#bump when the cached layout or the parsing changes
+
+	def __init__(self, cache_dir, max_mb=2048, key_mode="stat"):
+		self.cache_dir=cache_dir
+		self.max_bytes=int(max_mb*1024*1024)
+		self.key_mode=key_mode
+		try:
+			os.makedirs(cache_dir)
+		except OSError as e:
+			if e.errno != errno.EEXIST:
+				raise
+
+	def key(self, kind, fi, *params):
+		key_hash=hashlib.sha1("%s\t%d\t%s\t%s" % (kind, self.VERSION, os.path.abspath(fi), "\t".join([str(param) for param in params])))
+		if self.key_mode == "content":
+			with open(fi, 'rb') as infile:
+				for block in iter(lambda: infile.read(1<<20), ''):
+					key_hash.update(block)
+		else:
+			st=os.stat(fi)
+			key_hash.update("\t%d\t%r" % (st.st_size, st.st_mtime))
+		return "%s-%s" % (kind, key_hash.hexdigest())
+
+	def load(self, key):
+		entry=os.path.join(self.cache_dir, key)
+		if not os.path.isdir(entry):
+			return None
+		arrays={}
+		for fi in os.listdir(entry):
+			if fi.endswith(".npy"):
+				arrays[fi[:-4]]=np.load(os.path.join(entry, fi), mmap_mode='r')
+		#touch the entry so eviction sees it as recently used
+		os.utime(entry, None)
+		return arrays
+
+	def save(self, key, arrays):
+		#write to a temporary directory first so a half-written entry is never loaded
+		tmp_dir=tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+		for (name, arr) in arrays.iteritems():
+			np.save(os.path.join(tmp_dir, name+".npy"), np.ascontiguousarray(arr))
+		try:
+			os.rename(tmp_dir, os.path.join(self.cache_dir, key))
+		except OSError:
+			#another process got there first
+			shutil.rmtree(tmp_dir, ignore_errors=True)
+		self.evict()
+
+	def entries(self):
+		#(last used, bytes, path) for every entry
+		found=[]
+		for name in os.listdir(self.cache_dir):
+			entry=os.path.join(self.cache_dir, name)
+			if name.startswith(".") or not os.path.isdir(entry):
+				continue
+			size=sum([os.path.getsize(os.path.join(entry, fi)) for fi in os.listdir(entry)])
+			found.append((os.path.getmtime(entry), size, entry))
+		return found
+
+	def evict(self):
+		found=sorted(self.entries())
+		total=sum([size for (used, size, entry) in found])
+		while found and total > self.max_bytes:
+			(used, size, entry)=found.pop(0)
+			logging.info("Evicting cache entry %s" % entry)
+			shutil.rmtree(entry, ignore_errors=True)
+			total -= size
+
+	def clear(self):
+		for (used, size, entry) in self.entries():
+			shutil.rmtree(entry, ignore_errors=True)
+
+#set from params:cache_dir in the config, None when caching is off
+REPORT_CACHE=None
+
+def setupCache(params):
+	global REPORT_CACHE
+	cache_dir=params.get('cache_dir', False)
+	if cache_dir:
+		REPORT_CACHE=ReportCache(cache_dir, params.get('cache_max_mb', 2048), params.get('cache_key', "stat"))
+	else:
+		REPORT_CACHE=None
+	return REPORT_CACHE
+
+def readSeqRep(assm, exclude_mt):
+	#parseSeqRep through the report cache; returns (Assembly, chrom_list)
+	chrom_list=[]
+	key=None
+	if REPORT_CACHE:
+		key=REPORT_CACHE.key("seq", assm['seq_rpt'], assm['name'], assm['acc'], exclude_mt)
+		arrays=REPORT_CACHE.load(key)
+		if arrays is not None:
+			logging.info("Using cached sequence report for %s" % assm['seq_rpt'])
+			names=arrays['name'].tolist()
+			assm_dict=Assembly(assm['name'], assm['acc'], names, arrays['length'], arrays['role'], arrays['unit'])
+			chrom_list.extend([names[i] for i in arrays['chrom'].tolist()])
+			return assm_dict, chrom_list
+	assm_dict=parseSeqRep(assm['seq_rpt'], assm['name'], assm['acc'], chrom_list, exclude_mt)
+	if key:
+		REPORT_CACHE.save(key, {'name': np.array(assm_dict.names, dtype='S'),
+			'role': assm_dict.table['role'],
+			'unit': assm_dict.table['assm_unit'],
+			'length': assm_dict.table['length'],
+			'chrom': assm_dict.rows(chrom_list)})
+	return assm_dict, chrom_list
+
+#parsed sequence reports shared by the pairs of a batch, keyed by (seq_rpt, name, acc, exclude_mt)
+SEQ_RPT_CACHE={}
+
+def loadSeqRep(assm, exclude_mt):
+	#sequence objects and chromosome list for an assembly, from the batch cache when it has been filled
+	key=(assm['seq_rpt'], assm['name'], assm['acc'], exclude_mt)
+	if key not in SEQ_RPT_CACHE:
+		return readSeqRep(assm, exclude_mt)
+	(assm_dict, chrom_list)=SEQ_RPT_CACHE[key]
+	#parseAlignReport fills in the alignment data, so each pair gets its own copy
+	return assm_dict.copy(), list(chrom_list)
+
+def writeOutput(out_file, func, *args):
+	with open(out_file, 'w') as fh:
+		func(fh, *args)
+
+def writeTopLists(out_file, assm_name, other_name, assm_dict, top_n, seq_rank, by_seq=False):
+	#top_ten (or top_n_by_seq) file, straight from the assembly's interval arrays
+	if by_seq:
+		writeOutput(out_file, writeTopBySeq, assm_name, other_name, dict((key, topNBySeq(assm_dict.names, assm_dict.grouped(key), top_n, seq_rank)) for key in MERGED_KEYS), top_n)
+	else:
+		writeOutput(out_file, writeTopTenLists, assm_name, other_name, dict((key, topNIntervals(assm_dict.names, assm_dict.grouped(key), top_n, seq_rank)) for key in MERGED_KEYS), top_n)
+
+def writeIntervalIndex(out_file, assm_dicts):
+	IntervalIndex.fromAssemblies(assm_dicts).save(out_file)
+
+#export tables: sequence has one row per sequence of each assembly (sequence report metadata and the length of each
+#data type), interval one row per merged interval pointing at it by seq_id; categories are the bed data types
+EXPORT_SEQ_COLUMNS=[('seq_id', "INTEGER PRIMARY KEY"), ('assembly', "TEXT"), ('acc', "TEXT"), ('other', "TEXT"), ('seq', "TEXT"), ('role', "TEXT"), ('assm_unit', "TEXT"), ('length', "INTEGER")]+[(field, "INTEGER") for field in STAT_FIELDS]
+#start is 0-based and stop 1-based (the bed start and end), length=stop-start
+#n_count: N bases in the interval, NULL without a sequence file (input_files:<side>:sequence) or on a sequence it lacks
+EXPORT_INTERVAL_COLUMNS=[('seq_id', "INTEGER"), ('category', "TEXT"), ('start', "INTEGER"), ('stop', "INTEGER"), ('length', "INTEGER"), ('n_count', "INTEGER")]
+EXPORT_VERSION=2
+
+def exportSequences(assm_dicts):
+	#{column: list} of the sequence table, seq_id numbering the sequences of the assemblies in turn
+	cols=dict((col, []) for (col, col_type) in EXPORT_SEQ_COLUMNS)
+	for assm in assm_dicts:
+		size=len(assm)
+		base=len(cols['seq_id'])
+		other=",".join([other.name for other in assm_dicts if not other is assm])
+		cols['seq_id'].extend(range(base, base+size))
+		for (col, value) in (('assembly', assm.name), ('acc', assm.acc), ('other', other)):
+			cols[col].extend([value]*size)
+		cols['seq'].extend(assm.names)
+		cols['role'].extend(assm.table['role'].tolist())
+		cols['assm_unit'].extend(assm.table['assm_unit'].tolist())
+		for field in ['length']+STAT_FIELDS:
+			cols[field].extend(assm.table[field].tolist())
+	return cols
+
+def exportIntervals(assm_dicts):
+	#(category, seq_id, start, stop, N count) arrays for each assembly and data type, seq_ids as in exportSequences;
+	#N counts are -1 where unknown
+	base=0
+	for assm in assm_dicts:
+		for (key, data_type, merged_key) in BED_OUTPUTS:
+			(rows, start, end)=assm.grouped(merged_key)
+			n=assm.nCounts(rows, start, end)
+			yield data_type, rows+base, start, end, n if n is not None else np.full(start.size, -1, dtype=np.int64)
+		base += len(assm)
+
+def writeExportDb(out_file, assm_dicts):
+	#SQLite export: the sequence and interval tables, a meta table and an intervals view giving every interval its assembly,
+	#sequence, role and unit. Bulk inserts into a fresh file with no journal, indexes built afterwards, renamed into place
+	tmp_file=out_file+".tmp"
+	if os.path.exists(tmp_file):
+		os.remove(tmp_file)
+	con=sqlite3.connect(tmp_file)
+	try:
+		con.execute("PRAGMA journal_mode=OFF")
+		con.execute("PRAGMA synchronous=OFF")
+		con.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+		con.execute("CREATE TABLE sequence (%s)" % ", ".join(["%s %s" % col for col in EXPORT_SEQ_COLUMNS]))
+		con.execute("CREATE TABLE interval (%s)" % ", ".join(["%s %s" % col for col in EXPORT_INTERVAL_COLUMNS]))
+		con.executemany("INSERT INTO meta VALUES (?, ?)", [('version', str(EXPORT_VERSION)),
+			('assemblies', ",".join([assm.name for assm in assm_dicts])),
+			('date', datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))])
+		seq_cols=exportSequences(assm_dicts)
+		con.executemany("INSERT INTO sequence VALUES (%s)" % ", ".join(["?"]*len(EXPORT_SEQ_COLUMNS)), izip(*[seq_cols[col] for (col, col_type) in EXPORT_SEQ_COLUMNS]))
+		for (data_type, seq_id, start, end, n) in exportIntervals(assm_dicts):
+			n_count=repeat(None) if (n < 0).all() else [count if count >= 0 else None for count in n.tolist()]
+			con.executemany("INSERT INTO interval VALUES (?, ?, ?, ?, ?, ?)", izip(seq_id.tolist(), repeat(data_type), start.tolist(), end.tolist(), (end-start).tolist(), n_count))
+		#largest of a category, and position lookups per sequence
+		con.execute("CREATE INDEX interval_category_length ON interval (category, length)")
+		con.execute("CREATE INDEX interval_seq_start ON interval (seq_id, start)")
+		con.execute("CREATE INDEX sequence_assembly_seq ON sequence (assembly, seq)")
+		con.execute("CREATE VIEW intervals AS SELECT s.assembly, s.seq, s.role, s.assm_unit, i.category, i.start, i.stop, i.length, i.n_count FROM interval i JOIN sequence s ON s.seq_id = i.seq_id")
+		con.commit()
+	finally:
+		con.close()
+	os.rename(tmp_file, out_file)
+
+def exportParquetFiles(out_prefix):
+	return [out_prefix+"_sequences.parquet", out_prefix+"_intervals.parquet"]
+
+def writeExportParquet(out_prefix, assm_dicts):
+	#<out_prefix>_sequences.parquet and <out_prefix>_intervals.parquet, the same columns as the SQLite tables plus the
+	#assembly and sequence of each interval (dictionary encoded, so they cost little). Needs pyarrow
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+	seq_cols=exportSequences(assm_dicts)
+	(seq_out, int_out)=exportParquetFiles(out_prefix)
+	#python 2 str would come out as binary columns
+	arrow_types={"INTEGER": pa.int64(), "TEXT": pa.string(), "INTEGER PRIMARY KEY": pa.int64()}
+	pq.write_table(pa.Table.from_arrays([pa.array(seq_cols[col], type=arrow_types[col_type]) for (col, col_type) in EXPORT_SEQ_COLUMNS], [col for (col, col_type) in EXPORT_SEQ_COLUMNS]), seq_out+".tmp")
+	chunks=list(exportIntervals(assm_dicts))
+	seq_id=np.concatenate([chunk[1] for chunk in chunks]) if chunks else np.zeros(0, dtype=np.int64)
+	start=np.concatenate([chunk[2] for chunk in chunks]) if chunks else np.zeros(0, dtype=np.int64)
+	end=np.concatenate([chunk[3] for chunk in chunks]) if chunks else np.zeros(0, dtype=np.int64)
+	n_count=np.concatenate([chunk[4] for chunk in chunks]) if chunks else np.zeros(0, dtype=np.int64)
+	categories=[data_type for (key, data_type, merged_key) in BED_OUTPUTS]
+	category=np.concatenate([np.full(chunk[1].size, categories.index(chunk[0]), dtype=np.int32) for chunk in chunks]) if chunks else np.zeros(0, dtype=np.int32)
+	assm_of_seq=np.array([assm_dicts.index(assm) for assm in assm_dicts for seq in assm.names], dtype=np.int32)
+	table=pa.Table.from_arrays([pa.DictionaryArray.from_arrays(assm_of_seq[seq_id], pa.array([assm.name for assm in assm_dicts], type=pa.string())),
+			pa.DictionaryArray.from_arrays(seq_id.astype(np.int32), pa.array(seq_cols['seq'], type=pa.string())),
+			pa.array(seq_id),
+			pa.DictionaryArray.from_arrays(category, pa.array(categories, type=pa.string())),
+			pa.array(start),
+			pa.array(end),
+			pa.array(end-start),
+			pa.array(n_count, mask=n_count < 0)],
+		['assembly', 'seq', 'seq_id', 'category', 'start', 'stop', 'length', 'n_count'])
+	pq.write_table(table, int_out+".tmp")
+	os.rename(seq_out+".tmp", seq_out)
+	os.rename(int_out+".tmp", int_out)
+
+#pair outputs built from the intervals of both assemblies (so not with stream: yes): output key, name in the log,
+#writer, files it writes
+INTERVAL_OUTPUTS=[('interval_index', "interval index", writeIntervalIndex, lambda out: [out]),
+	('export_db', "SQLite export", writeExportDb, lambda out: [out]),
+	('export_parquet', "Parquet export", writeExportParquet, exportParquetFiles)]
+
+def runOutput(task):
+	#one output task: (metrics stage, assembly, files it writes, function, args). Returns the outputs that failed, after
+	#logging them, so one broken output doesn't stop the others: all of them (named by the first file) on an error,
+	#or the ones listed by OutputsFailed when a task of several outputs raises it
+	(stage_name, assm_name, out_files, func, args)=task
+	try:
+		with METRICS.stage(stage_name, assm_name) as stage:
+			func(*args)
+			stage.addFiles(*out_files)
+	except OutputsFailed as e:
+		return e.outputs
+	except Exception as e:
+		logging.exception("Failed to write %s: %s" % (out_files[0], e))
+		return [out_files[0]]
+	return []
+
+def renderOutputJob(task):
+	#figure process: the outputs that failed and the metrics records go back to the parent
+	start=len(METRICS.records)
+	failed=runOutput(task)
+	return failed, METRICS.collect(start)
+
+class OutputScheduler(object):
+	#the outputs written once the reports are parsed. Writers (stats, top lists, beds, density, index) run on a thread
+	#pool while figures render in their own processes, so the outputs take about as long as the slowest one.
+	#Failures are collected per output file rather than stopping the rest. workers=0 writes everything in turn as it is
+	#handed over, without threads or processes
+	def __init__(self, workers=4, figures=False):
+		self.failed=[]
+		self.pending=[]
+		self.procs=None
+		self.threads=None
+		#figure processes only pay off with a spare core each, and pool workers (e.g. the pairs of a batch) can't start
+		#processes of their own: otherwise figures are drawn in turn
+		procs=min(workers, len(GRAPH_OUTPUTS), multiprocessing.cpu_count()-1)
+		if procs > 0 and figures and not multiprocessing.current_process().daemon:
+			#started before any writer thread; each process imports matplotlib while the reports are still being parsed
+			self.procs=multiprocessing.Pool(procs, plotImports)
+		#how many batches makeGraphs splits the figures into
+		self.figure_procs=procs if self.procs else 0
+		if workers > 0:
+			self.threads=ThreadPool(workers)
+
+	def write(self, stage_name, assm_name, out_files, func, *args):
+		task=(stage_name, assm_name, out_files, func, args)
+		if self.threads:
+			self.pending.append((self.threads.apply_async(runOutput, (task,)), False))
+		else:
+			self.failed.extend(runOutput(task))
+
+	def render(self, stage_name, assm_name, out_files, func, *args):
+		#func and args are pickled to the figure process, so no lambdas
+		task=(stage_name, assm_name, out_files, func, args)
+		if self.procs:
+			self.pending.append((self.procs.apply_async(renderOutputJob, (task,)), True))
+		else:
+			#pyplot is not thread safe: without figure processes they are drawn here, one at a time
+			self.failed.extend(runOutput(task))
+
+	def finish(self):
+		#wait for every output; returns the ones that failed
+		for (res, remote) in self.pending:
+			if remote:
+				(failed, records)=res.get()
+				METRICS.records.extend(records)
+			else:
+				failed=res.get()
+			self.failed.extend(failed)
+		self.pending=[]
+		for pool in (self.procs, self.threads):
+			if pool:
+				pool.close()
+				pool.join()
+		(self.procs, self.threads)=(None, None)
+		return self.failed
+
+	def close(self):
+		#on the way out after an error: drop whatever hasn't run yet
+		for pool in (self.procs, self.threads):
+			if pool:
+				pool.terminate()
+				pool.join()
+		(self.procs, self.threads)=(None, None)
+
+def processAssembly(assm, other, params, out_cfg, jobs=1, outputs=None):
+	#everything for one assembly of the pair: sequence report, alignment report, stats, top ten and beds.
+	#The outputs are handed to the OutputScheduler, without one they are written before returning
+	##create sequence objects
+	#list to get sequence order of 'chrom' correct
+	with METRICS.stage("seq_report", assm['name']) as stage:
+		(assm_dict, chrom_list)=loadSeqRep(assm, params['exclude_mt'])
+		stage.count('sequences', len(assm_dict))
+	logging.info("Read %s, sequences: %d, chromosomes: %d" % (assm['name'], len(assm_dict), len(chrom_list)))
+	own_outputs=outputs is None
+	if own_outputs:
+		outputs=OutputScheduler(0)
+	if params.get('stream', False):
+		streamAssembly(assm, other, params, out_cfg, assm_dict, chrom_list, jobs, outputs)
+	else:
+		##parse alignment report
+		logging.info("Processing %s" % assm['name'])
+		parseAlignReport(assm['align_rpt'], assm['name'], assm_dict, jobs)
+		if assm.get('sequence', False):
+			loadGaps(assm, assm_dict)
+		writeAssemblyOutputs(assm, other, params, out_cfg, assm_dict, outputs)
+	if own_outputs and outputs.finish():
+		sys.exit(5)
+	return assm_dict, chrom_list
+
+def writeAssemblyOutputs(assm, other, params, out_cfg, assm_dict, outputs):
+	##produce stats
+	stats_out=out_cfg['stats']
+	if not stats_out == False:
+		logging.info("Writing stats file: %s" % stats_out)
+		outputs.write("stats", assm['name'], [stats_out], writeOutput, stats_out, writeStats, assm['name'], other['name'], assm_dict)
+	##make top ten file, straight from the assembly's interval arrays
+	top_n=params.get('top_n', 10)
+	top_ten_out=out_cfg['top_ten']
+	top_by_seq_out=out_cfg.get('top_n_by_seq', False)
+	seq_rank=seqRank(assm_dict.names, assm_dict)
+	if not top_ten_out == False:
+		logging.info("Writing top %d file: %s" % (top_n, top_ten_out))
+		outputs.write("top_n", assm['name'], [top_ten_out], writeTopLists, top_ten_out, assm['name'], other['name'], assm_dict, top_n, seq_rank)
+	if not top_by_seq_out == False:
+		logging.info("Writing top %d per sequence file: %s" % (top_n, top_by_seq_out))
+		outputs.write("top_n_by_seq", assm['name'], [top_by_seq_out], writeTopLists, top_by_seq_out, assm['name'], other['name'], assm_dict, top_n, seq_rank, True)
+	##produce bed files if desired, one output each
+	bed_files=[(data_type, out_cfg[key]) for (key, data_type, merged_key) in BED_OUTPUTS if not out_cfg.get(key, False) == False]
+	if params['make_bed'] == True and bed_files:
+		logging.info("Making %s beds" % assm['name'])
+		bgzip=params.get('bed_bgzip', False)
+		#one task for all of them: writeBeds walks the sequences once for every bed
+		outputs.write("beds", assm['name'], bedOutFiles([bed_out for (data_type, bed_out) in bed_files], bgzip), writeBeds, dict(bed_files), assm_dict, bgzip)
+	##windowed coverage of each data type
+	density_out=out_cfg.get('density', False)
+	if not density_out == False:
+		window=params.get('density_window', 1000)
+		step=params.get('density_step', window)
+		logging.info("Writing %s density tracks (window %d, step %d): %s_*.bedGraph" % (assm['name'], window, step, density_out))
+		outputs.write("density", assm['name'], densityOutFiles(density_out), writeDensity, density_out, assm_dict, window, step)
+	##N content of the intervals, needs the sequence file
+	gap_stats_out=out_cfg.get('gap_stats', False)
+	if not gap_stats_out == False:
+		if assm_dict.gaps is None:
+			logging.warning("Not writing %s: no input_files sequence for %s" % (gap_stats_out, assm['name']))
+		else:
+			logging.info("Writing N content file: %s" % gap_stats_out)
+			outputs.write("gap_stats", assm['name'], [gap_stats_out], writeOutput, gap_stats_out, writeGapStats, assm['name'], other['name'], assm_dict, assm['sequence'])
+
+def densityOutFiles(out_prefix):
+	#the files writeDensity writes for this prefix
+	return ["%s_%s.bedGraph" % (out_prefix, data_type) for (key, data_type, merged_key) in BED_OUTPUTS]+[out_prefix+".npz"]
+
+def bedOutFiles(out_files, bgzip=False):
+	#the files BedWriter actually writes for these bed paths
+	if not bgzip:
+		return list(out_files)
+	return [out_file+suffix for out_file in out_files for suffix in (".gz", ".gz.tbi")]
+
+def streamAssembly(assm, other, params, out_cfg, assm_dict, chrom_list, jobs, outputs):
+	#params:stream version of processAssembly: beds and top ten lists are filled while the report is read.
+	#bed rows come out in report order rather than sorted sequence order
+	logging.info("Streaming %s" % assm['name'])
+	bed_writers={}
+	if params['make_bed'] == True:
+		for (key, data_type, merged_key) in BED_OUTPUTS:
+			if not out_cfg[key] == False:
+				bed_writers[merged_key]=BedWriter(out_cfg[key], params.get('bed_bgzip', False))
+	top_n=params.get('top_n', 10)
+	top_lists=dict((key, TopN(top_n)) for key in MERGED_KEYS)
+	top_by_seq=dict((key, {}) for key in MERGED_KEYS)
+	with METRICS.stage("stream", assm['name']) as stage:
+		try:
+			streamAlignReport(assm['align_rpt'], assm['name'], assm_dict, bed_writers, top_lists, top_by_seq, stage, jobs)
+		finally:
+			for writer in bed_writers.itervalues():
+				writer.close()
+		stage.count('bytes_read', os.path.getsize(assm['align_rpt']))
+		stage.addFiles(*bedOutFiles([out_cfg[key] for (key, data_type, merged_key) in BED_OUTPUTS if merged_key in bed_writers], params.get('bed_bgzip', False)))
+	if not out_cfg.get('density', False) == False:
+		logging.warning("Not writing density tracks %s: streamed assemblies keep no intervals (set stream: no)" % out_cfg['density'])
+	if not out_cfg.get('gap_stats', False) == False:
+		logging.warning("Not writing N content file %s: streamed assemblies keep no intervals (set stream: no)" % out_cfg['gap_stats'])
+	stats_out=out_cfg['stats']
+	if not stats_out == False:
+		logging.info("Writing stats file: %s" % stats_out)
+		outputs.write("stats", assm['name'], [stats_out], writeOutput, stats_out, writeStats, assm['name'], other['name'], assm_dict)
+	top_ten_out=out_cfg['top_ten']
+	if not top_ten_out == False:
+		logging.info("Writing top %d file: %s" % (top_n, top_ten_out))
+		outputs.write("top_n", assm['name'], [top_ten_out], writeOutput, top_ten_out, writeTopTenLists, assm['name'], other['name'], dict((key, top.items()) for (key, top) in top_lists.iteritems()), top_n)
+	top_by_seq_out=out_cfg.get('top_n_by_seq', False)
+	if not top_by_seq_out == False:
+		logging.info("Writing top %d per sequence file: %s" % (top_n, top_by_seq_out))
+		outputs.write("top_n_by_seq", assm['name'], [top_by_seq_out], writeOutput, top_by_seq_out, writeTopBySeq, assm['name'], other['name'], top_by_seq, top_n)
+
+def processAssemblyJob(args):
+	#pool wrapper: a sys.exit in a pool worker would leave the parent waiting forever, so hand the exit code back instead.
+	#the worker's metrics records and the outputs that failed go back with the result
+	start=len(METRICS.records)
+	outputs=OutputScheduler(args[2].get('output_workers', 4))
+	try:
+		result=processAssembly(*(args+(outputs,)))
+		failed=outputs.finish()
+		return 0, result, METRICS.collect(start), failed
+	except SystemExit as e:
+		return e.code, None, METRICS.collect(start), []
+	finally:
+		outputs.close()
+
+#comp_img entries: (output key, makeBarGraph data type, name in the log)
+GRAPH_OUTPUTS=[('both_collapse', "collapse", "collapse"), ('both_expand', "expand", "expansion"), ('both_nohit', "no_hit", "no hit"), ('both_ungap_nohit', "ungap_nohit", "ungap no hit")]
+
+def makeGraphs(cfg_dict, assm1_chrom_list, assm1_dict, assm2_chrom_list, assm2_dict, outputs=None):
+	assm1=cfg_dict['input_files']['assm1']
+	assm2=cfg_dict['input_files']['assm2']
+	##produce graphs is desired, and only if chromosomes are available
+	if len(assm1_chrom_list)>0 and len(assm2_chrom_list) >0:
+		logging.info("Starting image production as both assemblies have chromosomes")
+		comp_img=cfg_dict['output_files']['comp_img']
+		panel_img=comp_img.get('both_panel', False)
+		(formats, preview_dpi)=imageOptions(cfg_dict['params'])
+		#the lengths are picked out here, the figure processes only get the lists
+		graphs=[]
+		panels=[]
+		for (out_key, data_type, label) in GRAPH_OUTPUTS:
+			out_img=comp_img.get(out_key, False)
+			if out_img == False and panel_img == False:
+				continue
+			data=barGraphData(assm1_chrom_list, assm1_dict, assm1['name'], assm2_chrom_list, assm2_dict, assm2['name'], data_type)
+			if not data:
+				continue
+			if not out_img == False:
+				logging.info("Making %s image" % label)
+				graphs.append((out_img, 'pair', (assm1_chrom_list, data[0], data[1], assm1['name'], assm2['name'], data[2])))
+			panels.append(data)
+		if not panel_img == False and panels:
+			logging.info("Making panel image: %s" % panel_img)
+			graphs.append((panel_img, 'panel', (assm1_chrom_list, assm1['name'], assm2['name'], panels)))
+		own_outputs=outputs is None
+		if own_outputs:
+			outputs=OutputScheduler(0)
+		#one batch, drawn on one reused figure, per figure process
+		batches=max(1, outputs.figure_procs)
+		for n in range(min(batches, len(graphs))):
+			batch=graphs[n::batches]
+			outputs.render("graphs", None, [fi for (out_img, draw, args) in batch for fi in imageOutFiles(out_img, formats, preview_dpi)], renderGraphs, batch, formats, preview_dpi)
+		if own_outputs and outputs.finish():
+			sys.exit(5)
+
+#sha1 of this script, filled in by codeVersion()
+CODE_VERSION=None
+
+def codeVersion():
+	#any change to the code makes every output out of date
+	global CODE_VERSION
+	if CODE_VERSION is None:
+		src=os.path.abspath(__file__)
+		if src.endswith((".pyc", ".pyo")):
+			src=src[:-1]
+		with open(src, 'rb') as fh:
+			CODE_VERSION=hashlib.sha1(fh.read()).hexdigest()
+	return CODE_VERSION
+
+#output_files entries of a side and the params that change them, on top of the side's inputs and names
+SIDE_ARTIFACTS=[('stats', []), ('top_ten', ['top_n', 'stream']), ('top_n_by_seq', ['top_n', 'stream']), ('density', ['density_window', 'density_step', 'stream']), ('gap_stats', ['stream'])]
+BED_ARTIFACT_PARAMS=['bed_bgzip', 'stream']
+IMAGE_ARTIFACT_PARAMS=['img_formats', 'img_preview_dpi']
+
+class BuildManifest(object):
+	#--incremental: what each output was last built from (content hashes of the inputs, the params that change it and
+	#the code version), plus the sizes and mtimes of the files it wrote. An output whose entry still matches is skipped.
+	#Each side also keeps its per-sequence lengths, so a side with nothing left to write is not parsed at all.
+	#Saved as JSON; the pairs of a batch merge their entries into the file under a lock.
+	VERSION=1
+
+	def __init__(self, manifest_file):
+		self.manifest_file=manifest_file
+		self.data=self.read()
+		self.updates={'outputs': {}, 'sides': {}, 'hashes': {}}
+
+	def empty(self):
+		return {'version': self.VERSION, 'outputs': {}, 'sides': {}, 'hashes': {}}
+
+	def read(self):
+		if not os.path.isfile(self.manifest_file):
+			return self.empty()
+		with open(self.manifest_file, 'r') as fh:
+			data=json.load(fh)
+		if data.get('version') != self.VERSION:
+			return self.empty()
+		return data
+
+	def lookup(self, section, name):
+		return self.updates[section].get(name, self.data[section].get(name))
+
+	def fileHash(self, fi):
+		#sha1 of the contents, only read again when the size or mtime changed
+		path=os.path.abspath(fi)
+		st=os.stat(path)
+		stamp=[st.st_size, st.st_mtime]
+		known=self.lookup('hashes', path)
+		if known and known[:2] == stamp:
+			return known[2]
+		file_hash=hashlib.sha1()
+		with open(path, 'rb') as infile:
+			for block in iter(lambda: infile.read(1<<20), ''):
+				file_hash.update(block)
+		self.updates['hashes'][path]=stamp+[file_hash.hexdigest()]
+		return file_hash.hexdigest()
+
+	def key(self, *parts):
+		return hashlib.sha1(json.dumps([codeVersion()]+list(parts), sort_keys=True)).hexdigest()
+
+	def fresh(self, out_path, key):
+		#built from the same inputs and settings, and the files written then are still there unchanged
+		entry=self.lookup('outputs', os.path.abspath(out_path))
+		if entry is None or entry['key'] != key:
+			return False
+		for (fi, stamp) in entry['files'].iteritems():
+			if not os.path.isfile(fi):
+				return False
+			st=os.stat(fi)
+			if [st.st_size, st.st_mtime] != stamp:
+				return False
+		return True
+
+	def record(self, out_path, key, out_files):
+		#out_files that were not written (e.g. graphs without chromosomes) are simply not expected next time
+		files={}
+		for fi in out_files:
+			if fi and os.path.isfile(fi):
+				st=os.stat(fi)
+				files[os.path.abspath(fi)]=[st.st_size, st.st_mtime]
+		self.updates['outputs'][os.path.abspath(out_path)]={'key': key, 'files': files}
+
+	def recordSide(self, side_id, key, assm_dict, chrom_list):
+		(names, stats)=seqStats(assm_dict)
+		self.updates['sides'][side_id]={'key': key,
+			'names': names,
+			'length': assm_dict.table['length'].tolist(),
+			'role': assm_dict.table['role'].tolist(),
+			'unit': assm_dict.table['assm_unit'].tolist(),
+			'chrom': chrom_list,
+			'stats': stats.tolist()}
+
+	def standIn(self, side_id, key, assm):
+		#(Assembly, chrom_list) with the lengths of the last build and no intervals; None if the side was not recorded
+		side=self.lookup('sides', side_id)
+		if side is None or side['key'] != key:
+			return None
+		names=[str(seq) for seq in side['names']]
+		assm_dict=Assembly(assm['name'], assm['acc'], names, side['length'], [str(role) for role in side['role']], [str(unit) for unit in side['unit']])
+		stats=np.array(side['stats'], dtype=np.int64).reshape(len(names), len(STAT_FIELDS))
+		for (col, field) in enumerate(STAT_FIELDS):
+			assm_dict.table[field]=stats[:, col]
+		return assm_dict, [str(seq) for seq in side['chrom']]
+
+	def save(self):
+		#merge into whatever other pairs wrote meanwhile; written to a temporary file first so readers never see half of it
+		with open(self.manifest_file+".lock", 'a') as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			data=self.read()
+			for (section, entries) in self.updates.iteritems():
+				data[section].update(entries)
+			tmp_file="%s.%d.tmp" % (self.manifest_file, os.getpid())
+			with open(tmp_file, 'w') as fh:
+				json.dump(data, fh, sort_keys=True)
+			os.rename(tmp_file, self.manifest_file)
+		self.data=data
+		self.updates={'outputs': {}, 'sides': {}, 'hashes': {}}
+
+class BuildPlan(object):
+	#which outputs of a pair are out of date: output_files is the config's output_files with the up to date entries set
+	#to False, run says which sides have to be processed, the others come from the manifest
+	def __init__(self, build, cfg_dict):
+		self.build=build
+		params=cfg_dict['params']
+		self.output_files=dict(cfg_dict['output_files'])
+		#(output path, key, files it writes) of everything that will be written
+		self.todo=[]
+		self.sides=[]
+		assm_keys=[]
+		for (side, other_side) in (('assm1', 'assm2'), ('assm2', 'assm1')):
+			assm=cfg_dict['input_files'][side]
+			other=cfg_dict['input_files'][other_side]
+			seq_hash=build.fileHash(assm['sequence']) if assm.get('sequence', False) else None
+			side_key=build.key('side', build.fileHash(assm['seq_rpt']), build.fileHash(assm['align_rpt']), assm['name'], assm['acc'], other['name'], params['exclude_mt'], seq_hash)
+			side_id="%s|%s|%s" % (assm['name'], other['name'], os.path.abspath(assm['align_rpt']))
+			out_cfg=dict(self.output_files[side])
+			#outputs missing from the config are off, as in writeAssemblyOutputs
+			artifacts=[(out_key, param_names, densityOutFiles(out_cfg.get(out_key, False)) if out_key == 'density' else [out_cfg.get(out_key, False)]) for (out_key, param_names) in SIDE_ARTIFACTS if not out_cfg.get(out_key, False) == False]
+			if params['make_bed'] == True:
+				artifacts += [(out_key, BED_ARTIFACT_PARAMS, bedOutFiles([out_cfg.get(out_key, False)], params.get('bed_bgzip', False))) for (out_key, data_type, merged_key) in BED_OUTPUTS if not out_cfg.get(out_key, False) == False]
+			stale=0
+			for (out_key, param_names, out_files) in artifacts:
+				key=build.key(out_key, side_key, [params.get(name) for name in param_names])
+				if build.fresh(out_cfg.get(out_key, False), key):
+					out_cfg[out_key]=False
+				else:
+					self.todo.append((out_cfg.get(out_key, False), key, out_files))
+					stale += 1
+			self.output_files[side]=out_cfg
+			self.sides.append((assm, side_id, side_key, stale))
+			assm_keys.append(side_key)
+		self.output_files['comp_img']=dict(self.output_files['comp_img'])
+		for (out_key, out_file) in self.output_files['comp_img'].items():
+			if out_file == False:
+				continue
+			key=build.key(out_key, assm_keys, [params.get(name) for name in IMAGE_ARTIFACT_PARAMS])
+			if build.fresh(out_file, key):
+				self.output_files['comp_img'][out_key]=False
+			else:
+				self.todo.append((out_file, key, imageOutFiles(out_file, *imageOptions(params))))
+		#the index and exports need the intervals of both sides
+		intervals_stale=False
+		for (out_key, label, writer, out_files_of) in INTERVAL_OUTPUTS:
+			pair_out=self.output_files.get(out_key, False)
+			if pair_out == False:
+				continue
+			key=build.key(out_key, assm_keys, params.get('stream'))
+			if build.fresh(pair_out, key):
+				self.output_files[out_key]=False
+			else:
+				self.todo.append((pair_out, key, out_files_of(pair_out)))
+				intervals_stale=True
+		self.stand_ins=[None, None]
+		for (i, (assm, side_id, side_key, stale)) in enumerate(self.sides):
+			if not stale and not intervals_stale:
+				self.stand_ins[i]=build.standIn(side_id, side_key, assm)
+		self.run=[stand_in is None for stand_in in self.stand_ins]
+
+	def record(self, results, failed=()):
+		#outputs that failed stay out of date
+		for (i, (assm, side_id, side_key, stale)) in enumerate(self.sides):
+			if self.run[i]:
+				self.build.recordSide(side_id, side_key, results[i][0], results[i][1])
+		for (out_path, key, out_files) in self.todo:
+			#outputs of several files (density, parquet) fail under the name of their first file
+			if not out_path in failed and not [fi for fi in out_files if fi in failed]:
+				self.build.record(out_path, key, out_files)
+		self.build.save()
+
+#set by --incremental
+INCREMENTAL=False
+
+def setupBuild(params):
+	#BuildManifest for params:build_manifest when --incremental is on, else None
+	if not INCREMENTAL:
+		return None
+	return BuildManifest(params.get('build_manifest', "assm_align_build.json"))
+
+def runPair(cfg_dict, jobs=1):
+	#one assm1/assm2 comparison as described by a config; returns the (assm_dict, chrom_list) of both sides
+	assm1=cfg_dict['input_files']['assm1']
+	assm2=cfg_dict['input_files']['assm2']
+	global BEDTOOLS_CHECK
+	BEDTOOLS_CHECK=cfg_dict['params'].get('bedtools_check', False)
+	setupCache(cfg_dict['params'])
+	METRICS.pair="%s vs %s" % (assm1['name'], assm2['name'])
+	out_files=cfg_dict['output_files']
+	plan=None
+	build=setupBuild(cfg_dict['params'])
+	if build:
+		plan=BuildPlan(build, cfg_dict)
+		out_files=plan.output_files
+		if not plan.todo:
+			logging.info("%s vs %s: all outputs up to date" % (assm1['name'], assm2['name']))
+		else:
+			logging.info("%s vs %s: %d outputs out of date" % (assm1['name'], assm2['name'], len(plan.todo)))
+	##process each assembly: the two sides are independent until the graphs
+	sides=[(assm1, assm2, cfg_dict['params'], out_files['assm1']), (assm2, assm1, cfg_dict['params'], out_files['assm2'])]
+	results=list(plan.stand_ins) if plan else [None, None]
+	to_run=[i for i in (0, 1) if results[i] is None]
+	for i in (0, 1):
+		if not i in to_run:
+			logging.info("%s is up to date, using the lengths from %s" % (sides[i][0]['name'], build.manifest_file))
+	#one process per side, the remaining workers go to merging within each side. Forked before the output threads start,
+	#so the workers don't inherit locks (logging, queues) held by threads they don't have
+	pool=multiprocessing.Pool(min(2, jobs)) if jobs > 1 and len(to_run) == 2 else None
+	##outputs are written in the background from here on, each side's as soon as it has been parsed
+	outputs=OutputScheduler(cfg_dict['params'].get('output_workers', 4), any([not out_img == False for out_img in out_files['comp_img'].values()]))
+	try:
+		if pool:
+			inner_jobs=max(1, jobs//2)
+			jobs_results=[pool.apply_async(processAssemblyJob, (side+(inner_jobs,),)) for side in sides]
+			pool.close()
+			jobs_results=[res.get() for res in jobs_results]
+			pool.join()
+			for (exit_code, side_result, records, failed) in jobs_results:
+				METRICS.records.extend(records)
+				outputs.failed.extend(failed)
+			for (exit_code, side_result, records, failed) in jobs_results:
+				if exit_code:
+					sys.exit(exit_code)
+			results=[side_result for (exit_code, side_result, records, failed) in jobs_results]
+		else:
+			for i in to_run:
+				results[i]=processAssembly(*(sides[i]+(jobs, outputs)))
+		(side1_result, side2_result)=results
+		makeGraphs(dict(cfg_dict, output_files=out_files), side1_result[1], side1_result[0], side2_result[1], side2_result[0], outputs)
+		for (out_key, label, writer, out_files_of) in INTERVAL_OUTPUTS:
+			pair_out=out_files.get(out_key, False)
+			if pair_out == False:
+				continue
+			if cfg_dict['params'].get('stream', False):
+				logging.warning("Not writing %s %s: streamed assemblies keep no intervals (set stream: no)" % (label, pair_out))
+			else:
+				logging.info("Writing %s: %s" % (label, pair_out))
+				outputs.write(out_key, None, out_files_of(pair_out), writer, pair_out, [side1_result[0], side2_result[0]])
+		failed=outputs.finish()
+	finally:
+		outputs.close()
+		if pool:
+			pool.terminate()
+	if plan:
+		plan.record(results, failed)
+	if failed:
+		logging.error("%s vs %s: %d outputs failed: %s" % (assm1['name'], assm2['name'], len(failed), ", ".join(failed)))
+		sys.exit(5)
+	return side1_result, side2_result
+
+#columns of the batch summary and the N-way query totals
+SUMMARY_HEADER="#Assembly\tVersus\tSequences\tChromosomes\tNoHit\tUnGap_NoHit\tCollapse(SP)\tExpansion(SP Only)\tInversion\tMix\tStatus\n"
+
+def summaryRow(assm, other, assm_dict, chrom_list):
+	#totals for one side of a pair, as a line of the batch summary table
+	tot=assm_dict.totals()
+	return "%s\t%s\t%d\t%d\t%d\t%d\t%d\t%d\t%d\t%d\tok\n" % tuple([assm['name'], other['name'], len(assm_dict), len(chrom_list)]+tot)
+
+def failedRows(assm1, assm2, exit_code):
+	#summary lines of a pair that failed: no totals, the exit code as its status
+	return ["%s\t%s\t%s\tfailed (exit %s)\n" % (assm['name'], other['name'], "\t".join(["NA"]*8), exit_code) for (assm, other) in ((assm1, assm2), (assm2, assm1))]
+
+def seqStats(assm_dict):
+	#(sequence names, sequences x STAT_FIELDS array): the per-sequence lengths a pool worker hands back for the N-way tables
+	return assm_dict.names, np.column_stack([assm_dict.table[field] for field in STAT_FIELDS]) if len(assm_dict) else np.zeros((0, len(STAT_FIELDS)), dtype=np.int64)
+
+def runPairJob(cfg_dict):
+	#batch worker: run one pair and hand back its summary lines (plus the exit code if the pair failed), metrics records
+	#and the per-sequence lengths of both sides
+	assm1=cfg_dict['input_files']['assm1']
+	assm2=cfg_dict['input_files']['assm2']
+	start=len(METRICS.records)
+	try:
+		(side1_result, side2_result)=runPair(cfg_dict)
+	except SystemExit as e:
+		return e.code, [], METRICS.collect(start), None
+	except Exception as e:
+		logging.exception("Pair %s vs %s failed: %s" % (assm1['name'], assm2['name'], e))
+		return 1, [], METRICS.collect(start), None
+	rows=[summaryRow(assm1, assm2, side1_result[0], side1_result[1]), summaryRow(assm2, assm1, side2_result[0], side2_result[1])]
+	return 0, rows, METRICS.collect(start), (seqStats(side1_result[0]), seqStats(side2_result[0]))
+
+def readManifest(manifest_file):
+	#batch manifest: shared params, a summary file and a list of pairs.
+	#each pair is either a path to a regular config file or the same input_files/output_files sections inline
+	manifest=yaml.load(open(manifest_file, 'r'))
+	pair_cfgs=[]
+	for pair in manifest['pairs']:
+		if isinstance(pair, basestring):
+			pair=yaml.load(open(pair, 'r'))
+		cfg_dict=dict(pair)
+		params=dict(manifest.get('params') or {})
+		params.update(pair.get('params') or {})
+		cfg_dict['params']=params
+		pair_cfgs.append(cfg_dict)
+	return manifest, pair_cfgs
+
+def runPairs(pair_cfgs, jobs=1):
+	#the pairs of a batch or multi run, spread over the workers; results come back in the given order
+	##parse every distinct sequence report once, before the pool forks so the workers share them
+	for cfg_dict in pair_cfgs:
+		for side in ('assm1', 'assm2'):
+			assm=cfg_dict['input_files'][side]
+			key=(assm['seq_rpt'], assm['name'], assm['acc'], cfg_dict['params']['exclude_mt'])
+			if key not in SEQ_RPT_CACHE:
+				setupCache(cfg_dict['params'])
+				with METRICS.stage("seq_report", assm['name']) as stage:
+					SEQ_RPT_CACHE[key]=readSeqRep(assm, cfg_dict['params']['exclude_mt'])
+					stage.count('sequences', len(SEQ_RPT_CACHE[key][0]))
+	logging.info("Batch of %d pairs, %d distinct sequence reports" % (len(pair_cfgs), len(SEQ_RPT_CACHE)))
+	if jobs > 1:
+		pool=multiprocessing.Pool(jobs)
+		results=pool.map(runPairJob, pair_cfgs, chunksize=1)
+		pool.close()
+		pool.join()
+	else:
+		results=[runPairJob(cfg_dict) for cfg_dict in pair_cfgs]
+	for (exit_code, rows, records, side_stats) in results:
+		METRICS.records.extend(records)
+	return results
+
+def writeSummary(summary_out, manifest_file, pair_cfgs, results):
+	#batch summary table; returns the number of failed pairs
+	failed=0
+	fh=open(summary_out, 'w') if summary_out else None
+	if fh:
+		date=datetime.datetime.now().strftime("%Y-%m-%d")
+		fh.write("##Batch assembly alignment summary: %s\n##%s\n" % (manifest_file, date))
+		fh.write(SUMMARY_HEADER)
+	for (cfg_dict, (exit_code, rows, records, side_stats)) in zip(pair_cfgs, results):
+		if exit_code:
+			failed += 1
+			(assm1, assm2)=(cfg_dict['input_files']['assm1'], cfg_dict['input_files']['assm2'])
+			logging.error("Pair failed (exit %s): %s vs %s" % (exit_code, assm1['name'], assm2['name']))
+			rows=failedRows(assm1, assm2, exit_code)
+		if fh:
+			fh.writelines(rows)
+	if fh:
+		fh.close()
+		logging.info("Wrote batch summary: %s" % summary_out)
+	return failed
+
+def runBatch(manifest_file, jobs=1):
+	(manifest, pair_cfgs)=readManifest(manifest_file)
+	results=runPairs(pair_cfgs, jobs)
+	failed=writeSummary(manifest.get('summary', False), manifest_file, pair_cfgs, results)
+	if failed:
+		logging.error("%d of %d pairs failed" % (failed, len(pair_cfgs)))
+		sys.exit(4)
+
+def pairOutputs(out_dir, assm1_name, assm2_name):
+	#default output_files of a pair, laid out like resources/assm_align_cfg.yml under out_dir/{stats,bed,img}
+	for sub in ("stats", "bed", "img"):
+		try:
+			os.makedirs(os.path.join(out_dir, sub))
+		except OSError as e:
+			if e.errno != errno.EEXIST:
+				raise
+	def sideOutputs(a, b):
+		pre="%s-%s" % (a, b)
+		outs={'stats': os.path.join(out_dir, "stats", pre+"_alignment_stats.txt"), 'top_ten': os.path.join(out_dir, "stats", pre+"_top_ten.txt")}
+		for (key, suffix) in (('no_hit_bed', "no_hit"), ('ungap_nohit_bed', "ungap_no_hit"), ('collapse_bed', "collapse"), ('expand_bed', "expansion"), ('inv_bed', "inv"), ('mix_bed', "mix")):
+			outs[key]=os.path.join(out_dir, "bed", "%s_%s.bed" % (pre, suffix))
+		return outs
+	pre="%s-%s" % (assm1_name, assm2_name)
+	return {'assm1': sideOutputs(assm1_name, assm2_name), 'assm2': sideOutputs(assm2_name, assm1_name),
+		'comp_img': dict((key, os.path.join(out_dir, "img", "%s_%s.png" % (pre, suffix))) for (key, suffix) in (('both_collapse', "collapse"), ('both_expand', "expand"), ('both_nohit', "no_hit"), ('both_ungap_nohit', "ungap_no_hit")))}
+
+def readMulti(multi_file):
+	#multi config: one reference against a list of queries. Each query becomes a pair config with the reference as assm1
+	#(its align_rpt being the query's ref_align_rpt) and the query as assm2
+	multi=yaml.load(open(multi_file, 'r'))
+	ref=multi['reference']
+	pair_cfgs=[]
+	for query in multi['queries']:
+		assm1=dict(ref)
+		assm1['align_rpt']=query['ref_align_rpt']
+		assm2=dict((key, query[key]) for key in ('acc', 'name', 'seq_rpt', 'align_rpt', 'sequence') if key in query)
+		output_files=query.get('output_files') or pairOutputs(multi.get('out_dir', "."), ref['name'], query['name'])
+		params=dict(multi.get('params') or {})
+		params.update(query.get('params') or {})
+		pair_cfgs.append({'input_files': {'assm1': assm1, 'assm2': assm2}, 'output_files': output_files, 'params': params})
+	return multi, pair_cfgs
+
+#N-way stats sections: (STAT_FIELDS column, heading)
+N_WAY_SECTIONS=[(0, "NoHit"), (1, "UnGap_NoHit"), (2, "Collapse(SP)"), (3, "Expansion(SP Only)"), (4, "Inversion"), (5, "Mix")]
+
+def writeNWayStats(fh, ref_name, query_names, ref_names, ref_stats, summary_rows):
+	#one table per discrepancy type: reference sequences down, queries across, each cell the reference bases of that type
+	#against that query; then the queries' own totals
+	date=datetime.datetime.now().strftime("%Y-%m-%d")
+	fh.write("##%s vs %d assemblies: %s\n##%s\n" % (ref_name, len(query_names), ", ".join(query_names), date))
+	for (col, heading) in N_WAY_SECTIONS:
+		fh.write("##%s\n#Sequence\t%s\n" % (heading, "\t".join(query_names)))
+		table=np.column_stack([stats[:, col] for stats in ref_stats]) if ref_stats else np.zeros((len(ref_names), 0), dtype=np.int64)
+		fh.write("".join(["%s\t%s\n" % (seq, "\t".join(["%d" % val for val in row])) for (seq, row) in zip(ref_names, table.tolist())]))
+		fh.write("total\t%s\n" % "\t".join(["%d" % val for val in table.sum(axis=0).tolist()]))
+	fh.write("##Query totals\n"+SUMMARY_HEADER)
+	fh.writelines(summary_rows)
+
+#grouped graphs: (output suffix, STAT_FIELDS column, title)
+N_WAY_GRAPHS=[("collapse", 2, "Collapse sequence"), ("expand", 3, "Expanded sequence"), ("no_hit", 0, "NoHit sequence"), ("ungap_nohit", 1, "Ungapped NoHit sequence")]
+
+def makeGroupedBarGraph(chrom_list, ref_name, query_names, values, title, out_fi, formats=(), preview_dpi=None):
+	renderGraphs([(out_fi, 'grouped', (chrom_list, ref_name, query_names, values, title))], formats, preview_dpi)
+
+def runMulti(multi_file, jobs=1):
+	(multi, pair_cfgs)=readMulti(multi_file)
+	ref=multi['reference']
+	if not pair_cfgs:
+		logging.warning("No queries in %s" % multi_file)
+		return
+	#parsed once here: runPairs shares it with every pair, and it gives the N-way tables their sequence and chromosome order
+	params=pair_cfgs[0]['params']
+	setupCache(params)
+	key=(ref['seq_rpt'], ref['name'], ref['acc'], params['exclude_mt'])
+	with METRICS.stage("seq_report", ref['name']) as stage:
+		SEQ_RPT_CACHE[key]=readSeqRep(ref, params['exclude_mt'])
+		stage.count('sequences', len(SEQ_RPT_CACHE[key][0]))
+	(ref_dict, ref_chroms)=SEQ_RPT_CACHE[key]
+	results=runPairs(pair_cfgs, jobs)
+	failed=writeSummary(multi.get('summary', False), multi_file, pair_cfgs, results)
+	done=[(cfg_dict, res) for (cfg_dict, res) in zip(pair_cfgs, results) if not res[0]]
+	query_names=[cfg_dict['input_files']['assm2']['name'] for (cfg_dict, res) in done]
+	ref_names=sort_list(ref_dict.keys())
+	#each pair's reference lengths, rows lined up with ref_names
+	ref_stats=[]
+	for (cfg_dict, (exit_code, rows, records, side_stats)) in done:
+		(names, stats)=side_stats[0]
+		row_of=dict((seq, i) for (i, seq) in enumerate(names))
+		ref_stats.append(stats[np.array([row_of[seq] for seq in ref_names], dtype=np.int64)])
+	stats_out=multi.get('n_way_stats', False)
+	if not stats_out == False:
+		logging.info("Writing N-way stats: %s" % stats_out)
+		with METRICS.stage("n_way_stats", ref['name']) as stage:
+			with open(stats_out, 'w') as fh:
+				writeNWayStats(fh, ref['name'], query_names, ref_names, ref_stats, [res[1][1] for (cfg_dict, res) in done])
+			stage.addFiles(stats_out)
+	img_out=multi.get('n_way_img', False)
+	img_failed=[]
+	if not img_out == False and ref_chroms and query_names:
+		rows=[ref_names.index(seq) for seq in ref_chroms]
+		(formats, preview_dpi)=imageOptions(params)
+		graphs=[]
+		for (suffix, col, title) in N_WAY_GRAPHS:
+			out_fi="%s_%s.png" % (img_out, suffix)
+			logging.info("Making N-way %s image: %s" % (suffix, out_fi))
+			graphs.append((out_fi, 'grouped', (ref_chroms, ref['name'], query_names, np.column_stack([stats[rows, col] for stats in ref_stats]), title)))
+		#all four on one figure
+		out_files=[fi for (out_fi, draw, args) in graphs for fi in imageOutFiles(out_fi, formats, preview_dpi)]
+		img_failed=runOutput(("n_way_graphs", ref['name'], out_files, renderGraphs, (graphs, formats, preview_dpi)))
+	if failed:
+		logging.error("%d of %d queries failed" % (failed, len(pair_cfgs)))
+		sys.exit(4)
+	if img_failed:
+		logging.error("N-way images failed: %s" % ", ".join(img_failed))
+		sys.exit(5)
+
+class LoadedPair(object):
+	#--serve: both assemblies of a pair parsed and merged as a run would (report cache included) but nothing written,
+	#plus the interval index over them and the sequence ranks the top lists break ties with
+	def __init__(self, pair_id, cfg_dict, jobs=1):
+		params=cfg_dict['params']
+		setupCache(params)
+		self.pair_id=pair_id
+		self.sides=[]
+		start=time.time()
+		for (side, other_side) in (('assm1', 'assm2'), ('assm2', 'assm1')):
+			assm=cfg_dict['input_files'][side]
+			(assm_dict, chrom_list)=loadSeqRep(assm, params['exclude_mt'])
+			parseAlignReport(assm['align_rpt'], assm['name'], assm_dict, jobs)
+			if assm.get('sequence', False):
+				loadGaps(assm, assm_dict)
+			self.sides.append((assm_dict, cfg_dict['input_files'][other_side]['name'], seqRank(assm_dict.names, assm_dict)))
+		self.index=IntervalIndex.fromAssemblies([assm_dict for (assm_dict, other, seq_rank) in self.sides])
+		self.top_n=params.get('top_n', 10)
+		self.load_secs=time.time()-start
+
+	def side(self, assm=None):
+		#(Assembly, other assembly name, seq_rank) by assembly name, assm1 by default
+		for side in self.sides:
+			if assm is None or side[0].name == assm:
+				return side
+		raise KeyError("No assembly %s in pair %s (%s)" % (assm, self.pair_id, ", ".join(self.index.names())))
+
+	def rows(self, assm_dict, seqs):
+		for seq in seqs:
+			if seq not in assm_dict:
+				raise KeyError("No sequence %s in %s" % (seq, assm_dict.name))
+		return assm_dict.rows(seqs)
+
+def pairId(cfg_dict, taken=()):
+	#assm1-assm2, numbered from .2 on when a batch has the same two names more than once
+	pair_id="%s-%s" % (cfg_dict['input_files']['assm1']['name'], cfg_dict['input_files']['assm2']['name'])
+	n=1
+	while (pair_id if n == 1 else "%s.%d" % (pair_id, n)) in taken:
+		n += 1
+	return pair_id if n == 1 else "%s.%d" % (pair_id, n)
+
+class PairCache(object):
+	#the pairs a service can answer for, parsed on first use and kept in memory; past max_pairs the least recently
+	#used one is dropped. Loads run one at a time under load_lock, queries on loaded pairs don't wait for them
+	def __init__(self, pair_cfgs, max_pairs=4, jobs=1):
+		self.cfgs=OrderedDict()
+		for cfg_dict in pair_cfgs:
+			self.cfgs[pairId(cfg_dict, self.cfgs)]=cfg_dict
+		self.max_pairs=max(1, max_pairs)
+		self.jobs=jobs
+		self.loaded=OrderedDict()
+		self.lock=threading.Lock()
+		self.load_lock=threading.Lock()
+
+	def resolve(self, pair_id=None):
+		#a service with a single pair doesn't need it named
+		if pair_id is None:
+			if len(self.cfgs) != 1:
+				raise ValueError("pair is required, one of: %s" % ", ".join(self.cfgs))
+			return self.cfgs.keys()[0]
+		if pair_id not in self.cfgs:
+			raise KeyError("No pair %s (%s)" % (pair_id, ", ".join(self.cfgs)))
+		return pair_id
+
+	def cached(self, pair_id):
+		with self.lock:
+			pair=self.loaded.pop(pair_id, None)
+			if pair is not None:
+				self.loaded[pair_id]=pair
+			return pair
+
+	def get(self, pair_id=None):
+		pair_id=self.resolve(pair_id)
+		pair=self.cached(pair_id)
+		if pair is not None:
+			return pair
+		with self.load_lock:
+			#another request may have loaded it while this one waited
+			pair=self.cached(pair_id)
+			if pair is not None:
+				return pair
+			logging.info("Loading pair %s" % pair_id)
+			pair=LoadedPair(pair_id, self.cfgs[pair_id], self.jobs)
+			logging.info("Loaded pair %s in %.2fs" % (pair_id, pair.load_secs))
+			with self.lock:
+				self.loaded[pair_id]=pair
+				while len(self.loaded) > self.max_pairs:
+					(old_id, old)=self.loaded.popitem(last=False)
+					logging.info("Dropped pair %s from memory (max_pairs %d)" % (old_id, self.max_pairs))
+		return pair
+
+	def pairs(self):
+		with self.lock:
+			return [{'pair': pair_id, 'assemblies': [cfg_dict['input_files'][side]['name'] for side in ('assm1', 'assm2')], 'loaded': pair_id in self.loaded} for (pair_id, cfg_dict) in self.cfgs.iteritems()]
+
+def serveStats(pair, assm=None, seqs=()):
+	#per-sequence lengths and totals of one side, like the stats file; seqs limits the sequences listed
+	(assm_dict, other, seq_rank)=pair.side(assm)
+	rows=pair.rows(assm_dict, seqs) if seqs else np.arange(len(assm_dict))
+	table=assm_dict.table[rows]
+	sequences=[dict([('seq', assm_dict.names[row]), ('length', int(rec['length'])), ('role', rec['role']), ('assm_unit', rec['assm_unit'])]+[(field, int(rec[field])) for field in STAT_FIELDS])
+		for (row, rec) in zip(rows.tolist(), table)]
+	return {'pair': pair.pair_id, 'assembly': assm_dict.name, 'other': other, 'totals': dict(zip(STAT_FIELDS, assm_dict.totals())), 'sequences': sequences}
+
+#/top categories: the names of the beds and the export db, the bed file suffixes and the merged keys
+TOP_CATEGORIES=dict(BED_KEYS, no_hit='nohit', ungap_no_hit='ungap_nohit', expansion='sp_only', **dict((key, key) for key in MERGED_KEYS))
+#largest n a /top query may ask for
+TOP_MAX_N=10000
+
+def serveTop(pair, assm=None, n=None, keys=(), seq=None):
+	#top n merged intervals of each type (all of MERGED_KEYS by default), genome-wide or on one sequence;
+	#requested categories come back under the name they were asked by
+	(assm_dict, other, seq_rank)=pair.side(assm)
+	if n is not None and not 1 <= n <= TOP_MAX_N:
+		raise ValueError("Bad n: %d, 1 to %d" % (n, TOP_MAX_N))
+	n=pair.top_n if n is None else n
+	row=pair.rows(assm_dict, [seq])[0] if seq is not None else None
+	top={}
+	for key in keys or MERGED_KEYS:
+		if key not in TOP_CATEGORIES:
+			raise ValueError("Unknown category %s, one of: %s" % (key, ", ".join(sorted(TOP_CATEGORIES))))
+		(grp, start, end)=assm_dict.grouped(TOP_CATEGORIES[key])
+		if row is not None:
+			on_seq=grp == row
+			(grp, start, end)=(grp[on_seq], start[on_seq], end[on_seq])
+		top[key]=[list(loc) for loc in topNIntervals(assm_dict.names, (grp, start, end), n, seq_rank)]
+	return {'pair': pair.pair_id, 'assembly': assm_dict.name, 'other': other, 'n': n, 'top': top}
+
+def serveRegions(pair, region_strs, assm=None):
+	#merged intervals overlapping each seq:start-end region (0-based half-open, like the beds and --query-index),
+	#with their N count when the assembly has a sequence file
+	(assm_dict, other, seq_rank)=pair.side(assm)
+	regions=[(region,)+parseRegion(region) for region in region_strs]
+	hits=[{'region': regions[n][0], 'type': key, 'seq': regions[n][1], 'start': s, 'end': e} for (n, key, s, e) in queryHits(pair.index, regions, assm_dict.name)]
+	if hits and assm_dict.gaps is not None:
+		n_counts=assm_dict.nCounts(assm_dict.rows([hit['seq'] for hit in hits]), [hit['start'] for hit in hits], [hit['end'] for hit in hits])
+		for (hit, n) in zip(hits, n_counts.tolist()):
+			hit['n']=n if n >= 0 else None
+	return {'pair': pair.pair_id, 'assembly': assm_dict.name, 'hits': hits}
+
+def queryArg(query, name, default=None, convert=None):
+	#last value of a query string parameter, converted; a bad value is the client's error
+	if name not in query:
+		return default
+	try:
+		return convert(query[name][-1]) if convert else query[name][-1]
+	except ValueError:
+		raise ValueError("Bad %s: %s" % (name, query[name][-1]))
+
+def serviceRequest(pairs, path, query):
+	#(HTTP status, JSON-able body) for a GET of path with parsed query string {name: [values]}
+	try:
+		if path == "/pairs":
+			return 200, {'pairs': pairs.pairs(), 'max_pairs': pairs.max_pairs}
+		if path not in ("/load", "/stats", "/top", "/region"):
+			return 404, {'error': "Unknown path %s, one of: /pairs, /load, /stats, /top, /region" % path}
+		pair=pairs.get(queryArg(query, 'pair'))
+		assm=queryArg(query, 'assembly')
+		if path == "/load":
+			return 200, {'pair': pair.pair_id, 'assemblies': pair.index.names(), 'load_s': round(pair.load_secs, 3)}
+		if path == "/stats":
+			return 200, serveStats(pair, assm, query.get('seq', []))
+		if path == "/top":
+			return 200, serveTop(pair, assm, queryArg(query, 'n', None, int), query.get('category', []), queryArg(query, 'seq'))
+		if not query.get('region'):
+			raise ValueError("region is required, seq:start-end (1-based, inclusive), can be repeated")
+		return 200, serveRegions(pair, query['region'], assm)
+	except KeyError as e:
+		return 404, {'error': e.args[0]}
+	except ValueError as e:
+		return 400, {'error': str(e)}
+	except (Exception, SystemExit) as e:
+		#a pair that fails to load (the parsers exit on bad reports) fails the request, not the service
+		logging.exception("%s failed: %s" % (path, e))
+		return 500, {'error': "%s failed: %s" % (path, e)}
+
+def serve(pair_cfgs, host="127.0.0.1", port=8765, socket_path=None, max_pairs=4, preload=False, jobs=1):
+	#--serve: answer /pairs, /load, /stats, /top and /region as JSON until interrupted, over HTTP on host:port or on a unix socket
+	#only the service needs the http modules, a normal run doesn't pay for importing them
+	import BaseHTTPServer
+	import SocketServer
+	import urlparse
+
+	class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+		def do_GET(self):
+			url=urlparse.urlparse(self.path)
+			(status, body)=serviceRequest(self.server.pairs, url.path, urlparse.parse_qs(url.query))
+			data=json.dumps(body)
+			self.send_response(status)
+			self.send_header("Content-Type", "application/json")
+			self.send_header("Content-Length", str(len(data)))
+			self.end_headers()
+			self.wfile.write(data)
+
+		def log_message(self, fmt, *args):
+			#the service log, not stderr; address_string() doesn't work on a unix socket
+			logging.debug("serve: %s" % (fmt % args))
+
+	class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+		daemon_threads=True
+		allow_reuse_address=True
+
+	class ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+		daemon_threads=True
+
+	pairs=PairCache(pair_cfgs, max_pairs, jobs)
+	if preload:
+		for pair_id in pairs.cfgs.keys()[:pairs.max_pairs]:
+			pairs.get(pair_id)
+	if socket_path:
+		if os.path.exists(socket_path):
+			os.remove(socket_path)
+		server=ThreadingUnixServer(socket_path, ServiceHandler)
+		where="unix socket %s" % socket_path
+	else:
+		server=ThreadingHTTPServer((host, port), ServiceHandler)
+		where="http://%s:%d" % server.server_address[:2]
+	server.pairs=pairs
+	#stopped by a service manager (SIGTERM) the same way as by ctrl-c, so the socket is removed
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	logging.info("Serving %d pairs on %s (max %d in memory)" % (len(pairs.cfgs), where, pairs.max_pairs))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		logging.info("Service stopped")
+	finally:
+		server.server_close()
+		if socket_path and os.path.exists(socket_path):
+			os.remove(socket_path)
+
+def queryIndex(index_file, region_strs, regions_file=None, assm=None, fh=sys.stdout):
+	#--query-index: no log file, just the hits on stdout
+	try:
+		regions=[(region,)+parseRegion(region) for region in region_strs]
+	except ValueError as e:
+		print >> sys.stderr, "ERROR: assm_align.py: %s" % e
+		sys.exit(1)
+	if regions_file:
+		regions.extend(readRegions(regions_file))
+	index=IntervalIndex.load(index_file)
+	try:
+		writeQueryHits(fh, index, regions, assm)
+	except KeyError as e:
+		print >> sys.stderr, "ERROR: assm_align.py: %s" % e.args[0]
+		sys.exit(1)
+
+def writeProfile(profiler, out_file, top=25):
+	#cProfile dump for pstats/snakeviz, plus the top functions by cumulative time in the log
+	import pstats
+	import StringIO
+	profiler.dump_stats(out_file)
+	buf=StringIO.StringIO()
+	pstats.Stats(profiler, stream=buf).sort_stats("cumulative").print_stats(top)
+	logging.info("Wrote profile: %s\n%s" % (out_file, buf.getvalue()))
+
 
 def main():
 	#parse parameters
 	parser = argparse.ArgumentParser(description="assm_align.py: process NCBI assm-assm alignments (also needs sequence report files)")
 	parser.add_argument("--config", dest='cfg_file', help="path to config file (default is resources/assm_align_cfg.yml)")
+	parser.add_argument("--batch", dest='manifest', help="batch manifest listing many assembly pairs (see resources/assm_align_batch.yml), replaces --config")
+	parser.add_argument("--multi", dest='multi', help="compare one reference against several query assemblies (see resources/assm_align_multi.yml), replaces --config")
+	parser.add_argument("--clear-cache", dest='clear_cache', action='store_true', help="empty the report cache (params:cache_dir of the config or batch manifest) and exit")
+	parser.add_argument("--jobs", dest='jobs', type=int, default=1, help="number of worker processes (default 1). With 2 or more the two assemblies, or the pairs of a batch, are processed in parallel")
+	parser.add_argument("--incremental", dest='incremental', action='store_true', help="only write the outputs whose inputs, params or code changed since the last --incremental run (tracked in params:build_manifest, default assm_align_build.json)")
+	parser.add_argument("--metrics-json", dest='metrics_json', help="write wall time, cpu time, peak memory and row/interval/byte counts for every stage and assembly to this file")
+	parser.add_argument("--profile", dest='profile', help="write cProfile stats to this file (and log the top functions). Only the main process is profiled, use --jobs 1 to see everything")
+	parser.add_argument("--query-index", dest='index_file', help="query mode: interval index written by a run (output_files:interval_index) to look up --region/--regions in, prints overlapping intervals and exits")
+	parser.add_argument("--region", dest='regions', action='append', default=[], help="region to query, seq:start-end (1-based, inclusive), can be repeated")
+	parser.add_argument("--regions", dest='regions_file', help="bed file of regions to query (0-based; optional 4th column names the region)")
+	parser.add_argument("--assembly", dest='assembly', help="which assembly of the index the regions are on (default the config's assm1)")
+	parser.add_argument("--serve", dest='serve', action='store_true', help="service mode: keep the pairs of --config, --batch or --multi in memory and answer stats, top-N and region queries as JSON over HTTP until interrupted")
+	parser.add_argument("--host", dest='host', default="127.0.0.1", help="address for --serve (default 127.0.0.1)")
+	parser.add_argument("--port", dest='port', type=int, default=8765, help="port for --serve (default 8765)")
+	parser.add_argument("--socket", dest='socket_path', help="serve on this unix socket instead of host:port")
+	parser.add_argument("--max-pairs", dest='max_pairs', type=int, default=4, help="pairs --serve keeps in memory, the least recently used is dropped past this (default 4)")
+	parser.add_argument("--preload", dest='preload', action='store_true', help="with --serve, load the pairs (up to --max-pairs) before answering")
 	args = parser.parse_args()
+	if args.index_file:
+		queryIndex(args.index_file, args.regions, args.regions_file, args.assembly)
+		return
 	#set up logging
 	try:
 		os.makedirs("log")
@@ -419,103 +3070,70 @@ def main():
 	logging.config.dictConfig(config_dict)
 	logger=logging.getLogger()
 	logger.info("================assm_align.py started: log file=%s================" % log_file)
-
-	##read config file and get file parameters
-	cfg_file=args.cfg_file
-	if not cfg_file:
-		cfg_file="resources/assm_align_cfg.yml"
-	cfg_dict=yaml.load(open(cfg_file, 'r'))
-	assm1=cfg_dict['input_files']['assm1']
-	assm2=cfg_dict['input_files']['assm2']
-	exclude_mt=cfg_dict['params']['exclude_mt']
-	##create sequence objects
-	#list to get sequence order of 'chrom' correct
-	assm1_chrom_list=[]
-	assm2_chrom_list=[]
-	assm1_dict=parseSeqRep(assm1['seq_rpt'], assm1['name'], assm1['acc'], assm1_chrom_list, exclude_mt)
-	logging.info("Read %s, sequences: %d, chromosomes: %d" % (assm1['name'], len(assm1_dict), len(assm1_chrom_list)))
-	assm2_dict=parseSeqRep(assm2['seq_rpt'], assm2['name'], assm2['acc'], assm2_chrom_list, exclude_mt)
-	logging.info("Read %s, sequences: %d, chromosomes: %d" % (assm2['name'], len(assm2_dict), len(assm2_chrom_list)))
-	##parse alignment report
-	logging.info("Processing %s" % assm1['name'])
-	parseAlignReport(assm1['align_rpt'], assm1['name'], assm1_dict)
-	logging.info("Procssing %s" % assm2['name'])
-	parseAlignReport(assm2['align_rpt'], assm2['name'], assm2_dict)
-	##produce stats
-	assm1_stats_out=cfg_dict['output_files']['assm1']['stats']
-	if not assm1_stats_out == False:
-		logging.info("Writing stats file: %s" % assm1_stats_out)
-		stats1_out=open(assm1_stats_out, 'w')
-		writeStats(stats1_out, assm1['name'], assm2['name'], assm1_dict)
-		stats1_out.close()
-	assm2_stats_out=cfg_dict['output_files']['assm2']['stats']
-	if not assm2_stats_out == False:
-		logging.info("Writing stats file: %s" % assm2_stats_out)
-		stats2_out=open(assm2_stats_out, 'w')
-		writeStats(stats2_out, assm2['name'], assm1['name'], assm2_dict)
-		stats2_out.close()
-	##make top ten file
-	assm1_top_ten_out=cfg_dict['output_files']['assm1']['top_ten']
-	if not assm1_top_ten_out == False:
-		logging.info("Writing top ten file: %s" % assm1_top_ten_out)
-		top_ten1_out=open(assm1_top_ten_out, 'w')
-		writeTopTen(top_ten1_out, assm1['name'], assm2['name'], assm1_dict)
-		top_ten1_out.close()
-	assm2_top_ten_out=cfg_dict['output_files']['assm2']['top_ten']
-	if not assm2_top_ten_out == False:
-		logging.info("Writing top ten file: %s" % assm2_top_ten_out)
-		top_ten2_out=open(assm2_top_ten_out, 'w')
-		writeTopTen(top_ten2_out, assm2['name'], assm1['name'], assm2_dict)
-		top_ten2_out.close()
-	##produce bed files if desired
-	##I'm sure there is a better way, but brute forcing it now
-	if cfg_dict['params']['make_bed'] == True:
-		assm1_nohit_bed=cfg_dict['output_files']['assm1']['no_hit_bed']
-		assm1_ungap_nohit_bed=cfg_dict['output_files']['assm1']['ungap_nohit_bed']
-		assm1_collapse_bed=cfg_dict['output_files']['assm1']['collapse_bed']
-		assm1_expand_bed=cfg_dict['output_files']['assm1']['expand_bed']
-		assm1_inv_bed=cfg_dict['output_files']['assm1']['inv_bed']
-		assm1_mix_bed=cfg_dict['output_files']['assm1']['mix_bed']
-		logging.info("Making assembly 1 beds")
-		makeBed(assm1_nohit_bed, assm1_dict, "nohit")
-		makeBed(assm1_ungap_nohit_bed, assm1_dict, "ungap_nohit")
-		makeBed(assm1_collapse_bed, assm1_dict, "collapse")
-		makeBed(assm1_expand_bed, assm1_dict, "expand")
-		makeBed(assm1_inv_bed, assm1_dict, "inv")
-		makeBed(assm1_mix_bed, assm1_dict, "mix")
-		assm2_nohit_bed=cfg_dict['output_files']['assm2']['no_hit_bed']
-		assm2_ungap_nohit_bed=cfg_dict['output_files']['assm2']['ungap_nohit_bed']
-		assm2_collapse_bed=cfg_dict['output_files']['assm2']['collapse_bed']
-		assm2_expand_bed=cfg_dict['output_files']['assm2']['expand_bed']
-		assm2_inv_bed=cfg_dict['output_files']['assm2']['inv_bed']
-		assm2_mix_bed=cfg_dict['output_files']['assm2']['mix_bed']
-		logging.info("Making assembly 2 beds")
-		makeBed(assm2_nohit_bed, assm2_dict, "nohit")
-		makeBed(assm2_nohit_bed, assm2_dict, "ungap_nohit")
-		makeBed(assm2_collapse_bed, assm2_dict, "collapse")
-		makeBed(assm2_expand_bed, assm2_dict, "expand")
-		makeBed(assm2_inv_bed, assm2_dict, "inv")
-		makeBed(assm2_mix_bed, assm2_dict, "mix")
-
-	##produce graphs is desired, and only if chromosomes are available
-	if len(assm1_chrom_list)>0 and len(assm2_chrom_list) >0:
-		logging.info("Starting image production as both assemblies have chromosomes")
-		collapse_img=cfg_dict['output_files']['comp_img']['both_collapse']
-		expand_img=cfg_dict['output_files']['comp_img']['both_expand']
-		nohit_img=cfg_dict['output_files']['comp_img']['both_nohit']
-		ungap_nohit_img=cfg_dict['output_files']['comp_img']['both_ungap_nohit']
-		if not collapse_img == False:
-			logging.info("Making collapse image")
-			makeBarGraph(assm1_chrom_list, assm1_dict, assm1['name'], assm2_chrom_list, assm2_dict, assm2['name'], collapse_img, "collapse")
-		if not expand_img == False:
-			logging.info("Making expansion image")
-			makeBarGraph(assm1_chrom_list, assm1_dict, assm1['name'], assm2_chrom_list, assm2_dict, assm2['name'], expand_img, "expand")
-		if not nohit_img == False:
-			logging.info("Making no hit image")
-			makeBarGraph(assm1_chrom_list, assm1_dict, assm1['name'], assm2_chrom_list, assm2_dict, assm2['name'], nohit_img, "no_hit")
-		if not ungap_nohit_img == False:
-			logging.info("Making ungap no hit image")
-			makeBarGraph(assm1_chrom_list, assm1_dict, assm1['name'], assm2_chrom_list, assm2_dict, assm2['name'], ungap_nohit_img, "ungap_nohit")
+	logger.debug("Startup: imports %.3fs, ready %.3fs" % (IMPORT_SECS, time.time()-IMPORT_START))
+	jobs=max(1, args.jobs)
+	if args.clear_cache:
+		if args.manifest or args.multi:
+			params=yaml.load(open(args.manifest or args.multi, 'r')).get('params') or {}
+		else:
+			params=yaml.load(open(args.cfg_file or "resources/assm_align_cfg.yml", 'r'))['params']
+		cache=setupCache(params)
+		if cache:
+			cache.clear()
+			logging.info("Cleared report cache: %s" % cache.cache_dir)
+		else:
+			logging.warning("No cache_dir set in params, nothing to clear")
+		return
+	if args.metrics_json:
+		METRICS.enabled=True
+	if args.incremental:
+		global INCREMENTAL
+		INCREMENTAL=True
+	if args.serve:
+		if args.manifest:
+			pair_cfgs=readManifest(args.manifest)[1]
+		elif args.multi:
+			pair_cfgs=readMulti(args.multi)[1]
+		else:
+			pair_cfgs=[yaml.load(open(args.cfg_file or "resources/assm_align_cfg.yml", 'r'))]
+		serve(pair_cfgs, args.host, args.port, args.socket_path, args.max_pairs, args.preload, jobs)
+		return
+	profiler=None
+	if args.profile:
+		import cProfile
+		profiler=cProfile.Profile()
+		profiler.enable()
+	start=time.time()
+	try:
+		if args.manifest:
+			runBatch(args.manifest, jobs)
+		elif args.multi:
+			runMulti(args.multi, jobs)
+		else:
+			##read config file and get file parameters
+			cfg_file=args.cfg_file
+			if not cfg_file:
+				cfg_file="resources/assm_align_cfg.yml"
+			cfg_dict=yaml.load(open(cfg_file, 'r'))
+			runPair(cfg_dict, jobs)
+	finally:
+		#also on failure: the stages that did run are what shows where it went wrong
+		if profiler:
+			profiler.disable()
+			writeProfile(profiler, args.profile)
+		if args.metrics_json:
+			METRICS.write(args.metrics_json, {'config': os.path.abspath(args.manifest or args.multi or args.cfg_file or "resources/assm_align_cfg.yml"),
+				'batch': bool(args.manifest),
+				'multi': bool(args.multi),
+				'jobs': jobs,
+				'date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+				'host': platform.node(),
+				'python': platform.python_version(),
+				'numpy': np.__version__,
+				'import_s': round(IMPORT_SECS, 4),
+				'total_s': round(time.time()-start, 4),
+				'peak_rss_mb': round(peakRssMb(), 1)})
+			logging.info("Wrote metrics: %s" % args.metrics_json)
 
 
 if __name__=="__main__":
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+############################################
+#
+#  Time the assm_align.py pipeline stage by stage (wall, cpu, peak memory) and write the results as JSON
+#  Inputs come from a normal config, e.g. one written by make_reports.py
+#  With --compare, exits non-zero when a stage got slower than the tolerance allows
+#
+#############################################
+from __future__ import division
+import os
+import sys
+import json
+import time
+import datetime
+import platform
+import resource
+import argparse
+import subprocess
+import logging
+import yaml
+
+BENCH_DIR=os.path.dirname(os.path.abspath(__file__))
+REPO_DIR=os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+import numpy as np
+import assm_align
+
+def resetPeakRss():
+	#Linux can reset the high-water mark (VmHWM) of a process; returns False where it can't
+	try:
+		with open("/proc/self/clear_refs", 'w') as fh:
+			fh.write("5")
+		return True
+	except (IOError, OSError):
+		return False
+
+def peakRssMb():
+	try:
+		with open("/proc/self/status", 'r') as fh:
+			for line in fh:
+				if line.startswith("VmHWM:"):
+					return int(line.split()[1])/1024
+	except IOError:
+		pass
+	#ru_maxrss: kB on Linux, bytes on macOS, and never reset
+	peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak/(1024*1024) if sys.platform == "darwin" else peak/1024
+
+class StageTimer(object):
+	#runs the stages, keeping one record per stage and assembly
+	def __init__(self):
+		self.results=[]
+		self.peak_reset=resetPeakRss()
+
+	def run(self, stage, assm_name, func, *args):
+		resetPeakRss()
+		cpu_start=sum(os.times()[:2])
+		start=time.time()
+		ret=func(*args)
+		wall=time.time()-start
+		cpu=sum(os.times()[:2])-cpu_start
+		self.results.append({'stage': stage, 'assembly': assm_name, 'wall_s': round(wall, 4), 'cpu_s': round(cpu, 4), 'peak_rss_mb': round(peakRssMb(), 1)})
+		return ret
+
+def importTime():
+	#fresh interpreter importing assm_align, best of three
+	code="import time; t=time.time(); import assm_align; print(time.time()-t)"
+	return min([float(subprocess.check_output([sys.executable, "-c", code], cwd=REPO_DIR)) for i in range(3)])
+
+def writeOut(out_file, func, *args):
+	with open(out_file, 'w') as fh:
+		func(fh, *args)
+
+def benchPair(cfg_dict, timer, graphs=True):
+	params=cfg_dict['params']
+	top_n=params.get('top_n', 10)
+	sides={}
+	for (side, other_side) in (('assm1', 'assm2'), ('assm2', 'assm1')):
+		assm=cfg_dict['input_files'][side]
+		other=cfg_dict['input_files'][other_side]
+		out_cfg=cfg_dict['output_files'][side]
+		chrom_list=[]
+		assm_dict=timer.run("parseSeqRep", assm['name'], assm_align.parseSeqRep, assm['seq_rpt'], assm['name'], assm['acc'], chrom_list, params['exclude_mt'])
+		(seq_names, cols)=timer.run("parseAlignReport", assm['name'], assm_align.readAlignReport, assm['align_rpt'], assm['name'])
+		timer.results[-1]['items']=sum([len(cols[data_type]) for data_type in assm_align.ALIGN_TYPES])
+		merged=timer.run("merge", assm['name'], assm_align.mergeAlignColumns, cols, len(seq_names))
+		timer.results[-1]['items']=sum([merged[key][0].size for key in assm_align.MERGED_KEYS])
+		del cols
+		timer.run("setAlignData", assm['name'], assm_dict.setAlignData, seq_names, merged)
+		timer.run("writeStats", assm['name'], writeOut, out_cfg['stats'], assm_align.writeStats, assm['name'], other['name'], assm_dict)
+		seq_rank=assm_align.seqRank(assm_dict.names, assm_dict)
+		top_lists=lambda: dict((key, assm_align.topNIntervals(assm_dict.names, assm_dict.grouped(key), top_n, seq_rank)) for key in assm_align.MERGED_KEYS)
+		timer.run("writeTopTen", assm['name'], lambda: writeOut(out_cfg['top_ten'], assm_align.writeTopTenLists, assm['name'], other['name'], top_lists(), top_n))
+		bed_files=dict((data_type, out_cfg[key]) for (key, data_type, merged_key) in assm_align.BED_OUTPUTS)
+		timer.run("makeBed", assm['name'], assm_align.writeBeds, bed_files, assm_dict, params.get('bed_bgzip', False))
+		timer.results[-1]['items']=sum([os.path.getsize(fi+(".gz" if params.get('bed_bgzip', False) else "")) for fi in bed_files.values()])
+		sides[side]=(assm_dict, chrom_list)
+	if graphs:
+		((assm1_dict, assm1_chrom_list), (assm2_dict, assm2_chrom_list))=(sides['assm1'], sides['assm2'])
+		timer.run("makeBarGraph", "both", assm_align.makeGraphs, cfg_dict, assm1_chrom_list, assm1_dict, assm2_chrom_list, assm2_dict)
+
+def compare(results, baseline_file, tolerance, min_secs):
+	#stages whose wall time grew past the tolerance (ignoring stages faster than min_secs)
+	baseline=json.load(open(baseline_file, 'r'))
+	base=dict(((res['stage'], res['assembly']), res) for res in baseline['stages'])
+	slower=[]
+	for res in results['stages']:
+		old=base.get((res['stage'], res['assembly']))
+		if old is None or max(old['wall_s'], res['wall_s']) < min_secs:
+			continue
+		if res['wall_s'] > old['wall_s']*(1+tolerance):
+			slower.append("%s %s: %.3fs -> %.3fs" % (res['stage'], res['assembly'], old['wall_s'], res['wall_s']))
+	return slower
+
+def main():
+	parser = argparse.ArgumentParser(description="bench_assm_align.py: per stage timings and peak memory for assm_align.py")
+	parser.add_argument("--config", dest='cfg_file', required=True, help="pipeline config (make_reports.py writes bench_cfg.yml)")
+	parser.add_argument("--out", dest='out_file', default="bench_results.json", help="results file (default bench_results.json)")
+	parser.add_argument("--no-graphs", dest='graphs', action='store_false', help="skip makeBarGraph")
+	parser.add_argument("--compare", dest='baseline', help="earlier results file to check against")
+	parser.add_argument("--tolerance", dest='tolerance', type=float, default=0.25, help="allowed slowdown per stage for --compare (default 0.25 = 25%%)")
+	parser.add_argument("--min-secs", dest='min_secs', type=float, default=0.05, help="stages faster than this are not compared (default 0.05)")
+	args = parser.parse_args()
+	#only the pipeline's warnings and errors, its info messages would drown the timings
+	logging.basicConfig(level=logging.WARNING, format='%(levelname)s: %(message)s')
+
+	cfg_dict=yaml.safe_load(open(args.cfg_file, 'r'))
+	timer=StageTimer()
+	import_secs=importTime()
+	start=time.time()
+	benchPair(cfg_dict, timer, args.graphs)
+	results={'meta': {'date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+			'config': os.path.abspath(args.cfg_file),
+			'python': platform.python_version(),
+			'numpy': np.__version__,
+			'host': platform.node(),
+			'peak_rss_per_stage': timer.peak_reset,
+			'inputs': dict((os.path.basename(cfg_dict['input_files'][side][key]), os.path.getsize(cfg_dict['input_files'][side][key])) for side in ('assm1', 'assm2') for key in ('seq_rpt', 'align_rpt'))},
+		'import_s': round(import_secs, 4),
+		'total_s': round(time.time()-start, 4),
+		'stages': timer.results}
+	with open(args.out_file, 'w') as fh:
+		json.dump(results, fh, indent=1, sort_keys=True)
+	for res in timer.results:
+		print "%-16s %-10s wall %8.3fs  cpu %8.3fs  peak %8.1f MB%s" % (res['stage'], res['assembly'], res['wall_s'], res['cpu_s'], res['peak_rss_mb'], "  items %d" % res['items'] if 'items' in res else "")
+	print "import %.3fs, total %.3fs -> %s" % (import_secs, results['total_s'], args.out_file)
+	if args.baseline:
+		slower=compare(results, args.baseline, args.tolerance, args.min_secs)
+		for line in slower:
+			print "SLOWER: %s" % line
+		if slower:
+			sys.exit(1)
+
+if __name__=="__main__":
+	main()
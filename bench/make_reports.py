@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+############################################
+#
+#  Write synthetic NCBI sequence reports and assm-assm alignment reports for benchmarking assm_align.py
+#  Also writes a config pointing at them, ready for assm_align.py --config or bench_assm_align.py
+#
+#############################################
+from __future__ import division
+import os
+import sys
+import argparse
+import numpy as np
+import yaml
+
+#alignment report data types and their default share of the rows
+DEFAULT_MIX="NoHit:0.3,SP:0.3,SP Only:0.2,Inv:0.1,Mix:0.1"
+#types whose rows may overlap (NoHit rows never do)
+OVERLAP_TYPES=["SP", "SP Only", "Inv", "Mix"]
+
+def parseMix(mix_str):
+	#"NoHit:0.3,SP:0.3,..." -> [(type, fraction)], fractions normalised to 1
+	mix=[]
+	for item in mix_str.split(","):
+		(data_type, frac)=item.rsplit(":", 1)
+		mix.append((data_type.strip(), float(frac)))
+	tot=sum([frac for (data_type, frac) in mix])
+	return [(data_type, frac/tot) for (data_type, frac) in mix]
+
+def makeSeqs(num_seqs, num_chroms, chrom_len, scaf_len, rng):
+	#(name, role, unit, length): chromosomes first (the last one non-nuclear MT when there are 3 or more), then unplaced scaffolds
+	seqs=[]
+	for i in range(num_chroms):
+		if num_chroms >= 3 and i == num_chroms-1:
+			seqs.append(("MT", 'assembled-molecule', "non-nuclear", 16569))
+		else:
+			seqs.append(("%d" % (i+1), 'assembled-molecule', "Primary Assembly", int(chrom_len*rng.uniform(0.3, 1.0))))
+	for i in range(num_seqs-num_chroms):
+		seqs.append(("scaf%d" % (i+1), 'unplaced-scaffold', "Primary Assembly", int(scaf_len*rng.uniform(0.2, 1.0))))
+	return seqs
+
+def writeSeqRep(fi, assm_name, seqs):
+	with open(fi, 'w') as out:
+		out.write("# Assembly Name:  %s\n" % assm_name)
+		out.write("# Sequence-Name\tSequence-Role\tAssigned-Molecule\tAssigned-Molecule-Location/Type\tGenBank-Accn\tRelationship\tRefSeq-Accn\tAssembly-Unit\tSequence-Length\tUCSC-style-name\n")
+		for (n, (name, role, unit, length)) in enumerate(seqs):
+			molecule=name if role == 'assembled-molecule' else "na"
+			out.write("%s\t%s\t%s\t%s\tGB%06d.1\t=\tRS%06d.1\t%s\t%d\tchr%s\n" % (name, role, molecule, "Chromosome" if role == 'assembled-molecule' else "na", n, n, unit, length, name))
+
+def typeRows(data_type, count, length, overlap, mean_len, rng):
+	#1-based start, stop, gapped and ungapped lengths for count rows of a data type on a sequence of the given length
+	if count == 0:
+		return [np.zeros(0, dtype=np.int64)]*4
+	row_len=np.minimum(np.maximum(rng.lognormal(np.log(mean_len), 1.0, count).astype(np.int64), 1), max(length//4, 1))
+	if data_type == "NoHit":
+		#non-overlapping: spread the rows over the sequence with random gaps between them
+		free=max(length-int(row_len.sum()), count)
+		gaps=np.diff(np.sort(rng.randint(0, free, count+1)))
+		start=np.cumsum(np.append(0, row_len[:-1]+gaps[:-1]))+1
+	else:
+		start=np.sort(rng.randint(1, max(length-int(row_len.max()), 2), count))
+		#with probability overlap a row starts inside the one before it
+		olap=np.flatnonzero(rng.random_sample(count) < overlap)
+		olap=olap[olap > 0]
+		start[olap]=start[olap-1]+(row_len[olap-1]*rng.random_sample(olap.size)).astype(np.int64)
+	stop=np.minimum(start+row_len-1, length)
+	start=np.minimum(start, stop)
+	gapped=stop-start+1
+	#mostly sequence, some rows mostly N
+	ungapped=(gapped*np.where(rng.random_sample(count) < 0.2, rng.random_sample(count)*0.5, 1-rng.random_sample(count)*0.1)).astype(np.int64)
+	return start, stop, gapped, ungapped
+
+def writeAlignRep(fi, assm_name, other_name, seqs, rows_per_seq, mix, overlap, mean_len, rng):
+	#one 'Sequence Name:' block per sequence, each with rows_per_seq rows split over the data types by mix
+	tot_rows=0
+	with open(fi, 'w', 1<<20) as out:
+		out.write("# Assembly-assembly alignment report (synthetic)\n# Reference: %s\n" % other_name)
+		out.write("Query Assembly Name: %s\n\n" % assm_name)
+		for (name, role, unit, length) in seqs:
+			#scaffolds get rows in proportion to their size, at least one
+			num_rows=rows_per_seq if role == 'assembled-molecule' else max(1, rows_per_seq//20)
+			out.write("Sequence Name: %s\n" % name)
+			out.write("#Type\tStart\tStop\tGapped-Length\tGap-Length\tUngapped-Length\n")
+			for (data_type, frac) in mix:
+				count=int(round(num_rows*frac))
+				(start, stop, gapped, ungapped)=typeRows(data_type, count, length, overlap if data_type in OVERLAP_TYPES else 0, mean_len, rng)
+				out.write("".join(["%s\t%d\t%d\t%d\t%d\t%d\n" % (data_type, s, e, g, g-u, u) for (s, e, g, u) in zip(start.tolist(), stop.tolist(), gapped.tolist(), ungapped.tolist())]))
+				tot_rows += count
+			out.write("\n")
+	return tot_rows
+
+def writeConfig(fi, out_dir, names, seq_rpts, align_rpts):
+	#pipeline config with every output under out_dir/out
+	res_dir=os.path.join(out_dir, "out")
+	for sub in ("stats", "bed", "img"):
+		if not os.path.isdir(os.path.join(res_dir, sub)):
+			os.makedirs(os.path.join(res_dir, sub))
+	def sideOutputs(a, b):
+		pre="%s-%s" % (a, b)
+		outs={'stats': os.path.join(res_dir, "stats", pre+"_alignment_stats.txt"), 'top_ten': os.path.join(res_dir, "stats", pre+"_top_ten.txt")}
+		for (key, suffix) in (('no_hit_bed', "no_hit"), ('ungap_nohit_bed', "ungap_no_hit"), ('collapse_bed', "collapse"), ('expand_bed', "expansion"), ('inv_bed', "inv"), ('mix_bed', "mix")):
+			outs[key]=os.path.join(res_dir, "bed", "%s_%s.bed" % (pre, suffix))
+		return outs
+	cfg={'input_files': {}, 'params': {'exclude_mt': True, 'make_bed': True}, 'output_files': {}}
+	for (n, side) in enumerate(('assm1', 'assm2')):
+		cfg['input_files'][side]={'acc': "GCF_%09d.1" % (n+1), 'name': names[n], 'seq_rpt': seq_rpts[n], 'align_rpt': align_rpts[n]}
+		cfg['output_files'][side]=sideOutputs(names[n], names[1-n])
+	cfg['output_files']['comp_img']=dict((key, os.path.join(res_dir, "img", "%s-%s_%s.png" % (names[0], names[1], suffix))) for (key, suffix) in (('both_collapse', "collapse"), ('both_expand', "expand"), ('both_nohit', "no_hit"), ('both_ungap_nohit', "ungap_no_hit")))
+	with open(fi, 'w') as out:
+		yaml.safe_dump(cfg, out, default_flow_style=False)
+
+def main():
+	parser = argparse.ArgumentParser(description="make_reports.py: write synthetic sequence and alignment reports (plus a config) for benchmarking")
+	parser.add_argument("--out-dir", dest='out_dir', required=True, help="directory for the reports and bench_cfg.yml")
+	parser.add_argument("--seqs", dest='seqs', type=int, default=100, help="sequences per assembly (default 100)")
+	parser.add_argument("--chroms", dest='chroms', type=int, default=24, help="how many of the sequences are chromosomes (default 24, the last is MT)")
+	parser.add_argument("--rows-per-seq", dest='rows', type=int, default=1000, help="alignment rows per chromosome, scaffolds get 1/20th (default 1000)")
+	parser.add_argument("--overlap", dest='overlap', type=float, default=0.3, help="chance an SP/SP Only/Inv/Mix row overlaps the previous one (default 0.3)")
+	parser.add_argument("--mix", dest='mix', default=DEFAULT_MIX, help="share of rows per data type (default %s)" % DEFAULT_MIX)
+	parser.add_argument("--chrom-len", dest='chrom_len', type=int, default=100000000, help="longest chromosome (default 100Mb)")
+	parser.add_argument("--scaf-len", dest='scaf_len', type=int, default=200000, help="longest scaffold (default 200kb)")
+	parser.add_argument("--mean-len", dest='mean_len', type=int, default=2000, help="typical row length (default 2000)")
+	parser.add_argument("--seed", dest='seed', type=int, default=1, help="random seed (default 1)")
+	args = parser.parse_args()
+
+	rng=np.random.RandomState(args.seed)
+	mix=parseMix(args.mix)
+	if not os.path.isdir(args.out_dir):
+		os.makedirs(args.out_dir)
+	out_dir=os.path.abspath(args.out_dir)
+	names=["SynthA", "SynthB"]
+	chroms=min(args.chroms, args.seqs)
+	seqs=makeSeqs(args.seqs, chroms, args.chrom_len, args.scaf_len, rng)
+	seq_rpts=[]
+	align_rpts=[]
+	for (n, name) in enumerate(names):
+		other=names[1-n]
+		#same sequence names on both sides, lengths differ a little
+		side_seqs=[(seq, role, unit, int(length*rng.uniform(0.98, 1.02)) if seq != "MT" else length) for (seq, role, unit, length) in seqs]
+		seq_rpt=os.path.join(out_dir, "%s.assembly.txt" % name)
+		align_rpt=os.path.join(out_dir, "%s-%s.report.txt" % (name, other))
+		writeSeqRep(seq_rpt, name, side_seqs)
+		rows=writeAlignRep(align_rpt, name, other, side_seqs, args.rows, mix, args.overlap, args.mean_len, rng)
+		print "%s: %d sequences, %d alignment rows, %.1f MB" % (align_rpt, len(side_seqs), rows, os.path.getsize(align_rpt)/1e6)
+		seq_rpts.append(seq_rpt)
+		align_rpts.append(align_rpt)
+	cfg_file=os.path.join(out_dir, "bench_cfg.yml")
+	writeConfig(cfg_file, out_dir, names, seq_rpts, align_rpts)
+	print "config: %s" % cfg_file
+
+if __name__=="__main__":
+	main()
@@ -2,11 +2,21 @@ import unittest
 import cStringIO
 import sys
 import os
+import tempfile
+import gzip
+import struct
+import subprocess
+import shutil
+import sqlite3
+import threading
+import time
+import numpy as np
 
 direct=os.getcwd()
 sys.path.append(direct)
 
-from assm_align import mergeLoc, getLength
+from assm_align import mergeLoc, getLength, mergeIntervals, parseAlignReport, Seq, ReportCache, TopN, streamAlignReport, BedWriter, topNIntervals, topNBySeq, writeTopTen, parseSeqRep, Assembly, Metrics, BgzfWriter, readLines, IntervalIndex, parseRegion, windowCoverage, readMulti, writeNWayStats, BuildManifest, OutputScheduler, writeOutput, renderGraphs, imageOutFiles, OutputsFailed, writeExportDb, PairCache, serviceRequest, GapIndex, fastaGaps, twoBitGaps, seqAliases, CorruptInput, readManifest, runPairs, writeSummary, runBatch, queryIndex, writeDensity
+import assm_align
 
 class check_mergeLoc(unittest.TestCase):
 
@@ -27,6 +37,36 @@ class check_mergeLoc(unittest.TestCase):
 	def test_mergeLoc3(self):
 		self.assertEqual(mergeLoc(self.loc_list3), self.merge_loc_list3)
 
+	def test_mergeLoc_unsorted(self):
+		self.assertEqual(mergeLoc(['1:110-120', '1:50-150', '1:1-100']), self.merge_loc_list1)
+
+	def test_mergeLoc_bookend(self):
+		self.assertEqual(mergeLoc(['1:1-100', '1:100-120']), [('1',1,120,119)])
+
+	def test_mergeLoc_empty(self):
+		self.assertEqual(mergeLoc([]), [])
+
+class check_imports(unittest.TestCase):
+
+	def test_lazy_plotting(self):
+		#plotting libraries are only imported when a graph is drawn
+		code="import sys; import assm_align; print(','.join(sorted(mod for mod in ('matplotlib', 'seaborn', 'pybedtools') if mod in sys.modules)))"
+		out=subprocess.check_output([sys.executable, "-c", code], cwd=direct)
+		self.assertEqual(out.strip(), "")
+
+class check_mergeIntervals(unittest.TestCase):
+
+	def test_groups(self):
+		(grp, start, end)=mergeIntervals([9, 0, 10, 0], [20, 8, 12, 3], [0, 0, 0, 1])
+		self.assertEqual(grp.tolist(), [0, 0, 1])
+		self.assertEqual(start.tolist(), [0, 9, 0])
+		self.assertEqual(end.tolist(), [8, 20, 3])
+
+	def test_contained(self):
+		(grp, start, end)=mergeIntervals([0, 2, 4, 30], [50, 3, 60, 40])
+		self.assertEqual(start.tolist(), [0])
+		self.assertEqual(end.tolist(), [60])
+
 class check_getLength(unittest.TestCase):
 
 	def setUp(self):
@@ -41,5 +81,732 @@ class check_getLength(unittest.TestCase):
 	def test_getLen2(self):
 		self.assertEqual(getLength(self.loc_list2), self.len2)
 
+ALIGN_RPT="""# Alignment report
+Query Assembly Name: asmA
+
+Sequence Name: 1
+#Type\tStart\tStop\tGapped\tGap\tUngapped
+NoHit\t1\t100\t100\t0\t100
+NoHit\t201\t300\t100\t90\t10
+SP\t51\t150\t100\t0\t100
+SP\t101\t200\t100\t0\t100
+Mix\t11\t20\t10\t0\t10
+
+Sequence Name: 2
+SP Only\t1\t10\t10\t0\t10
+Inv\t21\t30\t10\t0\t10
+"""
+
+class check_parseAlignReport(unittest.TestCase):
+
+	def setUp(self):
+		(fd, self.rpt)=tempfile.mkstemp()
+		os.write(fd, ALIGN_RPT)
+		os.close(fd)
+		self.assm_dict={}
+		for name in ('1', '2', '3'):
+			self.assm_dict[name]=Seq()
+			self.assm_dict[name].name=name
+		parseAlignReport(self.rpt, 'asmA', self.assm_dict)
+
+	def tearDown(self):
+		os.remove(self.rpt)
+
+	def test_nohit(self):
+		seq=self.assm_dict['1']
+		self.assertEqual(seq.nohit_len, 200)
+		self.assertEqual(seq.ungap_nohit_len, 110)
+		self.assertEqual(seq.no_hit_list, [('1',0,100,100), ('1',200,300,100)])
+		self.assertEqual(seq.ungap_no_hit_list, [('1',0,100,100)])
+
+	def test_merged(self):
+		self.assertEqual(self.assm_dict['1'].sp_list, [('1',50,200,150)])
+		self.assertEqual(self.assm_dict['1'].sp_len, 150)
+		self.assertEqual(self.assm_dict['1'].mix_loc_list, [('1',10,20,10)])
+		self.assertEqual(self.assm_dict['2'].sp_only_len, 10)
+		self.assertEqual(self.assm_dict['2'].inv_loc_list, [('2',20,30,10)])
+		self.assertEqual(self.assm_dict['2'].no_hit_list, [])
+
+	def test_jobs(self):
+		par_dict={}
+		for name in self.assm_dict:
+			par_dict[name]=Seq()
+			par_dict[name].name=name
+		parseAlignReport(self.rpt, 'asmA', par_dict, jobs=3)
+		for name in self.assm_dict:
+			self.assertEqual(vars(par_dict[name]), vars(self.assm_dict[name]))
+
+	def test_no_data(self):
+		seq=self.assm_dict['3']
+		self.assertEqual((seq.nohit_len, seq.sp_len, seq.sp_only_len, seq.inv_len, seq.mix_len), (0, 0, 0, 0, 0))
+
+SEQ_RPT="""# Assembly Name:  asmA
+# Sequence-Name\tSequence-Role\tAssigned-Molecule\tAssigned-Molecule-Location/Type\tGenBank-Accn\tRelationship\tRefSeq-Accn\tAssembly-Unit\tSequence-Length\tUCSC-style-name
+1\tassembled-molecule\t1\tChromosome\tCM1\t=\tNC1\tPrimary Assembly\t1000\tchr1
+2\tassembled-molecule\t2\tChromosome\tCM2\t=\tNC2\tPrimary Assembly\t800\tchr2
+MT\tassembled-molecule\tMT\tMitochondrion\tJ01\t=\tNC3\tnon-nuclear\t160\tchrM
+3\tunplaced-scaffold\tna\tna\tGL1\t=\tNT1\tPrimary Assembly\t500\tchrUn
+"""
+
+class check_Assembly(unittest.TestCase):
+
+	def setUp(self):
+		self.files=[]
+		for text in (SEQ_RPT, ALIGN_RPT):
+			(fd, fi)=tempfile.mkstemp()
+			os.write(fd, text)
+			os.close(fd)
+			self.files.append(fi)
+		self.chrom_list=[]
+		self.assm=parseSeqRep(self.files[0], 'asmA', 'GCF_1', self.chrom_list, True)
+		parseAlignReport(self.files[1], 'asmA', self.assm)
+
+	def tearDown(self):
+		for fi in self.files:
+			os.remove(fi)
+
+	def test_seq_rpt(self):
+		self.assertTrue(isinstance(self.assm, Assembly))
+		self.assertEqual(self.chrom_list, ['1', '2'])
+		self.assertEqual(self.assm.chromList(False), ['1', '2', 'MT'])
+		self.assertEqual(sorted(self.assm.keys()), ['1', '2', '3', 'MT'])
+		seq=self.assm['3']
+		self.assertEqual((seq.name, seq.length, seq.role, seq.assm_unit, seq.ref_acc), ('3', 500, 'unplaced-scaffold', 'Primary Assembly', 'GCF_1'))
+
+	def test_views(self):
+		full_dict={}
+		for name in self.assm:
+			full_dict[name]=Seq()
+			full_dict[name].name=name
+		parseAlignReport(self.files[1], 'asmA', full_dict)
+		for name in self.assm:
+			for attr in ('nohit_len', 'ungap_nohit_len', 'sp_len', 'sp_only_len', 'inv_len', 'mix_len', 'no_hit_list', 'ungap_no_hit_list', 'sp_list', 'sp_only_list', 'inv_loc_list', 'mix_loc_list'):
+				self.assertEqual(getattr(self.assm[name], attr), getattr(full_dict[name], attr))
+
+	def test_totals(self):
+		self.assertEqual(self.assm.totals(), [200, 110, 150, 10, 10, 10])
+		self.assertEqual(self.assm.copy().totals(), [0, 0, 0, 0, 0, 0])
+
+	def test_density(self):
+		(rows, starts, ends, covered)=windowCoverage(self.assm, 100, 50)
+		first=np.flatnonzero(rows == self.assm.index['1'])[:5]
+		self.assertEqual(starts[first].tolist(), [0, 50, 100, 150, 200])
+		self.assertEqual(covered['nohit'][first].tolist(), [100, 50, 0, 50, 100])
+		self.assertEqual(covered['collapse'][first].tolist(), [50, 100, 100, 50, 0])
+		#last window of a sequence is clipped to its length
+		mt=np.flatnonzero(rows == self.assm.index['MT'])
+		self.assertEqual((starts[mt[-1]], ends[mt[-1]]), (150, 160))
+		self.assertEqual(covered['inv'].sum(), 10)
+		#sliding windows: each bedGraph row is the first step of its window, so rows don't overlap
+		out_dir=tempfile.mkdtemp()
+		try:
+			writeDensity(os.path.join(out_dir, "density"), self.assm, 100, 50)
+			lines=open(os.path.join(out_dir, "density_collapse.bedGraph")).read().split("\n")
+			self.assertEqual(lines[1:5], ["1\t0\t50\t0.5", "1\t50\t100\t1", "1\t100\t150\t1", "1\t150\t200\t0.5"])
+		finally:
+			shutil.rmtree(out_dir)
+
+	def test_index(self):
+		(fd, index_file)=tempfile.mkstemp(suffix=".npz")
+		os.close(fd)
+		self.files.append(index_file)
+		IntervalIndex.fromAssemblies([self.assm]).save(index_file)
+		index=IntervalIndex.load(index_file)
+		self.assertEqual(index.names(), ['asmA'])
+		self.assertEqual(index.query('1', 90, 120), [('nohit', 0, 100), ('ungap_nohit', 0, 100), ('sp', 50, 200)])
+		#half-open: touching an interval's end is not an overlap
+		self.assertEqual(index.query('1', 100, 101), [('sp', 50, 200)])
+		self.assertEqual(index.query('2', 0, 100), [('sp_only', 0, 10), ('inv', 20, 30)])
+		self.assertEqual(index.query('3', 0, 100), [])
+		self.assertEqual(index.query('nope', 0, 100), [])
+		hits=index.queryRegions(['2', '1', '1'], [0, 0, 150], [25, 300, 250])
+		self.assertEqual(hits['nohit'][0].tolist(), [1, 1, 2])
+		self.assertEqual(hits['inv'][0].tolist(), [0])
+		self.assertEqual(parseRegion("1:1,001-2,000"), ('1', 1000, 2000))
+		self.assertEqual(parseRegion("1:5"), ('1', 4, 5))
+		self.assertEqual(parseRegion("chrUn"), ('chrUn', 0, IntervalIndex.SHIFT-1))
+		for region in ("1:abc-5", "1:10-5", "1:0-5"):
+			self.assertRaises(ValueError, parseRegion, region)
+		with self.assertRaises(SystemExit) as e:
+			queryIndex(index_file, ["1:abc-5"], fh=cStringIO.StringIO())
+		self.assertEqual(e.exception.code, 1)
+		self.assertRaises(KeyError, index.side, 'asmB')
+
+	def test_export_db(self):
+		(fd, db_file)=tempfile.mkstemp(suffix=".sqlite")
+		os.close(fd)
+		self.files.append(db_file)
+		writeExportDb(db_file, [self.assm])
+		con=sqlite3.connect(db_file)
+		self.assertEqual(con.execute("SELECT COUNT(*) FROM sequence WHERE assembly='asmA'").fetchone()[0], len(self.assm))
+		self.assertEqual(con.execute("SELECT seq, start, stop, length FROM intervals WHERE category='collapse' ORDER BY length DESC").fetchall(), [('1', 50, 200, 150)])
+		self.assertEqual(con.execute("SELECT seq, start, stop FROM intervals WHERE category='inv'").fetchall(), [('2', 20, 30)])
+		self.assertEqual(con.execute("SELECT sp_len FROM sequence WHERE seq='1'").fetchone()[0], self.assm['1'].sp_len)
+		con.close()
+
+class check_streamAlignReport(unittest.TestCase):
+
+	def setUp(self):
+		(fd, self.rpt)=tempfile.mkstemp()
+		os.write(fd, ALIGN_RPT)
+		os.close(fd)
+
+	def tearDown(self):
+		os.remove(self.rpt)
+
+	def test_stream(self):
+		assm_dict={}
+		full_dict={}
+		for name in ('1', '2', '3'):
+			assm_dict[name]=Seq()
+			full_dict[name]=Seq()
+		bed=BedWriter(self.rpt+".bed")
+		top_lists={'sp': TopN(1)}
+		streamAlignReport(self.rpt, 'asmA', assm_dict, {'nohit': bed}, top_lists)
+		bed.close()
+		parseAlignReport(self.rpt, 'asmA', full_dict)
+		for name in assm_dict:
+			for attr in ('nohit_len', 'ungap_nohit_len', 'sp_len', 'sp_only_len', 'inv_len', 'mix_len'):
+				self.assertEqual(getattr(assm_dict[name], attr), getattr(full_dict[name], attr))
+		self.assertEqual(open(bed.out_file).read().split("\n", 1)[1], "1\t0\t100\n1\t200\t300\n")
+		os.remove(bed.out_file)
+		self.assertEqual(top_lists['sp'].items(), [('1',50,200,150)])
+
+	def writeReport(self, text):
+		with open(self.rpt, 'w') as fh:
+			fh.write(text)
+
+	def test_split_block(self):
+		#sequence 1 in two consecutive blocks with overlapping rows: merged across them, as without streaming
+		self.writeReport(ALIGN_RPT.replace("SP\t101\t200", "\nSequence Name: 1\nSP\t101\t200"))
+		assm_dict=dict((name, Seq()) for name in ('1', '2', '3'))
+		full_dict=dict((name, Seq()) for name in ('1', '2', '3'))
+		bgzip_bed=BedWriter(self.rpt+".sp.bed", True)
+		streamAlignReport(self.rpt, 'asmA', assm_dict, {'sp': bgzip_bed}, {})
+		bgzip_bed.close()
+		parseAlignReport(self.rpt, 'asmA', full_dict)
+		self.assertEqual(assm_dict['1'].sp_len, 150)
+		self.assertEqual(assm_dict['1'].sp_len, full_dict['1'].sp_len)
+		self.assertEqual(bgzip_bed.index.names, ['1'])
+		self.assertEqual(gzip.open(bgzip_bed.out_file).read().split("\n", 1)[1], "1\t50\t200\n")
+		for fi in (bgzip_bed.out_file, bgzip_bed.out_file+".tbi"):
+			os.remove(fi)
+
+	def test_repeated_block(self):
+		#sequence 1 again after sequence 2: its rows are already written, so streaming stops
+		self.writeReport(ALIGN_RPT+"\nSequence Name: 1\nSP\t101\t200\t100\t0\t100\n")
+		assm_dict=dict((name, Seq()) for name in ('1', '2', '3'))
+		with self.assertRaises(SystemExit):
+			streamAlignReport(self.rpt, 'asmA', assm_dict, {}, {})
+
+class check_topN(unittest.TestCase):
+
+	def setUp(self):
+		self.seq_names=['1', '2', 'un']
+		self.grouped=(np.array([0, 0, 0, 1, 1, 2]), np.array([0, 10, 100, 0, 50, 0]), np.array([5, 40, 130, 30, 60, 99]))
+		self.rank=np.array([0, 1, -1])
+
+	def test_genome(self):
+		self.assertEqual(topNIntervals(self.seq_names, self.grouped, 3, self.rank), [('1',10,40,30), ('1',100,130,30), ('2',0,30,30)])
+
+	def test_by_seq(self):
+		by_seq=topNBySeq(self.seq_names, self.grouped, 2, self.rank)
+		self.assertEqual(dict(by_seq), {'1': [('1',10,40,30), ('1',100,130,30)], '2': [('2',0,30,30), ('2',50,60,10)]})
+
+	def test_writeTopTen_mix(self):
+		seq=Seq()
+		seq.set_nohit(0, 0, [], [])
+		seq.set_sp(0, [])
+		seq.set_sp_only(0, [])
+		seq.set_inv(5, [('1',0,5,5)])
+		seq.set_mix(7, [('1',10,17,7)])
+		fh=cStringIO.StringIO()
+		writeTopTen(fh, 'A', 'B', {'1': seq}, 1)
+		self.assertTrue(fh.getvalue().endswith("##Mix\n#chr\tstart\tstop\tlen\n1\t10\t17\t7\n"))
+		self.assertTrue("##Top 1 by category." in fh.getvalue())
+
+class check_BedWriter(unittest.TestCase):
+
+	def setUp(self):
+		self.out_dir=tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.out_dir)
+
+	def test_bgzip(self):
+		out_file=os.path.join(self.out_dir, "A-B_inv.bed")
+		writer=BedWriter(out_file, bgzip=True)
+		writer.writeRows('1', range(0, 400000, 20), range(10, 400010, 20))
+		writer.writeRows('2', [5], [50])
+		writer.close()
+		lines=gzip.open(out_file+".gz").read().split("\n")
+		self.assertEqual(lines[0], "track name=A-B_inv")
+		self.assertEqual(lines[1:3], ["1\t0\t10", "1\t20\t30"])
+		self.assertEqual(lines[-2], "2\t5\t50")
+		tbi=gzip.open(out_file+".gz.tbi").read()
+		self.assertEqual(tbi[:4], "TBI\1")
+		self.assertEqual(struct.unpack("<iiiiiii", tbi[4:32]), (2, 0x10000, 1, 2, 3, ord('#'), 1))
+
+class check_iterLineChunks(unittest.TestCase):
+
+	def setUp(self):
+		self.out_dir=tempfile.mkdtemp()
+		self.text="".join(["row %d\tof\tlines\n" % i for i in range(50000)])
+		self.plain=os.path.join(self.out_dir, "rpt.txt")
+		with open(self.plain, 'w') as fh:
+			fh.write(self.text)
+		self.gz=self.plain+".gz"
+		with gzip.open(self.gz, 'wb') as fh:
+			fh.write(self.text)
+		self.bgz=self.plain+".bgz"
+		bgzf=BgzfWriter(self.bgz)
+		bgzf.write(self.text)
+		bgzf.close()
+
+	def tearDown(self):
+		shutil.rmtree(self.out_dir)
+
+	def test_formats(self):
+		lines=self.text.split("\n")[:-1]
+		for (fi, jobs) in ((self.plain, 1), (self.gz, 1), (self.bgz, 1), (self.bgz, 3)):
+			self.assertEqual(list(readLines(fi, jobs)), lines)
+
+	def test_small_chunks(self):
+		#lines split across chunk boundaries come back whole
+		chunk=assm_align.READ_CHUNK
+		assm_align.READ_CHUNK=1000
+		try:
+			self.assertEqual(list(readLines(self.plain)), self.text.split("\n")[:-1])
+		finally:
+			assm_align.READ_CHUNK=chunk
+
+	def test_compressed_report(self):
+		bgz=os.path.join(self.out_dir, "align.bgz")
+		bgzf=BgzfWriter(bgz)
+		bgzf.write(ALIGN_RPT)
+		bgzf.close()
+		(fd, rpt)=tempfile.mkstemp(dir=self.out_dir)
+		os.write(fd, ALIGN_RPT)
+		os.close(fd)
+		self.assertEqual(parseAlignReport(bgz, 'asmA', {})[0], parseAlignReport(rpt, 'asmA', {})[0])
+		self.assertEqual(parseAlignReport(bgz, 'asmA', {})[1]['sp'][1].tolist(), parseAlignReport(rpt, 'asmA', {})[1]['sp'][1].tolist())
+
+	def damaged(self, fi, edit):
+		out=os.path.join(self.out_dir, "damaged")
+		with open(out, 'wb') as fh:
+			fh.write(edit(open(fi, 'rb').read()))
+		return out
+
+	def test_corrupt(self):
+		#decode errors say where and why, not that the file can't be opened
+		flip=lambda data: data[:len(data)//2]+chr(ord(data[len(data)//2])^0xff)+data[len(data)//2+1:]
+		for (fi, edit, where) in ((self.bgz, lambda data: data[:-100], "Truncated BGZF block at byte "),
+				(self.bgz, flip, "Corrupt BGZF block at byte "),
+				(self.gz, flip, "Corrupt gzip data")):
+			with self.assertRaises(CorruptInput) as e:
+				list(readLines(self.damaged(fi, edit)))
+			self.assertTrue(e.exception.where.startswith(where), e.exception.where)
+		bgz=os.path.join(self.out_dir, "align.bgz")
+		bgzf=BgzfWriter(bgz)
+		bgzf.write(ALIGN_RPT)
+		bgzf.close()
+		with self.assertRaises(SystemExit) as e:
+			parseAlignReport(self.damaged(bgz, lambda data: data[:-40]), 'asmA', {})
+		self.assertEqual(e.exception.code, 2)
+
+class check_TopN(unittest.TestCase):
+
+	def test_ties(self):
+		top=TopN(2)
+		for loc in [('1',0,5,5), ('1',10,20,10), ('2',0,10,10), ('2',20,40,20)]:
+			top.push(loc)
+		self.assertEqual(top.items(), [('2',20,40,20), ('1',10,20,10)])
+
+	def test_arrays(self):
+		top=TopN(3)
+		top.pushArrays('1', np.array([0, 10, 30, 50]), np.array([5, 25, 31, 90]))
+		top.pushArrays('2', np.array([0]), np.array([15]))
+		self.assertEqual(top.items(), [('1',50,90,40), ('1',10,25,15), ('2',0,15,15)])
+
+class check_ReportCache(unittest.TestCase):
+
+	def setUp(self):
+		self.cache_dir=tempfile.mkdtemp()
+		(fd, self.rpt)=tempfile.mkstemp()
+		os.write(fd, ALIGN_RPT)
+		os.close(fd)
+
+	def tearDown(self):
+		shutil.rmtree(self.cache_dir)
+		os.remove(self.rpt)
+
+	def test_roundtrip(self):
+		cache=ReportCache(self.cache_dir)
+		key=cache.key("align", self.rpt, 'asmA')
+		self.assertEqual(cache.load(key), None)
+		cache.save(key, {'start': np.arange(5)})
+		self.assertEqual(cache.load(key)['start'].tolist(), [0, 1, 2, 3, 4])
+		self.assertNotEqual(cache.key("align", self.rpt, 'asmB'), key)
+
+	def test_evict(self):
+		cache=ReportCache(self.cache_dir, max_mb=0.01)
+		cache.save('old', {'start': np.zeros(1000)})
+		os.utime(os.path.join(self.cache_dir, 'old'), (0, 0))
+		cache.save('new', {'start': np.zeros(1000)})
+		self.assertEqual(cache.load('old'), None)
+		self.assertNotEqual(cache.load('new'), None)
+
+class check_BuildManifest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir=tempfile.mkdtemp()
+		self.manifest_file=os.path.join(self.tmp_dir, "build.json")
+		self.out=os.path.join(self.tmp_dir, "out.txt")
+		with open(self.out, 'w') as fh:
+			fh.write("stats\n")
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_fresh(self):
+		build=BuildManifest(self.manifest_file)
+		key=build.key('stats', build.fileHash(self.out), 10)
+		self.assertFalse(build.fresh(self.out, key))
+		build.record(self.out, key, [self.out])
+		build.save()
+		build=BuildManifest(self.manifest_file)
+		self.assertTrue(build.fresh(self.out, key))
+		self.assertFalse(build.fresh(self.out, build.key('stats', build.fileHash(self.out), 5)))
+		with open(self.out, 'a') as fh:
+			fh.write("edited\n")
+		self.assertFalse(build.fresh(self.out, key))
+
+	def test_standIn(self):
+		(fd, seq_rpt)=tempfile.mkstemp(dir=self.tmp_dir)
+		os.write(fd, SEQ_RPT)
+		os.close(fd)
+		(fd, align_rpt)=tempfile.mkstemp(dir=self.tmp_dir)
+		os.write(fd, ALIGN_RPT)
+		os.close(fd)
+		chrom_list=[]
+		assm=parseSeqRep(seq_rpt, 'asmA', 'GCF_1', chrom_list, True)
+		parseAlignReport(align_rpt, 'asmA', assm)
+		build=BuildManifest(self.manifest_file)
+		build.recordSide('asmA|asmB', 'k1', assm, chrom_list)
+		build.save()
+		build=BuildManifest(self.manifest_file)
+		self.assertEqual(build.standIn('asmA|asmB', 'k2', {'name': 'asmA', 'acc': 'GCF_1'}), None)
+		(stand_in, stand_in_chroms)=build.standIn('asmA|asmB', 'k1', {'name': 'asmA', 'acc': 'GCF_1'})
+		self.assertEqual(stand_in_chroms, chrom_list)
+		self.assertEqual(stand_in.names, assm.names)
+		self.assertEqual(stand_in.totals(), assm.totals())
+
+	def test_plan_missing_beds(self):
+		#bed keys left out of the config are off, as without --incremental
+		files={}
+		for (name, text) in (('seq_rpt', SEQ_RPT), ('align_rpt', ALIGN_RPT)):
+			files[name]=os.path.join(self.tmp_dir, name+".txt")
+			with open(files[name], 'w') as fh:
+				fh.write(text)
+		assm=dict(files, acc='GCF_1', name='asmA')
+		side_outs=lambda pre: {'stats': os.path.join(self.tmp_dir, pre+"_stats.txt"), 'top_ten': False, 'no_hit_bed': os.path.join(self.tmp_dir, pre+"_no_hit.bed")}
+		cfg_dict={'input_files': {'assm1': assm, 'assm2': assm}, 'params': {'exclude_mt': True, 'make_bed': True},
+			'output_files': {'assm1': side_outs("a"), 'assm2': side_outs("b"), 'comp_img': {}}}
+		plan=assm_align.BuildPlan(BuildManifest(self.manifest_file), cfg_dict)
+		self.assertEqual(sorted([os.path.basename(out_path) for (out_path, key, out_files) in plan.todo]), ["a_no_hit.bed", "a_stats.txt", "b_no_hit.bed", "b_stats.txt"])
+
+class check_OutputScheduler(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir=tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def writeLine(self, fh, text):
+		fh.write(text+"\n")
+
+	def test_failed(self):
+		for workers in (0, 2):
+			outputs=OutputScheduler(workers)
+			good=os.path.join(self.tmp_dir, "good%d.txt" % workers)
+			bad=os.path.join(self.tmp_dir, "missing", "bad.txt")
+			outputs.write("stats", 'asmA', [bad], writeOutput, bad, self.writeLine, "bad")
+			outputs.write("stats", 'asmA', [good], writeOutput, good, self.writeLine, "good")
+			self.assertEqual(outputs.finish(), [bad])
+			self.assertEqual(open(good).read(), "good\n")
+
+	def test_beds_failed(self):
+		#all beds of a side are one task, a bed that can't be written fails alone
+		assm=Assembly('asmA', 'GCF_1', ['1'], [100], ['assembled-molecule'], ['Primary Assembly'])
+		good=os.path.join(self.tmp_dir, "inv.bed")
+		bad=os.path.join(self.tmp_dir, "missing", "mix.bed")
+		outputs=OutputScheduler(0)
+		outputs.write("beds", 'asmA', [good, bad], assm_align.writeBeds, {'inv': good, 'mix': bad}, assm)
+		self.assertEqual(outputs.finish(), [bad])
+		self.assertEqual(open(good).read(), "track name=inv\n")
+
+class check_renderGraphs(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir=tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_batch(self):
+		(plt, sns)=assm_align.plotImports()
+		chroms=["1", "2", "3"]
+		graphs=[(os.path.join(self.tmp_dir, "%s.png" % name), 'pair', (chroms, [1, 2, 3], [3, 2, 1], 'asmA', 'asmB', name)) for name in ("collapse", "expand")]
+		graphs.append((os.path.join(self.tmp_dir, "panel.png"), 'panel', (chroms, 'asmA', 'asmB', [([1, 2, 3], [3, 2, 1], "collapse"), ([2, 2, 2], [1, 1, 1], "expand")])))
+		#one failing graph doesn't stop the others
+		bad=os.path.join(self.tmp_dir, "missing", "bad.png")
+		graphs.insert(1, (bad, 'pair', (chroms, [1, 2, 3], [3, 2, 1], 'asmA', 'asmB', "bad")))
+		with self.assertRaises(OutputsFailed) as err:
+			renderGraphs(graphs, ["svg"], 20)
+		self.assertEqual(err.exception.outputs, [bad])
+		for (out_img, draw, args) in graphs[:1]+graphs[2:]:
+			for fi in imageOutFiles(out_img, ["svg"], 20):
+				self.assertTrue(os.path.getsize(fi) > 0)
+		self.assertEqual(plt.get_fignums(), [])
+
+	def test_imageOutFiles(self):
+		self.assertEqual(imageOutFiles("img/a.png", ["png", "pdf"], 30), ["img/a.png", "img/a.pdf", "img/a.preview.png"])
+
+class check_multi(unittest.TestCase):
+
+	def setUp(self):
+		self.out_dir=tempfile.mkdtemp()
+		self.multi_file=os.path.join(self.out_dir, "multi.yml")
+		with open(self.multi_file, 'w') as fh:
+			fh.write("""reference: {acc: GCF_1, name: R, seq_rpt: R.txt}
+params: {exclude_mt: yes, make_bed: no}
+out_dir: %s
+queries:
+  - {acc: GCF_2, name: Q1, seq_rpt: Q1.txt, align_rpt: Q1-R.report.txt, ref_align_rpt: R-Q1.report.txt}
+  - {acc: GCF_3, name: Q2, seq_rpt: Q2.txt, align_rpt: Q2-R.report.txt, ref_align_rpt: R-Q2.report.txt, params: {make_bed: yes}}
+""" % self.out_dir)
+
+	def tearDown(self):
+		shutil.rmtree(self.out_dir)
+
+	def test_readMulti(self):
+		(multi, pair_cfgs)=readMulti(self.multi_file)
+		self.assertEqual([cfg['input_files']['assm2']['name'] for cfg in pair_cfgs], ['Q1', 'Q2'])
+		self.assertEqual(pair_cfgs[1]['input_files']['assm1'], {'acc': 'GCF_1', 'name': 'R', 'seq_rpt': 'R.txt', 'align_rpt': 'R-Q2.report.txt'})
+		self.assertEqual([cfg['params']['make_bed'] for cfg in pair_cfgs], [False, True])
+		self.assertEqual(pair_cfgs[0]['output_files']['assm2']['stats'], os.path.join(self.out_dir, "stats", "Q1-R_alignment_stats.txt"))
+		self.assertTrue(os.path.isdir(os.path.join(self.out_dir, "bed")))
+
+	def test_writeNWayStats(self):
+		fh=cStringIO.StringIO()
+		ref_stats=[np.array([[5, 4, 3, 2, 1, 0], [10, 0, 0, 0, 0, 0]]), np.array([[6, 0, 0, 0, 0, 1], [0, 0, 0, 0, 0, 0]])]
+		writeNWayStats(fh, 'R', ['Q1', 'Q2'], ['1', '2'], ref_stats, ["Q1\tR\t2\t2\t1\t1\t1\t1\t1\t1\tok\n"])
+		lines=fh.getvalue().split("\n")
+		self.assertEqual(lines[0], "##R vs 2 assemblies: Q1, Q2")
+		self.assertEqual(lines[2:7], ["##NoHit", "#Sequence\tQ1\tQ2", "1\t5\t6", "2\t10\t0", "total\t15\t6"])
+		self.assertTrue("total\t0\t1" in lines)
+		self.assertEqual(lines[-2], "Q1\tR\t2\t2\t1\t1\t1\t1\t1\t1\tok")
+
+class check_batch(unittest.TestCase):
+
+	def setUp(self):
+		self.out_dir=tempfile.mkdtemp()
+		for (name, text) in (('seq_rpt', SEQ_RPT), ('align_rpt', ALIGN_RPT)):
+			with open(os.path.join(self.out_dir, name+".txt"), 'w') as fh:
+				fh.write(text)
+		self.manifest_file=os.path.join(self.out_dir, "batch.yml")
+		self.summary=os.path.join(self.out_dir, "summary.txt")
+		#the report is asmA's, so the second pair fails
+		with open(self.manifest_file, 'w') as fh:
+			fh.write("""params: {exclude_mt: yes, make_bed: no}
+summary: %(dir)s/summary.txt
+pairs:
+  - input_files:
+      assm1: {acc: GCF_1, name: asmA, seq_rpt: %(dir)s/seq_rpt.txt, align_rpt: %(dir)s/align_rpt.txt}
+      assm2: {acc: GCF_1, name: asmA, seq_rpt: %(dir)s/seq_rpt.txt, align_rpt: %(dir)s/align_rpt.txt}
+    output_files: &outs
+      assm1: {stats: %(dir)s/stats1.txt, top_ten: no}
+      assm2: {stats: %(dir)s/stats2.txt, top_ten: no}
+      comp_img: {both_collapse: no, both_expand: no, both_nohit: no, both_ungap_nohit: no}
+  - input_files:
+      assm1: {acc: GCF_1, name: asmA, seq_rpt: %(dir)s/seq_rpt.txt, align_rpt: %(dir)s/align_rpt.txt}
+      assm2: {acc: GCF_2, name: asmB, seq_rpt: %(dir)s/seq_rpt.txt, align_rpt: %(dir)s/align_rpt.txt}
+    output_files: *outs
+    params: {exclude_mt: no}
+""" % {'dir': self.out_dir})
+
+	def tearDown(self):
+		shutil.rmtree(self.out_dir)
+		assm_align.SEQ_RPT_CACHE.clear()
+
+	def test_readManifest(self):
+		(manifest, pair_cfgs)=readManifest(self.manifest_file)
+		self.assertEqual(manifest['summary'], self.summary)
+		self.assertEqual([cfg['input_files']['assm2']['name'] for cfg in pair_cfgs], ['asmA', 'asmB'])
+		self.assertEqual([cfg['params'] for cfg in pair_cfgs], [{'exclude_mt': True, 'make_bed': False}, {'exclude_mt': False, 'make_bed': False}])
+
+	def test_failed_pair(self):
+		(manifest, pair_cfgs)=readManifest(self.manifest_file)
+		results=runPairs(pair_cfgs)
+		self.assertEqual([res[0] for res in results], [0, 3])
+		self.assertEqual(writeSummary(self.summary, self.manifest_file, pair_cfgs, results), 1)
+		lines=open(self.summary).read().split("\n")
+		self.assertEqual(lines[2].split("\t")[-1], "Status")
+		self.assertEqual(lines[3:5], ["asmA\tasmA\t4\t2\t200\t110\t150\t10\t10\t10\tok"]*2)
+		self.assertEqual([line.split("\t")[:3]+line.split("\t")[-1:] for line in lines[5:7]],
+			[["asmA", "asmB", "NA", "failed (exit 3)"], ["asmB", "asmA", "NA", "failed (exit 3)"]])
+		self.assertEqual(lines[7:], [""])
+		with self.assertRaises(SystemExit) as e:
+			runBatch(self.manifest_file)
+		self.assertEqual(e.exception.code, 4)
+
+class check_GapIndex(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir=tempfile.mkdtemp()
+		self.seqs=[('chr1', "ACNNNNGTnnAC"+"A"*20+"NN"), ('chr2', "ACGT")]
+		self.fasta=os.path.join(self.tmp_dir, "seq.fa")
+		with open(self.fasta, 'w') as fh:
+			for (name, seq) in self.seqs:
+				fh.write(">%s description\n%s\n" % (name, "\n".join([seq[i:i+5] for i in range(0, len(seq), 5)])))
+		#2bit with the same N blocks; the packed bases don't matter
+		self.two_bit=os.path.join(self.tmp_dir, "seq.2bit")
+		blocks=[[(2, 4), (8, 2), (32, 2)], []]
+		index=""
+		records=""
+		offset=16+sum([1+len(name)+4 for (name, seq) in self.seqs])
+		for ((name, seq), seq_blocks) in zip(self.seqs, blocks):
+			record=struct.pack("<II", len(seq), len(seq_blocks))+"".join([struct.pack("<I", s) for (s, size) in seq_blocks])+"".join([struct.pack("<I", size) for (s, size) in seq_blocks])+struct.pack("<II", 0, 0)+"\0"*((len(seq)+3)//4)
+			index += chr(len(name))+name+struct.pack("<I", offset+len(records))
+			records += record
+		with open(self.two_bit, 'wb') as fh:
+			fh.write(struct.pack("<IIII", 0x1A412743, 0, len(self.seqs), 0)+index+records)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_readers(self):
+		for gaps in (fastaGaps(self.fasta), twoBitGaps(self.two_bit)):
+			(names, lengths, rows, starts, ends)=gaps
+			self.assertEqual(names, ['chr1', 'chr2'])
+			self.assertEqual(list(lengths), [34, 4])
+			index=GapIndex(*gaps)
+			self.assertEqual(zip(index.starts.tolist(), index.ends.tolist()), [(2, 6), (8, 10), (32, 34)])
+
+	def test_count(self):
+		index=GapIndex(*fastaGaps(self.fasta))
+		seq=self.seqs[0][1].upper()
+		spans=[(s, e) for s in range(len(seq)+1) for e in range(s, len(seq)+1)]
+		counts=index.count([0]*len(spans), [s for (s, e) in spans], [e for (s, e) in spans])
+		self.assertEqual(counts.tolist(), [seq[s:e].count("N") for (s, e) in spans])
+		self.assertEqual(index.count([1, -1], [0, 0], [4, 4]).tolist(), [0, -1])
+
+	def test_setGaps(self):
+		(fd, seq_rpt)=tempfile.mkstemp(dir=self.tmp_dir)
+		os.write(fd, SEQ_RPT)
+		os.close(fd)
+		assm=parseSeqRep(seq_rpt, 'asmA', 'GCF_1', [], True)
+		#chr1 and chr2 are the UCSC-style names of 1 and 2
+		matched=assm.setGaps(GapIndex(*fastaGaps(self.fasta)), seqAliases(seq_rpt))
+		self.assertEqual(matched, {0: 0, 1: 1})
+		self.assertEqual(assm.nCounts(np.array([0, 1, 2]), [0, 0, 0], [10, 4, 10]).tolist(), [6, 0, -1])
+
+class check_service(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp_dir=tempfile.mkdtemp()
+		files={}
+		for (name, text) in (('seq_rpt', SEQ_RPT), ('align_rpt', ALIGN_RPT)):
+			files[name]=os.path.join(self.tmp_dir, name+".txt")
+			with open(files[name], 'w') as fh:
+				fh.write(text)
+		assm=dict(files, acc='GCF_1', name='asmA')
+		cfg_dict={'input_files': {'assm1': assm, 'assm2': assm}, 'params': {'exclude_mt': True}}
+		#the report is asmA's, so the last pair fails to load
+		bad={'input_files': {'assm1': assm, 'assm2': dict(assm, name='asmB')}, 'params': {'exclude_mt': True}}
+		self.pairs=PairCache([cfg_dict, cfg_dict, bad], max_pairs=1)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp_dir)
+
+	def test_lru(self):
+		self.assertEqual([pair['pair'] for pair in self.pairs.pairs()], ['asmA-asmA', 'asmA-asmA.2', 'asmA-asmB'])
+		pair=self.pairs.get('asmA-asmA')
+		self.assertTrue(self.pairs.get('asmA-asmA') is pair)
+		self.pairs.get('asmA-asmA.2')
+		self.assertEqual(self.pairs.loaded.keys(), ['asmA-asmA.2'])
+		self.assertFalse(self.pairs.get('asmA-asmA') is pair)
+
+	def test_requests(self):
+		(status, body)=serviceRequest(self.pairs, "/stats", {'pair': ['asmA-asmA'], 'seq': ['1']})
+		self.assertEqual(status, 200)
+		self.assertEqual(body['sequences'][0]['sp_len'], 150)
+		self.assertEqual(body['totals']['sp_only_len'], 10)
+		(status, body)=serviceRequest(self.pairs, "/top", {'pair': ['asmA-asmA'], 'n': ['1'], 'category': ['nohit', 'inv']})
+		self.assertEqual(body['top'], {'nohit': [['1', 0, 100, 100]], 'inv': [['2', 20, 30, 10]]})
+		(status, body)=serviceRequest(self.pairs, "/top", {'pair': ['asmA-asmA'], 'n': ['1'], 'category': ['collapse', 'expansion', 'no_hit']})
+		self.assertEqual(body['top'], {'collapse': [['1', 50, 200, 150]], 'expansion': [['2', 0, 10, 10]], 'no_hit': [['1', 0, 100, 100]]})
+		(status, body)=serviceRequest(self.pairs, "/top", {'pair': ['asmA-asmA'], 'category': ['gap']})
+		self.assertEqual(status, 400)
+		self.assertTrue("collapse" in body['error'], body)
+		(status, body)=serviceRequest(self.pairs, "/region", {'pair': ['asmA-asmA'], 'region': ['1:100-120']})
+		self.assertEqual([(hit['type'], hit['start'], hit['end']) for hit in body['hits']], [('nohit', 0, 100), ('ungap_nohit', 0, 100), ('sp', 50, 200)])
+		self.assertEqual(serviceRequest(self.pairs, "/stats", {'pair': ['nope']})[0], 404)
+		self.assertEqual(serviceRequest(self.pairs, "/stats", {})[0], 400)
+		self.assertEqual(serviceRequest(self.pairs, "/top", {'pair': ['asmA-asmA'], 'n': ['x']})[0], 400)
+		for n in ('0', '-1', '10001'):
+			self.assertEqual(serviceRequest(self.pairs, "/top", {'pair': ['asmA-asmA'], 'n': [n]}), (400, {'error': "Bad n: %s, 1 to 10000" % n}))
+		for region in ('1:abc-5', '1:10-5', '1:0-5', '1:5-'):
+			self.assertEqual(serviceRequest(self.pairs, "/region", {'pair': ['asmA-asmA'], 'region': [region]})[0], 400)
+		self.assertEqual(serviceRequest(self.pairs, "/stats", {'pair': ['asmA-asmB']})[0], 500)
+
+class check_Metrics(unittest.TestCase):
+
+	def test_disabled(self):
+		metrics=Metrics()
+		with metrics.stage("merge", 'asmA') as stage:
+			stage.count('rows_parsed', 10)
+		self.assertEqual(metrics.records, [])
+
+	def test_stage(self):
+		metrics=Metrics(enabled=True)
+		metrics.pair="asmA vs asmB"
+		with metrics.stage("merge", 'asmA') as stage:
+			stage.count('rows_parsed', 10)
+			stage.count('rows_parsed', 5)
+		self.assertEqual(len(metrics.records), 1)
+		rec=metrics.records[0]
+		self.assertEqual((rec['stage'], rec['assembly'], rec['pair'], rec['rows_parsed']), ("merge", 'asmA', "asmA vs asmB", 15))
+		self.assertTrue(rec['wall_s'] >= 0 and rec['peak_rss_growth_mb'] >= 0 and rec['process_peak_rss_mb'] > 0)
+
+	def test_thread_cpu(self):
+		#a stage waiting in one thread isn't charged the cpu another thread burns meanwhile
+		metrics=Metrics(enabled=True)
+		started=threading.Event()
+		def waiting():
+			with metrics.stage("beds", 'asmA'):
+				started.set()
+				time.sleep(0.3)
+		thread=threading.Thread(target=waiting)
+		thread.start()
+		started.wait()
+		with metrics.stage("merge", 'asmA'):
+			end=time.time()+0.2
+			while time.time() < end:
+				pass
+		thread.join()
+		cpu=dict((rec['stage'], rec['cpu_s']) for rec in metrics.records)
+		self.assertTrue(cpu['merge'] > 0.1 and cpu['beds'] < 0.05, cpu)
+
+	def test_failed(self):
+		metrics=Metrics(enabled=True)
+		with self.assertRaises(ValueError):
+			with metrics.stage("merge", 'asmA'):
+				raise ValueError
+		self.assertTrue(metrics.records[0]['failed'])
+		self.assertEqual(len(metrics.collect(0)), 1)
+		self.assertEqual(metrics.records, [])
+
 if __name__ == '__main__':
 	unittest.main()